@@ -1,3 +1,5 @@
+import atexit
+import multiprocessing as mp
 import typing as ty
 
 import numpy as np
@@ -61,6 +63,10 @@ class Block:
     #: These can be overriden by Source attributes, just like model functions.
     model_attributes: ty.Tuple[str] = tuple()
 
+    #: Model attributes of this block that only affect performance,
+    #: see Source.non_physics_settings
+    non_physics_settings: ty.Tuple[str] = tuple()
+
     #: Set the maximum dimension size for a block's dimensions; these are used
     #: for variable tensor stepping
     max_dim_size: ty.Dict[str, int] = dict()
@@ -154,6 +160,13 @@ class Block:
                           <= d[f'{dim}_max'].values), \
                 f"_annotate of {self} set misordered bounds"
 
+    def prepare_annotate(self):
+        """Called before annotating data, always in the main process, also
+        when annotating in parallel. Override to do expensive setup that
+        all batches share, such as building an MC reservoir.
+        """
+        pass
+
     def annotate_special(self, d: pd.DataFrame):
         """Will be called after annotate for any blocks which choose to implement it.
         """
@@ -241,6 +254,22 @@ class BlockModelSource(fd.Source):
     #: Dimensions provided by the first block
     initial_dimensions: tuple
 
+    #: Number of processes to use for annotating data. If > 1, events are
+    #: annotated in chunks of whole batches in spawned worker processes,
+    #: which are reused across set_data calls (see close_annotate_pool).
+    n_annotate_processes = 1
+
+    non_physics_settings = fd.Source.non_physics_settings + (
+        'n_annotate_processes',)
+
+    # Sorted MC reservoir arrays for get_priors, see prepare_priors
+    _prior_reservoirs = None
+    _prior_reservoirs_key = None
+
+    # Worker pool for parallel annotation, see _get_annotate_pool
+    _annotate_pool = None
+    _annotate_pool_key = None
+
     def __init__(self, *args, **kwargs):
         if isinstance(self.model_blocks[0], FirstBlock):
             # Blocks have already been instantiated
@@ -261,6 +290,7 @@ class BlockModelSource(fd.Source):
             'special_model_functions',
             'model_attributes',
             'frozen_model_functions',
+            'non_physics_settings',
             'array_columns')}
 
         # Instantiate the blocks.
@@ -308,6 +338,13 @@ class BlockModelSource(fd.Source):
             "You changed a dimension's max_dim_size in more than one place (block). \
             Please fix this, then try again!"
 
+        # Annotation and simulation settings can be changed like any other
+        # model attribute
+        collected['model_attributes'] += [
+            'n_annotate_processes',
+            'n_simulate_processes',
+            'simulate_chunk_size']
+
         # The source may declare additional frozen data methods
         collected['frozen_model_functions'] += self.frozen_model_functions
 
@@ -492,7 +529,11 @@ class BlockModelSource(fd.Source):
         # All blocks after the first help to simulate the response
         d = self.data
         d['p_accepted'] = 1.   # Cut on p_accepted is made in Source.simulate
-        for b in self.model_blocks[1:]:
+        for i, b in enumerate(self.model_blocks[1:]):
+            # Give each block its own random stream, so a block whose
+            # draws depend on the parameters does not desynchronize the
+            # common random numbers of the blocks after it.
+            self._seed_simulation_stage(2 + i)
             b.simulate(d)
         return d
 
@@ -506,18 +547,20 @@ class BlockModelSource(fd.Source):
         bounds values from annotate() for (filter_dims) are used to filter the
         MC reservoir to obtain bounds on (prior_dims).
         """
+        # One prior per batch of the currently set data
+        self.prior_PDFs_LB = tuple(dict())
+        self.prior_PDFs_UB = tuple(dict())
+
         if self.mc_reservoir.empty:
             return
 
-        for set in self.prior_dimensions:
-            prior_dims = set[0]
-            filter_dims = set[1]
-
-            prior_data_columns, filter_data_columns = [], []
-            for dim in prior_dims:
-                prior_data_columns.append(self.mc_reservoir.columns.get_loc(dim))
-            for dim in filter_dims:
-                filter_data_columns.append(self.mc_reservoir.columns.get_loc(dim))
+        for (prior_dims, filter_dims), reservoir in zip(
+                self.prior_dimensions, self.prepare_priors()):
+            # Columns of reservoir: filter dimensions, then prior dimensions
+            filter_data_columns = list(range(len(filter_dims)))
+            prior_data_columns = list(range(len(filter_dims),
+                                            len(filter_dims) + len(prior_dims)))
+            sorted_column = reservoir[:, 0]
 
             for batch in range(self.n_batches):
                 df_batch = data[batch * self.batch_size:(batch + 1) * self.batch_size]
@@ -528,11 +571,114 @@ class BlockModelSource(fd.Source):
                 for dim in filter_dims:
                     filter_dims_max.append(max(df_batch[dim + '_max']))
 
-                fd.bounds.get_priors(self, self.mc_reservoir.values, prior_dims,
-                                     prior_data_columns, filter_data_columns,
-                                     filter_dims_min, filter_dims_max)
+                fd.bounds.get_priors(
+                    self, reservoir, prior_dims,
+                    prior_data_columns, filter_data_columns,
+                    filter_dims_min, filter_dims_max,
+                    i_min=np.searchsorted(sorted_column, filter_dims_min[0],
+                                          side='left'),
+                    i_max=np.searchsorted(sorted_column, filter_dims_max[0],
+                                          side='right'))
+
+    def prepare_priors(self):
+        """Return list with, for each entry of prior_dimensions, an array
+        of the MC reservoir columns of its filter and prior dimensions
+        (in that order), sorted on the first filter dimension.
+        Each batch then only has to scan the rows passing the filter on
+        that dimension.
+
+        The arrays are reused until mc_reservoir_key changes.
+        """
+        if self._prior_reservoirs is None \
+                or self._prior_reservoirs_key != self.mc_reservoir_key:
+            self._prior_reservoirs = []
+            for prior_dims, filter_dims in self.prior_dimensions:
+                order = np.argsort(
+                    self.mc_reservoir[filter_dims[0]].to_numpy(),
+                    kind='stable')
+                self._prior_reservoirs.append(
+                    self.mc_reservoir[list(filter_dims) + list(prior_dims)]
+                    .to_numpy()[order])
+            self._prior_reservoirs_key = self.mc_reservoir_key
+        return self._prior_reservoirs
 
     def _annotate(self, _skip_bounds_computation=False):
+        # Shared setup (e.g. MC reservoirs) happens here, in this process,
+        # so parallel and serial annotation use the same setup
+        for b in self.model_blocks[::-1]:
+            b.prepare_annotate()
+        if not self.mc_reservoir.empty:
+            self.prepare_priors()
+        n_processes = min(self.n_annotate_processes, self.n_batches or 1)
+        if n_processes > 1 and not mp.current_process().daemon:
+            self._annotate_parallel(n_processes)
+        else:
+            self._annotate_serial()
+
+    def _annotate_parallel(self, n_processes):
+        """Annotate self.data in n_processes chunks of whole batches,
+        so per-batch bounds and priors are the same as for serial annotation.
+        """
+        batch_edges = np.linspace(
+            0, self.n_batches, n_processes + 1).astype(int)
+        event_edges = batch_edges * self.batch_size
+        chunks = [self.data.iloc[start:stop]
+                  for start, stop in zip(event_edges[:-1], event_edges[1:])]
+
+        results = self._get_annotate_pool(n_processes).map(
+            _annotate_chunk, chunks)
+
+        index = self.data.index
+        self.data = pd.concat([r[0] for r in results], ignore_index=True)
+        self.data.index = index
+        self.prior_PDFs_LB = sum([r[1] for r in results], tuple())
+        self.prior_PDFs_UB = sum([r[2] for r in results], tuple())
+
+    def _get_annotate_pool(self, n_processes):
+        """Return a worker_pool of n_processes workers, whose payload is
+        this source without its data.
+
+        Starting workers and sending them the source (including the MC
+        reservoir) is expensive, so the pool is reused for later annotations
+        until the number of processes, the source settings or the MC
+        reservoir change.
+        """
+        key = (n_processes, self.batch_size,
+               self.max_sigma, self.bounds_prob_outer,
+               fd.deterministic_hash(self.settings_key()),
+               self.mc_reservoir_key)
+        if self._annotate_pool is None or self._annotate_pool_key != key:
+            self.close_annotate_pool()
+            # Workers get the data to annotate in chunks, not with the source
+            data = self.data
+            data_tensor = self.__dict__.pop('data_tensor', None)
+            self.data = None
+            try:
+                self._annotate_pool = fd.worker_pool(n_processes, payload=self)
+            finally:
+                self.data = data
+                if data_tensor is not None:
+                    self.data_tensor = data_tensor
+            self._annotate_pool_key = key
+            # Stop the workers cleanly if the pool is still open at exit
+            atexit.register(self._annotate_pool.terminate)
+        return self._annotate_pool
+
+    def close_annotate_pool(self):
+        """Stop the worker processes used for parallel annotation, if any"""
+        if self._annotate_pool is not None:
+            atexit.unregister(self._annotate_pool.terminate)
+            self._annotate_pool.terminate()
+        self._annotate_pool = self._annotate_pool_key = None
+
+    def __getstate__(self):
+        # Pools cannot be pickled
+        state = super().__getstate__()
+        state.pop('_annotate_pool', None)
+        state.pop('_annotate_pool_key', None)
+        return state
+
+    def _annotate_serial(self):
         d = self.data
         # By going in reverse order through the blocks, we can use the bounds
         # on hidden variables closer to the final signals (easy to compute)
@@ -587,3 +733,18 @@ class BlockModelSource(fd.Source):
 
 class BlockNotFoundError(Exception):
     pass
+
+
+def _annotate_chunk(data):
+    """Annotate a chunk of whole batches of data with the source that is
+    the worker payload. Runs in a worker process, so modifying the source
+    is harmless.
+
+    Returns (annotated data, lower bound priors, upper bound priors)
+    """
+    source = fd.worker_payload()
+    source.data = data.reset_index(drop=True)
+    source.n_events = len(source.data)
+    source.n_batches = int(np.ceil(source.n_events / source.batch_size))
+    source._annotate_serial()
+    return source.data, source.prior_PDFs_LB, source.prior_PDFs_UB
@@ -101,7 +101,8 @@ def bayes_bounds_priors(source, batch, df, in_dim, bounds_prob, bound, bound_typ
 
 def get_priors(source, reservoir, prior_dims,
                prior_data_cols, filter_data_cols,
-               filter_dims_min, filter_dims_max):
+               filter_dims_min, filter_dims_max,
+               i_min=0, i_max=None):
     """Obtain priors on certain hidden variable dimensions, to obtain more
     accurate Bayes bounds. Separate priors calculated for estimating upper and
     lower bounds.
@@ -115,16 +116,21 @@ def get_priors(source, reservoir, prior_dims,
     obtaining lower bound priors
     :param filter_dims_max: upper bounds of the dimensions we are filtering by, for
     obtaining upper bound priors
+    :param i_min: if the reservoir is sorted on its first filter column, the
+    index of the first row passing the lower bound filter on that column
+    :param i_max: if the reservoir is sorted on its first filter column, the
+    index of the first row failing the upper bound filter on that column
     """
     prior_dict = {}
 
-    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
-        prior_data_filter = [True] * len(reservoir[:, 0])
-
-        for filter_data_col, filter_dim_min in zip(filter_data_cols, filter_dims_min):
-            prior_data_filter = prior_data_filter * (reservoir[:, filter_data_col] >= filter_dim_min)
+    # Rows outside [i_min:] fail the lower bound filter, no need to scan them
+    reservoir_LB = reservoir[i_min:]
+    prior_data_filter = np.ones(len(reservoir_LB), dtype=bool)
+    for filter_data_col, filter_dim_min in zip(filter_data_cols, filter_dims_min):
+        prior_data_filter &= (reservoir_LB[:, filter_data_col] >= filter_dim_min)
 
-        prior_data = reservoir[:, prior_data_col][prior_data_filter]
+    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
+        prior_data = reservoir_LB[:, prior_data_col][prior_data_filter]
         prior_hist = np.histogram(prior_data)
         prior_pdf = stats.rv_histogram(prior_hist)
         prior_dict[prior_dim] = prior_pdf
@@ -133,13 +139,14 @@ def get_priors(source, reservoir, prior_dims,
 
     prior_dict = {}
 
-    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
-        prior_data_filter = [True] * len(reservoir[:, 0])
-
-        for filter_data_col, filter_dim_max in zip(filter_data_cols, filter_dims_max):
-            prior_data_filter = prior_data_filter * (reservoir[:, filter_data_col] <= filter_dim_max)
+    # Rows outside [:i_max] fail the upper bound filter
+    reservoir_UB = reservoir[:i_max]
+    prior_data_filter = np.ones(len(reservoir_UB), dtype=bool)
+    for filter_data_col, filter_dim_max in zip(filter_data_cols, filter_dims_max):
+        prior_data_filter &= (reservoir_UB[:, filter_data_col] <= filter_dim_max)
 
-        prior_data = reservoir[:, prior_data_col][prior_data_filter]
+    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
+        prior_data = reservoir_UB[:, prior_data_col][prior_data_filter]
         prior_hist = np.histogram(prior_data)
         prior_pdf = stats.rv_histogram(prior_hist)
         prior_dict[prior_dim] = prior_pdf
@@ -1,10 +1,21 @@
+from functools import partial
+import json
+import multiprocessing as mp
+import os
 import typing as ty
+
+import numpy as np
 import pandas as pd
 import pickle as pkl
+import tensorflow as tf
+from tqdm import tqdm
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
 
+#: Version of the on-disk reservoir format written by build_event_reservoir
+RESERVOIR_FILE_VERSION = 1
+
 
 def make_event_reservoir(ntoys: int = None,
                          input_prefix='',
@@ -125,6 +136,296 @@ def make_event_reservoir_no_compute(ntoys: int = None,
         pkl.dump(source.column_index, open(f'{output_prefix}{sname}_column_index{output_label}.pkl', 'wb'))
 
 
+@export
+def build_event_reservoir(directory,
+                          ntoys: int = None,
+                          max_rm_dict=None,
+                          chunk_size=int(1e4),
+                          n_processes=1,
+                          seed=None,
+                          progress=True,
+                          anchors=None,
+                          **sources):
+    """Build an annotated reservoir of events to be used in
+    FrozenReservoirSources in directory, and return it as fd.ColumnarData
+    with memory-mapped columns (see load_event_reservoir).
+
+    Unlike make_event_reservoir, this works in chunks:
+        - each source simulates its events in chunks of chunk_size events
+          (before efficiencies), each with its own random seed;
+        - the chunks are simulated in n_processes spawned worker processes;
+        - the differential rate under each source is computed separately
+          for each chunk;
+        - finished chunks are saved in directory. If the build fails or is
+          interrupted, calling build_event_reservoir again with the same
+          arguments resumes it;
+        - the finished reservoir is written column by column to one .npy
+          file per column, so it never has to fit in memory at once.
+
+    Arguments:
+        - directory: directory to build the reservoir in.
+        - ntoys, max_rm_dict, sources: as for make_event_reservoir.
+        - chunk_size: number of events each source simulates per chunk.
+        - n_processes: number of worker processes for simulation.
+            Workers receive the sources by pickling, so source classes must
+            be defined at module level. Differential rates are computed in
+            this process; set n_annotate_processes on the sources to
+            annotate the chunks in parallel.
+        - seed: integer seed for the simulation. If None, a seed is drawn
+            from the global numpy random state. When resuming, the seed of
+            the original build is used.
+        - progress: whether to show progress bars.
+        - anchors: dictionary {sourcename: {parameter: sequence of values},
+            ...}. For each source and parameter, the differential rate under
+            the source is also stored with the parameter set to each of the
+            anchor values (and other parameters at their defaults), in
+            columns '{sourcename}_diff_rate_{parameter}_{i}'. With these,
+            FrozenReservoirSources can reweight to other values of the
+            parameters.
+    """
+    assert len(sources) != 0, "Must pass at least one source instance to build_event_reservoir()"
+    if ntoys is None:
+        ntoys = 1000
+    if max_rm_dict is None:
+        max_rm_dict = dict()
+    if anchors is None:
+        anchors = dict()
+    for sname in anchors:
+        assert sname in sources, f"Anchors given for unknown source {sname}"
+    anchors = {sname: {pname: [float(x) for x in xs]
+                       for pname, xs in anchors.get(sname, dict()).items()}
+               for sname in sources}
+
+    os.makedirs(directory, exist_ok=True)
+
+    # Check we resume or load a build with the same settings
+    config = dict(
+        ntoys=ntoys,
+        chunk_size=int(chunk_size),
+        n_simulate={
+            sname: int(max_rm_dict.get(sname, 1.)
+                       * ntoys * source.mu_before_efficiencies())
+            for sname, source in sources.items()},
+        sources={
+            sname: [f'{source.__class__.__module__}.'
+                    f'{source.__class__.__qualname__}',
+                    fd.deterministic_hash(source.settings_key())]
+            for sname, source in sources.items()},
+        anchors=anchors)
+    config_fn = os.path.join(directory, 'build_config.json')
+    if os.path.exists(config_fn):
+        with open(config_fn) as f:
+            old_config = json.load(f)
+        seed = old_config.pop('seed')
+        if old_config != config:
+            raise ValueError(
+                f"{directory} contains a reservoir built with "
+                f"different settings: {old_config}")
+        if os.path.exists(os.path.join(directory, 'reservoir.json')):
+            return load_event_reservoir(directory)
+    else:
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        fd.save_atomically(
+            config_fn, lambda fn: _dump_json({**config, 'seed': seed}, fn))
+
+    # Simulate events, in chunks with independent seeds
+    sim_tasks = []
+    for i_source, (sname, n) in enumerate(config['n_simulate'].items()):
+        n_chunks = int(np.ceil(n / config['chunk_size']))
+        chunk_sizes = np.diff(np.linspace(0, n, n_chunks + 1).astype(int))
+        seeds = np.random.SeedSequence([seed, i_source]).spawn(n_chunks)
+        for i_chunk, (n_events, ss) in enumerate(zip(chunk_sizes, seeds)):
+            chunk_fn = os.path.join(directory,
+                                    f'events_{sname}_{i_chunk:05d}.pkl')
+            sim_tasks.append((chunk_fn, sname, int(n_events),
+                              int(ss.generate_state(1)[0])))
+    chunk_fns = [task[0] for task in sim_tasks]
+    _run_reservoir_tasks(
+        _simulate_reservoir_chunk,
+        [task for task in sim_tasks if not os.path.exists(task[0])],
+        sources, n_processes, progress, desc="Simulating reservoir")
+
+    # Compute differential rates of each chunk under each source
+    _run_reservoir_tasks(
+        _reservoir_chunk_diff_rate,
+        [(chunk_fn, sname, anchors[sname])
+         for chunk_fn in chunk_fns
+         for sname in sources
+         if not os.path.exists(_diff_rate_fn(chunk_fn, sname))],
+        sources, 1, progress,
+        desc="Computing reservoir differential rates")
+
+    _assemble_reservoir(directory, chunk_fns, anchors)
+    return load_event_reservoir(directory)
+
+
+@export
+def load_event_reservoir(directory, mmap=True):
+    """Return fd.ColumnarData with the reservoir in directory,
+    made by build_event_reservoir.
+
+    :param directory: directory the reservoir was built in
+    :param mmap: If True (default), memory-map the columns rather than
+        reading them into memory.
+    """
+    metadata = _load_reservoir_metadata(directory)
+    return fd.ColumnarData(
+        {column: np.load(os.path.join(directory, 'columns', f'{column}.npy'),
+                         mmap_mode='r' if mmap else None)
+         for column in metadata['columns']},
+        n_rows=metadata['n_events'])
+
+
+def _load_reservoir_metadata(directory):
+    with open(os.path.join(directory, 'reservoir.json')) as f:
+        metadata = json.load(f)
+    if metadata['file_version'] > RESERVOIR_FILE_VERSION:
+        raise ValueError(
+            f"Reservoir in {directory} has version "
+            f"{metadata['file_version']}, this flamedisx only reads "
+            f"versions up to {RESERVOIR_FILE_VERSION}")
+    return metadata
+
+
+def _diff_rate_columns(sname, anchors):
+    """Return names of the differential rate columns of source sname:
+    first the nominal one, then one per anchor of each parameter"""
+    return [f'{sname}_diff_rate'] + [
+        f'{sname}_diff_rate_{pname}_{i}'
+        for pname, xs in anchors.items()
+        for i in range(len(xs))]
+
+
+def _dump_json(x, fn):
+    with open(fn, mode='w') as f:
+        json.dump(x, f)
+
+
+def _diff_rate_fn(chunk_fn, sname):
+    return chunk_fn[:-len('.pkl')] + f'_{sname}_diff_rate.npy'
+
+
+def _run_reservoir_tasks(f, tasks, sources, n_processes, progress, desc):
+    """Call f(sources, task) on each of tasks,
+    in n_processes spawned worker processes"""
+    if not tasks:
+        return
+    if n_processes > 1 and not mp.current_process().daemon:
+        with fd.worker_pool(n_processes, payload=sources) as pool:
+            results = pool.imap_unordered(partial(_reservoir_worker, f), tasks)
+            if progress:
+                results = tqdm(results, desc=desc, total=len(tasks))
+            for _ in results:
+                pass
+    else:
+        for task in (tqdm(tasks, desc=desc) if progress else tasks):
+            f(sources, task)
+
+
+def _reservoir_worker(f, task):
+    return f(fd.worker_payload(), task)
+
+
+def _simulate_reservoir_chunk(sources, task):
+    chunk_fn, sname, n_events, seed = task
+    source = sources[sname]
+    with source.common_random_numbers(seed):
+        d = source.simulate(n_events)
+    d['source'] = sname
+    fd.save_atomically(chunk_fn, lambda fn: d.to_pickle(fn, compression=None))
+
+
+def _reservoir_chunk_diff_rate(sources, task):
+    chunk_fn, sname, anchors = task
+    source = sources[sname]
+    d = pd.read_pickle(chunk_fn, compression=None)
+    param_list = [dict()] + [{pname: x}
+                             for pname, xs in anchors.items()
+                             for x in xs]
+    if len(d):
+        source.set_data(d)
+        diff_rate = np.stack(
+            [source.batched_differential_rate(progress=False, **params)
+             for params in param_list],
+            axis=1)
+    else:
+        diff_rate = np.zeros((0, len(param_list)))
+
+    def save(fn):
+        with open(fn, 'wb') as f:
+            np.save(f, diff_rate)
+    fd.save_atomically(_diff_rate_fn(chunk_fn, sname), save)
+
+
+def _assemble_reservoir(directory, chunk_fns, anchors):
+    """Write the reservoir in chunk_fns to one .npy file per column
+    in directory/columns, and finally the reservoir.json metadata."""
+    # Find the columns, their dtypes, and the number of events
+    dtypes = dict()
+    n_events = 0
+    for chunk_fn in chunk_fns:
+        d = pd.read_pickle(chunk_fn, compression=None)
+        n_events += len(d)
+        for column in d.columns:
+            dtype = _column_values(d[column]).dtype
+            dtypes[column] = np.result_type(dtypes.get(column, dtype), dtype)
+    for column in dtypes:
+        if np.issubdtype(dtypes[column], np.number):
+            # Events from sources that do not simulate this column get NaN
+            dtypes[column] = np.result_type(dtypes[column], np.float64)
+    # Differential rate column -> (source name, index in diff rate files)
+    diff_rate_columns = dict()
+    for sname, source_anchors in anchors.items():
+        for i, column in enumerate(_diff_rate_columns(sname, source_anchors)):
+            dtypes[column] = np.dtype(np.float64)
+            diff_rate_columns[column] = (sname, i)
+
+    # Fill the columns chunk by chunk
+    os.makedirs(os.path.join(directory, 'columns'), exist_ok=True)
+    columns = {
+        column: np.lib.format.open_memmap(
+            os.path.join(directory, 'columns', f'{column}.npy'),
+            mode='w+', dtype=dtype, shape=(n_events,))
+        for column, dtype in dtypes.items()}
+    start = 0
+    for chunk_fn in chunk_fns:
+        d = pd.read_pickle(chunk_fn, compression=None)
+        stop = start + len(d)
+        diff_rates = {sname: np.load(_diff_rate_fn(chunk_fn, sname))
+                      for sname in anchors}
+        for column, values in columns.items():
+            if column in diff_rate_columns:
+                sname, i = diff_rate_columns[column]
+                values[start:stop] = diff_rates[sname][:, i]
+            elif column in d:
+                values[start:stop] = _column_values(d[column])
+            else:
+                values[start:stop] = np.nan
+        start = stop
+    for values in columns.values():
+        values.flush()
+    del columns
+
+    metadata = dict(file_version=RESERVOIR_FILE_VERSION,
+                    flamedisx_version=fd.__version__,
+                    columns=list(dtypes.keys()),
+                    n_events=n_events,
+                    anchors=anchors)
+    fd.save_atomically(
+        os.path.join(directory, 'reservoir.json'),
+        lambda fn: _dump_json(metadata, fn))
+
+
+def _column_values(column):
+    """Return numpy array with values of a DataFrame column,
+    with strings as a fixed-width (memory-mappable) string dtype"""
+    values = column.values
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
 @export
 class FrozenReservoirSource(fd.ColumnSource):
     """Source that looks up precomputed differential rates in a column source,
@@ -140,18 +441,47 @@ class FrozenReservoirSource(fd.ColumnSource):
             '{sorce_name}_diff_rate' with the differential rate of each event
             computed under all base sources that will have a FrozenReservoirSource used
             in the analysis.
+            Can also be the directory of a reservoir made by
+            build_event_reservoir, which is then opened memory-mapped.
         - input_mu: pass a pre-computed mu for the base source class.
+        - anchors: dictionary {parameter: sequence of values} of parameters
+            for which the reservoir has differential rates at anchor values
+            (see build_event_reservoir). Defaults to the anchors stored in
+            the reservoir directory, if any.
+
+    With anchors, the source has these parameters. The differential rate of
+    each event, and the expected number of events, are reweighted from the
+    nominal parameters by interpolating the event's differential rate
+    between the anchors, multiplying the relative changes along each
+    parameter. Simulations draw reservoir events with probability
+    proportional to these weights. This only works well for parameters that
+    change the event distribution modestly, so the reservoir still covers
+    it well, and with anchors close enough that each event's differential
+    rate is roughly linear between them.
 
     For other arguments, see flamedisx.source.Source
     """
 
+    # random_truth returns columns of reservoir rows, and simulation only
+    # passes these through.
+    columnar_simulation = True
+
     def __init__(self, source_type: fd.Source.__class__ = None, source_name: str = None,
                  source_kwargs: ty.Dict[str, ty.Union[int, float]] = None,
-                 reservoir: pd.DataFrame = None,
+                 reservoir: ty.Union[pd.DataFrame, str] = None,
                  input_mu=None,
-                 *args, **kwargs):
+                 *args,
+                 anchors=None,
+                 **kwargs):
         assert source_type is not None, "Must pass a source type to FrozenReservoirSource"
         assert source_name is not None, "Must pass a source name to FrozenReservoirSource"
+        if isinstance(reservoir, str):
+            if anchors is None:
+                anchors = _load_reservoir_metadata(
+                    reservoir)['anchors'].get(source_name, dict())
+            reservoir = load_event_reservoir(reservoir)
+        if anchors is None:
+            anchors = dict()
         assert source_name in reservoir['source'].values, "The reservoir must contain events from this source type"
 
         if source_kwargs is None:
@@ -159,8 +489,32 @@ class FrozenReservoirSource(fd.ColumnSource):
 
         self.source_name = source_name
         self.reservoir = reservoir
+        # Column arrays and indices of the rows from our source, so toys
+        # are drawn without scanning or copying the whole reservoir
+        self._reservoir_columns = {column: reservoir[column].values
+                                   for column in reservoir.columns}
+        self._reservoir_index = np.flatnonzero(
+            self._reservoir_columns['source'] == source_name)
         source = source_type(**source_kwargs)
 
+        # For each parameter: sorted values at which we know the
+        # differential rate, including the default, and the columns with
+        # the differential rates at these values.
+        self.param_defaults = {pname: float(source.defaults[pname])
+                               for pname in anchors}
+        self._anchor_grid = dict()
+        self._anchor_columns = dict()
+        nominal_column = f'{source_name}_diff_rate'
+        for pname, xs in anchors.items():
+            grid = list(xs) + [self.param_defaults[pname]]
+            columns = (_diff_rate_columns(source_name, {pname: xs})[1:]
+                       + [nominal_column])
+            grid, unique_index = np.unique(grid, return_index=True)
+            self._anchor_grid[pname] = grid
+            self._anchor_columns[pname] = [columns[i] for i in unique_index]
+        self._anchor_grid_tf = {pname: fd.np_to_tf(grid)
+                                for pname, grid in self._anchor_grid.items()}
+
         self.column = f'{source_name}_diff_rate'
         if input_mu is None:
             self.mu = source.estimate_mu()
@@ -169,10 +523,83 @@ class FrozenReservoirSource(fd.ColumnSource):
 
         super().__init__(*args, **kwargs)
 
+    def scan_model_functions(self):
+        super().scan_model_functions()
+        for pname, value in self.param_defaults.items():
+            self.defaults[pname] = tf.convert_to_tensor(
+                value, dtype=fd.float_type())
+
+    def extra_needed_columns(self):
+        return super().extra_needed_columns() + sorted(set(sum(
+            self._anchor_columns.values(), [])) - {self.column})
+
+    def _differential_rate(self, data_tensor, ptensor):
+        nominal = self._fetch(self.column, data_tensor)
+        result = nominal
+        for pname, columns in self._anchor_columns.items():
+            diff_rate = fd.tf_multilinear_interpolate(
+                [tf.reshape(self._fetch_param(pname, ptensor), (1,))],
+                [self._anchor_grid_tf[pname]],
+                tf.stack([self._fetch(column, data_tensor)
+                          for column in columns]))[0]
+            result *= tf.math.divide_no_nan(diff_rate, nominal)
+        return result
+
+    def reweight_factors(self, **params):
+        """Return numpy array with the ratio of the differential rate at
+        params to the nominal one, for each reservoir event from this source
+        """
+        params = self._check_params(params)
+        nominal = self._reservoir_columns[self.column][self._reservoir_index]
+        result = np.ones(len(self._reservoir_index))
+        for pname, x in params.items():
+            diff_rates = np.stack([
+                self._reservoir_columns[column][self._reservoir_index]
+                for column in self._anchor_columns[pname]])
+            diff_rate = fd.multilinear_interpolate(
+                [np.atleast_1d(x)], [self._anchor_grid[pname]], diff_rates)[0]
+            result *= np.divide(diff_rate, nominal,
+                                out=np.zeros_like(result),
+                                where=nominal != 0)
+        return result
+
+    def _check_params(self, params):
+        """Return dict of params that differ from the nominal ones,
+        as floats"""
+        result = dict()
+        for pname, x in params.items():
+            if pname not in self._anchor_grid:
+                raise NotImplementedError(
+                    f"FrozenReservoirSource has no anchors for {pname}, "
+                    "so it cannot simulate or reweight to other values")
+            x = float(x)
+            if x != self.param_defaults[pname]:
+                result[pname] = x
+        return result
+
+    def mu_before_efficiencies(self, **params):
+        return self.estimate_mu(**params)
+
+    def estimate_mu(self, n_trials=None, **params):
+        if not self._check_params(params):
+            return self.mu
+        return self.mu * np.mean(self.reweight_factors(**params))
+
     def random_truth(self, n_events, fix_truth=None, **params):
         if fix_truth is not None:
             raise NotImplementedError("FrozenReservoirSource does not yet support fix_truth")
-        if len(params):
-            raise NotImplementedError("FrozenReservoirSource does not yet support alternative parameters in simulate")
 
-        return self.reservoir[self.reservoir['source'] == self.source_name].sample(n_events, replace=True)
+        if self._check_params(params):
+            # Importance sampling: draw events proportional to their weight
+            cumulative_weights = np.cumsum(self.reweight_factors(**params))
+            rows = self._reservoir_index[np.searchsorted(
+                cumulative_weights,
+                np.random.rand(int(n_events)) * cumulative_weights[-1],
+                side='right')]
+        else:
+            rows = self._reservoir_index[
+                np.random.randint(len(self._reservoir_index), size=int(n_events))]
+        return fd.ColumnarData(
+            {column: values[rows]
+             for column, values in self._reservoir_columns.items()},
+            n_rows=n_events)
@@ -15,7 +15,12 @@ from scipy.optimize import NonlinearConstraint
 __all__ = ['LOWER_RATE_MULTIPLIER_BOUND',
            'SUPPORTED_OPTIMIZERS',
            'SUPPORTED_INTERVAL_OPTIMIZERS',
-           'FLOAT32_EPS']
+           'FLOAT32_EPS',
+           'OptimizerWarning',
+           'OptimizerFailure',
+           'NewtonMinimizeResult',
+           'damped_newton_step',
+           'batched_newton_minimize']
 
 # Setting this to 0 does work, but makes the inference rather slow
 # (at least for scipy); probably there is a relative xtol computation,
@@ -54,7 +59,9 @@ class Objective:
     :param bounds: {param: (left, right)} bounds, if any (otherwise None)
     :param nan_val: Value to pass to optimizer if likelihood evaluates to NaN
     :param get_lowlevel_result: Return low-level result from optimizer directly
-    :param use_hessian: If supported, use Hessian to improve error estimate
+    :param use_hessian: If supported, use Hessian to improve error estimate.
+    Pass 'hvp' to give the optimizer only Hessian-vector products, so the
+    full Hessian is never computed (supported by ScipyObjective).
     :param return_errors: If supported, return error estimates on parameters
     """
     memoize = True                  # Cache values during minimization.
@@ -90,7 +97,9 @@ class Objective:
         self.nan_val = nan_val
         self.get_lowlevel_result = get_lowlevel_result
         self.return_history = get_history
-        self.use_hessian = use_hessian
+        # Hessian-vector products replace, rather than add to, the Hessian
+        self.use_hvp = isinstance(use_hessian, str) and use_hessian == 'hvp'
+        self.use_hessian = use_hessian and not self.use_hvp
         self.return_errors = return_errors
         self.optimizer_kwargs = optimizer_kwargs
         self.allow_failure = allow_failure
@@ -353,6 +362,17 @@ class Objective:
         """Return only Hessian"""
         return self(x).hess
 
+    def hessp(self, x_norm, p):
+        """Return product of the Hessian with p, in normalized coordinates"""
+        params = {**self._array_to_dict(self.restore_scale(x_norm)),
+                  **self.fix}
+        # Hessian in normalized coordinates is H * outer(scale, scale)
+        hvp = self.lf.minus2_ll(
+            **params,
+            omit_grads=tuple(self.fix.keys()),
+            hvp_vector=self.normalize(p, 'gradient'))[2]
+        return self.normalize(hvp, 'gradient')
+
     def _lowlevel_shortcut(self, res):
         if self.get_lowlevel_result:
             return True, res
@@ -382,7 +402,7 @@ class Objective:
 
         # Compare the result against the guess
         for k, v in result.items():
-            if k in self.fix:
+            if k not in self.arg_names:
                 continue
             if self.guess[k] == v:
                 if self.suppress_warnings is False:
@@ -419,7 +439,7 @@ class ScipyObjective(Objective):
 
         kwargs: ty.Dict[str, ty.Any] = self._scipy_minizer_options()
 
-        if self.use_hessian:
+        if self.use_hessian or self.use_hvp:
             # Of all scipy-optimize methods, only trust-constr takes
             # both a Hessian and bounds argument.
             kwargs.setdefault('method', 'trust-constr')
@@ -436,7 +456,18 @@ class ScipyObjective(Objective):
         kwargs['options'].setdefault('xtol', FLOAT32_EPS**0.5)
         kwargs['options'].setdefault('gtol', 1e-2 * FLOAT32_EPS**0.25)
 
-        if self.use_hessian:
+        if self.use_hvp:
+            if kwargs['method'].lower() in ('newton-cg', 'trust-ncg',
+                                            'trust-krylov', 'trust-constr'):
+                kwargs['hessp'] = self.hessp
+            else:
+                warnings.warn(
+                    "You passed use_hessian = 'hvp', but scipy optimizer "
+                    f"method {kwargs['method']} does not support passing "
+                    "Hessian-vector products. Hessian information will not "
+                    "be used.",
+                    UserWarning)
+        elif self.use_hessian:
             if (kwargs['method'].lower() in ('newton-cg', 'dogleg')
                     or kwargs['method'].startswith('trust')):
                 kwargs['hess'] = self.hess
@@ -595,9 +626,199 @@ class MinuitObjective(Objective):
         return position, result.fval
 
 
+class NewtonObjective(Objective):
+    """Minimize with damped Newton steps using flamedisx's exact Hessian.
+    The entire minimization, including the loop over batches and the
+    parameter normalization, is compiled into a single tensorflow function.
+
+    optimizer_kwargs can set max_iterations, f_tolerance, x_tolerance and
+    initial_damping, see batched_newton_minimize.
+
+    Errors are estimated from the Hessian at the minimum.
+    """
+    memoize = False
+
+    def _minimize(self):
+        if not self.use_hessian:
+            warnings.warn(
+                "You set use_hessian = False, but the Newton minimizer "
+                "always uses the Hessian",
+                UserWarning)
+
+        kwargs = dict(max_iterations=100,
+                      f_tolerance=1e-5,
+                      x_tolerance=FLOAT32_EPS,
+                      initial_damping=1e-3)
+        kwargs.update(self.optimizer_kwargs)
+
+        lower, upper = np.array([
+            self.normed_bounds.get(k, (None, None))
+            for k in self.arg_names], dtype=float).reshape(-1, 2).T
+        # None bounds became NaN
+        lower[np.isnan(lower)] = -np.inf
+        upper[np.isnan(upper)] = np.inf
+
+        def to_tensor(x):
+            return tf.constant(x, dtype=tf.float64)
+
+        # Pass all numbers as tensors, so the minimizer is traced only
+        # once for each set of free parameters
+        return self.lf._minimize_newton(
+            arg_names=tuple(self.arg_names),
+            fix=fd.values_to_constants(dict(self.fix)),
+            data_tensors=self.lf.data_tensors,
+            batch_info=self.lf.batch_info,
+            constraint_extra_args=self.lf.constraint_extra_args,
+            x0=to_tensor(self._dict_to_array(self.normalize(self.guess))),
+            scale=to_tensor(self.scale_vector),
+            offset=to_tensor(self.offset_vector),
+            lower=to_tensor(lower),
+            upper=to_tensor(upper),
+            max_iterations=tf.constant(kwargs['max_iterations']),
+            **{k: to_tensor(kwargs[k])
+               for k in ('f_tolerance', 'x_tolerance', 'initial_damping')})
+
+    def parse_result(self, result):
+        result, hess = result
+        result = NewtonMinimizeResult(*[x.numpy() for x in result])
+        if not result.converged:
+            self.fail(f"Newton optimizer failed to converge "
+                      f"in {result.n_iterations} iterations")
+        position = self._array_to_dict(self.restore_scale(result.position))
+        if self.return_errors:
+            # Covariance of the parameters is the inverse of the Hessian
+            # of -log likelihood, i.e. half that of our objective
+            cov = (2 * np.linalg.inv(hess.numpy())
+                   * np.outer(self.scale_vector, self.scale_vector))
+            position.update({
+                'error_' + k: v
+                for k, v in zip(self.arg_names, np.diag(cov) ** 0.5)})
+        return position, result.objective_value
+
+
 SUPPORTED_OPTIMIZERS = dict(tfp=TensorFlowObjective,
                             minuit=MinuitObjective,
-                            scipy=ScipyObjective)
+                            scipy=ScipyObjective,
+                            newton=NewtonObjective)
+
+
+##
+# Batched minimization
+##
+
+class NewtonMinimizeResult(ty.NamedTuple):
+    position: np.ndarray         # (n_problems, n_params)
+    objective_value: np.ndarray  # (n_problems,)
+    converged: np.ndarray        # (n_problems,) bool
+    n_iterations: np.ndarray     # (n_problems,) int
+
+
+def damped_newton_step(x, g, h, damping, lower, upper):
+    """Return (new position, predicted decrease, relative step size)
+    of a damped Newton step for a batch of problems, projected onto bounds.
+
+    Solves (H + damping * D) p = -g, with D the absolute diagonal of the
+    Hessian H, so the steps do not depend on the scale of the parameters.
+    Parameters at a bound whose gradient points out of the bounds are
+    held fixed.
+    """
+    held = ((x <= lower) & (g > 0)) | ((x >= upper) & (g < 0))
+    free = tf.cast(~held, x.dtype)
+    g_free = g * free
+    diag = tf.maximum(tf.abs(tf.linalg.diag_part(h)),
+                      tf.constant(1e-12, x.dtype))
+    system = (h * free[:, :, None] * free[:, None, :]
+              + tf.linalg.diag(damping[:, None] * diag * free + (1 - free)))
+    step = -tf.linalg.solve(system, g_free[:, :, None])[:, :, 0]
+    predicted_decrease = -(
+        tf.reduce_sum(g_free * step, axis=1)
+        + 0.5 * tf.einsum('bi,bij,bj->b', step, h, step))
+    x_new = tf.clip_by_value(x + step, lower, upper)
+    relative_step = tf.reduce_max(
+        tf.abs(x_new - x) / (tf.abs(x) + 1), axis=1)
+    return x_new, predicted_decrease, relative_step
+
+
+def batched_newton_minimize(fun, x0, lower=None, upper=None,
+                            max_iterations=100,
+                            f_tolerance=1e-5,
+                            x_tolerance=FLOAT32_EPS,
+                            initial_damping=1e-3):
+    """Minimize many independent functions of a few parameters at once,
+    with damped Newton (Levenberg-Marquardt) steps projected onto bounds.
+
+    Steps that decrease the objective are accepted and decrease the damping;
+    others are rejected and increase it. The linear algebra is done for all
+    problems at once in tensorflow; only problems that have not yet
+    converged are evaluated.
+
+    :param fun: function (x, indices) -> (values, gradients, Hessians) of the
+        problems with the given indices, with x a (len(indices), n_params)
+        array of their parameters.
+    :param x0: (n_problems, n_params) array of starting positions
+    :param lower: lower bounds, broadcastable to x0 (-inf for no bound)
+    :param upper: upper bounds, broadcastable to x0 (inf for no bound)
+    :param max_iterations: maximum number of iterations
+    :param f_tolerance: problems converge when the decrease of the objective
+        predicted by the quadratic model is below this
+    :param x_tolerance: problems also converge when the relative step size
+        falls below this
+    :param initial_damping: initial damping factor
+    """
+    float_type = tf.float64
+    x = tf.convert_to_tensor(x0, dtype=float_type)
+    n_problems, n_params = x.shape
+    lower = tf.broadcast_to(tf.convert_to_tensor(
+        -np.inf if lower is None else lower, dtype=float_type), x.shape)
+    upper = tf.broadcast_to(tf.convert_to_tensor(
+        np.inf if upper is None else upper, dtype=float_type), x.shape)
+    x = tf.clip_by_value(x, lower, upper)
+
+    def evaluate(x, indices):
+        return [tf.convert_to_tensor(y, dtype=float_type)
+                for y in fun(x.numpy(), indices)]
+
+    f, g, h = evaluate(x, np.arange(n_problems))
+    damping = tf.fill((n_problems,), tf.constant(initial_damping, float_type))
+    active = np.ones(n_problems, dtype=bool)
+    converged = np.zeros(n_problems, dtype=bool)
+    n_iterations = np.zeros(n_problems, dtype=int)
+
+    for _ in range(max_iterations):
+        indices = np.flatnonzero(active)
+        if not len(indices):
+            break
+        n_iterations[indices] += 1
+        xs, fs, gs, hs, ds, lo, up = [
+            tf.gather(t, indices)
+            for t in (x, f, g, h, damping, lower, upper)]
+
+        x_new, predicted_decrease, relative_step = damped_newton_step(
+            xs, gs, hs, ds, lo, up)
+        f_new, g_new, h_new = evaluate(x_new, indices)
+        accept = (f_new < fs) & tf.math.is_finite(f_new)
+
+        # Update the problems we just stepped
+        def update(t, t_new):
+            mask = tf.reshape(accept, [-1] + [1] * (len(t.shape) - 1))
+            return tf.tensor_scatter_nd_update(
+                t, indices[:, None], tf.where(mask, t_new, tf.gather(t, indices)))
+        x, f, g, h = [update(t, t_new) for t, t_new in
+                      ((x, x_new), (f, f_new), (g, g_new), (h, h_new))]
+        damping = tf.tensor_scatter_nd_update(
+            damping, indices[:, None],
+            tf.where(accept, ds / 3, tf.maximum(ds * 4, 1e-4)))
+
+        done = (((predicted_decrease >= 0) & (predicted_decrease < f_tolerance))
+                | (relative_step < x_tolerance)).numpy()
+        converged[indices[done]] = True
+        active[indices[done]] = False
+
+    return NewtonMinimizeResult(
+        position=x.numpy(),
+        objective_value=f.numpy(),
+        converged=converged,
+        n_iterations=n_iterations)
 
 
 ##
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from copy import deepcopy
 import warnings
 
@@ -319,7 +320,42 @@ class LogLikelihood:
                     break
 
         self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
+        self._build_data_tensors()
+
+    def append_data(self,
+                    data: ty.Union[pd.DataFrame, ty.Dict[str, pd.DataFrame]]):
+        """Add events to the data of sources in the likelihood.
+        Data is passed in the same format as for set_data. Only the new
+        events (and those in the last, incomplete batch of the current data)
+        are annotated; rate multiplier guesses are not updated.
+        """
+        if isinstance(data, pd.DataFrame):
+            assert len(self.dsetnames) == 1, \
+                "You passed one DataFrame but there are multiple datasets"
+            data = {DEFAULT_DSETNAME: data}
+
+        if getattr(self, 'batch_info', None) is None:
+            # No data set yet
+            return self.set_data(data)
+        batch_info = self.batch_info.numpy()
+
+        for sname, source in self.sources.items():
+            dname = self.dset_for_source[sname]
+            if dname not in data or data[dname] is None:
+                continue
+
+            # Copy ensures annotations don't clobber
+            source.append_data(deepcopy(data[dname]))
+
+            # Update batch info
+            dset_index = self.dsetnames.index(dname)
+            batch_info[dset_index, :] = [
+                source.n_batches, source.batch_size, source.n_padding]
 
+        self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
+        self._build_data_tensors()
+
+    def _build_data_tensors(self):
         # Build a big data tensor for each dataset.
         # Each source has an [n_batches, batch_size, n_columns] tensor.
         # Since the number of columns are different, we must concat along
@@ -340,6 +376,30 @@ class LogLikelihood:
                 np.concatenate([[0], stop_idx[:-1]]),
                 stop_idx])
 
+    @contextmanager
+    def _set_data_temporarily(self, data):
+        """Set data temporarily. Afterwards, restore the current data,
+        data tensors and rate multiplier guesses of the likelihood
+        and its sources."""
+        old_defaults = dict(self.param_defaults)
+        old_state = {
+            k: self.__dict__.get(k)
+            for k in ('batch_info', 'data_tensors', 'column_indices')}
+        old_source_states = {
+            sname: {k: getattr(source, k, None)
+                    for k in source._data_attributes}
+            for sname, source in self.sources.items()}
+        try:
+            self.set_data(data)
+            yield
+        finally:
+            self.param_defaults = old_defaults
+            for k, v in old_state.items():
+                setattr(self, k, v)
+            for sname, source_state in old_source_states.items():
+                for k, v in source_state.items():
+                    setattr(self.sources[sname], k, v)
+
     def simulate(self, fix_truth=None, **params):
         """Simulate events from sources.
         """
@@ -377,12 +437,23 @@ class LogLikelihood:
         return self.log_likelihood(second_order=False, **kwargs)[0]
 
     def log_likelihood(self, second_order=False,
-                       omit_grads=tuple(), **kwargs):
+                       omit_grads=tuple(), hvp_vector=None, **kwargs):
+        """Return (log likelihood, gradient, Hessian or None)
+
+        :param second_order: If True, compute the Hessian
+        :param omit_grads: Parameters to omit from the gradient and Hessian
+        :param hvp_vector: If given, return the product of the Hessian with
+            this vector (over the parameters not in omit_grads) instead of
+            the Hessian. This avoids computing the full Hessian.
+        """
         params = self.prepare_params(kwargs)
+        if hvp_vector is not None:
+            hvp_vector = tf.constant(hvp_vector, dtype=fd.float_type())
         n_grads = len(self.param_defaults) - len(omit_grads)
         ll = 0.
         llgrad = np.zeros(n_grads, dtype=np.float64)
         llgrad2 = np.zeros((n_grads, n_grads), dtype=np.float64)
+        llhvp = np.zeros(n_grads, dtype=np.float64)
 
         for dsetname in self.dsetnames:
             # Getting this from the batch_info tensor is much slower
@@ -410,6 +481,7 @@ class LogLikelihood:
                     second_order=second_order,
                     empty_batch=empty_batch,
                     constraint_extra_args=self.constraint_extra_args,
+                    hvp_vector=hvp_vector,
                     **params)
                 ll += results[0].numpy().astype(np.float64)
 
@@ -417,9 +489,13 @@ class LogLikelihood:
                     if results[1] is None:
                         raise ValueError("TensorFlow returned None as gradient!")
                     llgrad += results[1].numpy().astype(np.float64)
-                    if second_order:
+                    if hvp_vector is not None:
+                        llhvp += results[2].numpy().astype(np.float64)
+                    elif second_order:
                         llgrad2 += results[2].numpy().astype(np.float64)
 
+        if hvp_vector is not None:
+            return ll, llgrad, llhvp
         if second_order:
             return ll, llgrad, llgrad2
         return ll, llgrad, None
@@ -490,6 +566,7 @@ class LogLikelihood:
                         i_batch, dsetname, data_tensor, batch_info,
                         omit_grads=tuple(), second_order=False,
                         empty_batch=False, constraint_extra_args=None,
+                        hvp_vector=None,
                         **params):
         # Stack the params to create a single node
         # to differentiate with respect to.
@@ -526,10 +603,31 @@ class LogLikelihood:
                 kwargs = {**params_unstacked, **constraint_extra_args}
                 ll += self.log_constraint(**kwargs)
 
+        if hvp_vector is not None:
+            # Derivative of the gradient along hvp_vector: the Hessian-vector
+            # product, at the cost of about one extra pass instead of one per
+            # parameter. This is reverse-over-reverse, since forward-mode
+            # differentiation ignores custom gradients (like QuadratureMu's)
+            # in traced functions.
+            grad = tf.gradients(ll, grad_par_stack,
+                                unconnected_gradients='zero')[0]
+            hvp = tf.gradients(grad, grad_par_stack, grad_ys=hvp_vector,
+                               unconnected_gradients='zero')[0]
+            return ll, grad, hvp
+
         # Autodifferentiation. This is why we use tensorflow:
         grad = tf.gradients(ll, grad_par_stack)[0]
         if second_order:
-            return ll, grad, tf.hessians(ll, grad_par_stack)[0]
+            if empty_batch:
+                # tf.hessians fails if the gradient is constant, as it is
+                # without data if only rate multipliers are free
+                hess = tf.stack([
+                    tf.gradients(g, grad_par_stack,
+                                 unconnected_gradients='zero')[0]
+                    for g in tf.unstack(grad)])
+            else:
+                hess = tf.hessians(ll, grad_par_stack)[0]
+            return ll, grad, hess
         return ll, grad, None
 
     def _log_likelihood_inner(self, i_batch, params,
@@ -597,14 +695,16 @@ class LogLikelihood:
             Any omitted parameters will be guessed at LogLikelihood.defaults()
         :param fix: dict {param: value} of parameters to keep fixed
             during the minimzation.
-        :param optimizer: 'tf', 'minuit' or 'scipy'
+        :param optimizer: 'tfp', 'minuit', 'scipy' or 'newton'
         :param get_lowlevel_result: Returns the full optimizer result instead
             of the best fit parameters. Bool.
         :param get_history: Returns the history of optimizer calls instead
             of the best fit parameters. Bool.
         :param use_hessian: If True, uses flamedisxs' exact Hessian
             in the optimizer. Otherwise, most optimizers estimate it by finite-
-            difference calculations.
+            difference calculations. If 'hvp', the scipy optimizer gets
+            only exact Hessian-vector products, which are much cheaper than
+            the full Hessian for many parameters.
         :param return_errors: If using the minuit minimizer, instead return
             a 2-tuple of (bestfit dict, error dict).
             If the optimizer is minuit, you can also pass 'hesse' or 'minos'.
@@ -619,8 +719,10 @@ class LogLikelihood:
             raise ValueError("Must specify bestfit guess as a dictionary")
 
         # Check the likelihood has a finite value and gradient before starting
+        full_hessian = use_hessian and not (
+            isinstance(use_hessian, str) and use_hessian == 'hvp')
         val, grad, hess = self.log_likelihood(**guess,
-                                              second_order=use_hessian)
+                                              second_order=full_hessian)
         if not np.isfinite(val):
             raise ValueError("The likelihood is - infinity at your guess, "
                              "please guess better, remove outlier events, or "
@@ -629,7 +731,7 @@ class LogLikelihood:
             raise ValueError("The likelihood is finite at your guess, "
                              "but the gradient is not. Are you starting at a "
                              "cusp?")
-        if use_hessian:
+        if full_hessian:
             if hess is None:
                 raise RuntimeError("Likelihood did't provide Hessian!")
             if not np.all(np.isfinite(hess)):
@@ -668,6 +770,312 @@ class LogLikelihood:
 
         return result
 
+    def batched_bestfit(self,
+                        datasets,
+                        guess=None,
+                        fix=None,
+                        bounds=None,
+                        constraint_extra_args=None,
+                        allow_failure=False,
+                        **kwargs):
+        """Return list of best-fit parameter dicts, one for each of many
+        independent datasets, fitted simultaneously with
+        fd.batched_newton_minimize.
+
+        The datasets are padded to whole batches, stacked, and annotated in
+        a single set_data call. The likelihood's data is restored afterwards.
+        Only likelihoods with a single dataset are supported.
+
+        :param datasets: iterable of DataFrames, e.g. fd.ToyDatasets
+        :param guess: dict {param: guess} of guesses to use for all datasets.
+            Free rate multipliers that are not guessed are scaled to match
+            the number of events in each dataset.
+        :param fix: dict {param: value} of parameters to keep fixed
+            during the minimzation.
+        :param bounds: dict {param: (min, max)}, overriding default bounds
+        :param constraint_extra_args: list of dicts of extra constraint
+            arguments, one for each dataset. If omitted, uses those set with
+            set_constraint_extra_args for all datasets.
+        :param allow_failure: If True, raise a warning instead of an exception
+            if any of the fits did not converge.
+        :param kwargs: passed to fd.batched_newton_minimize
+        """
+        assert len(self.dsetnames) == 1, \
+            "batched_bestfit only supports likelihoods with a single dataset"
+        dsetname = self.dsetnames[0]
+        datasets = list(datasets)
+        n_datasets = len(datasets)
+        if guess is None:
+            guess = dict()
+        if fix is None:
+            fix = dict()
+        bounds = {**self.default_bounds,
+                  **(dict() if bounds is None else bounds)}
+        if constraint_extra_args is None:
+            constraint_extra_args = [self.constraint_extra_args] * n_datasets
+        else:
+            assert len(constraint_extra_args) == n_datasets, \
+                "Need constraint_extra_args for each dataset"
+            constraint_extra_args = [
+                fd.values_to_constants(dict(c))
+                for c in constraint_extra_args]
+
+        if all(c is None for c in constraint_extra_args):
+            constraint_extra_args = None
+        else:
+            # Stack the arguments of all datasets, so the objective can
+            # gather those of each batch's dataset
+            constraint_extra_args = {
+                k: tf.stack([c[k] for c in constraint_extra_args])
+                for k in constraint_extra_args[0]}
+
+        # Pad each dataset to whole batches, as Source.set_data does,
+        # so no batch contains events from two datasets
+        batch_size = self.sources[self.sources_in_dset[dsetname][0]].batch_size
+        n_events = np.array([len(d) for d in datasets])
+        n_batches = np.ceil(n_events / batch_size).astype(int)
+        n_padding = n_batches * batch_size - n_events
+        padded = [pd.concat([d, d.iloc[np.zeros(n_pad, dtype=int)]],
+                            ignore_index=True)
+                  for d, n_pad in zip(datasets, n_padding)]
+        batch_info = tf.constant(
+            [[[n_b, batch_size, n_pad]]
+             for n_b, n_pad in zip(n_batches, n_padding)],
+            dtype=fd.int_type())
+        # Dataset and index within the dataset of each batch
+        batch_dataset = tf.constant(
+            np.repeat(np.arange(n_datasets), n_batches), dtype=fd.int_type())
+        batch_index = tf.constant(
+            np.concatenate([np.arange(n, dtype=int) for n in n_batches]),
+            dtype=fd.int_type())
+        empty_datasets = tf.constant(
+            np.flatnonzero(n_batches == 0), dtype=fd.int_type())
+
+        # Starting positions and bounds of the free parameters
+        param_names = [p for p in self.param_names if p not in fix]
+        start = {**self.guess(), **guess, **fix}
+        mus = {sname: self.mu(source_name=sname, **start).numpy()
+               for sname in self.sources}
+        free_rates = [sname for sname in self.sources
+                      if sname + '_rate_multiplier' in param_names
+                      and sname + '_rate_multiplier' not in guess]
+        mu_free = sum([mus[sname] for sname in free_rates])
+        mu_other = sum(mus.values()) - mu_free
+        x0 = np.array([[start[p] for p in param_names]] * n_datasets,
+                      dtype=np.float64)
+        if free_rates and mu_free > 0:
+            scale = np.maximum(n_events - mu_other, 1) / mu_free
+            for sname in free_rates:
+                x0[:, param_names.index(sname + '_rate_multiplier')] *= scale
+        lower, upper = np.zeros((2, len(param_names)))
+        for i, p in enumerate(param_names):
+            lo, up = bounds.get(p, (None, None))
+            if p.endswith('_rate_multiplier') and p not in bounds:
+                lo = fd.LOWER_RATE_MULTIPLIER_BOUND
+            lower[i] = -np.inf if lo is None else lo
+            upper[i] = np.inf if up is None else up
+
+        fixed_params = self.prepare_params(fix)
+
+        def objective(x, indices):
+            # Evaluate all active datasets in one call. Inputs have the same
+            # shape in every iteration, so this is traced only once.
+            x_all = np.zeros((n_datasets, len(param_names)))
+            x_all[indices] = x
+            active = np.zeros(n_datasets, dtype=bool)
+            active[indices] = True
+            results = self._batched_log_likelihood(
+                dsetname=dsetname,
+                param_names=tuple(param_names),
+                fixed_params=fixed_params,
+                x=tf.constant(x_all, dtype=fd.float_type()),
+                active=tf.constant(active),
+                data_tensor=self.data_tensors[dsetname],
+                batch_info=batch_info,
+                batch_dataset=batch_dataset,
+                batch_index=batch_index,
+                empty_datasets=empty_datasets,
+                constraint_extra_args=constraint_extra_args)
+            return tuple(-2 * r.numpy()[indices] for r in results)
+
+        with self._set_data_temporarily(pd.concat(padded, ignore_index=True)):
+            res = fd.batched_newton_minimize(
+                objective, x0, lower=lower, upper=upper, **kwargs)
+
+        if not np.all(res.converged):
+            msg = (f"Batched optimizer did not converge for "
+                   f"{np.sum(~res.converged)} of {n_datasets} datasets")
+            if allow_failure:
+                warnings.warn(msg, fd.OptimizerWarning)
+            else:
+                raise fd.OptimizerFailure(msg)
+        return [{**dict(zip(param_names, x)), **fix}
+                for x in res.position]
+
+    @tf.function
+    def _minimize_newton(self, arg_names, fix,
+                         data_tensors, batch_info, constraint_extra_args,
+                         x0, scale, offset, lower, upper,
+                         max_iterations, f_tolerance, x_tolerance,
+                         initial_damping):
+        """Return (NewtonMinimizeResult, Hessian), in normalized coordinates,
+        of minimizing -2 log likelihood over arg_names, for
+        fd.NewtonObjective. Positions are normalized as
+        (physical - offset) / scale.
+
+        This is traced once for each set of free and fixed parameters;
+        all numbers should be passed as tensors.
+        """
+        n_params = len(arg_names)
+        omit_grads = tuple(fix.keys())
+        float_type = tf.float64
+
+        def objective(x_norm):
+            x = tf.cast(x_norm * scale + offset, fd.float_type())
+            params = {**fix, **dict(zip(arg_names, tf.unstack(x)))}
+            ll = tf.constant(0., dtype=float_type)
+            llgrad = tf.zeros(n_params, dtype=float_type)
+            llgrad2 = tf.zeros((n_params, n_params), dtype=float_type)
+
+            for dsetname in self.dsetnames:
+                n_batches = int(
+                    self.sources[self.sources_in_dset[dsetname][0]].n_batches)
+                # Dummy batch without data for the mu and constraint terms
+                empty_batch = n_batches == 0
+                for i_batch in tf.range(max(n_batches, 1), dtype=fd.int_type()):
+                    results = self._log_likelihood(
+                        i_batch,
+                        dsetname=dsetname,
+                        data_tensor=(None if empty_batch
+                                     else data_tensors[dsetname][i_batch]),
+                        batch_info=batch_info,
+                        omit_grads=omit_grads,
+                        second_order=True,
+                        empty_batch=empty_batch,
+                        constraint_extra_args=constraint_extra_args,
+                        **params)
+                    ll += tf.cast(results[0], float_type)
+                    llgrad += tf.cast(results[1], float_type)
+                    llgrad2 += tf.cast(results[2], float_type)
+
+            # Gradient and Hessian in normalized coordinates
+            return (-2 * ll,
+                    -2 * llgrad * scale,
+                    -2 * llgrad2 * scale[:, None] * scale[None, :])
+
+        def step(i, x, f, g, h, damping, converged):
+            x_new, predicted_decrease, relative_step = [
+                y[0] for y in fd.damped_newton_step(
+                    x[None], g[None], h[None], damping[None],
+                    lower[None], upper[None])]
+            f_new, g_new, h_new = objective(x_new)
+            accept = (f_new < f) & tf.math.is_finite(f_new)
+            converged = (
+                ((predicted_decrease >= 0) & (predicted_decrease < f_tolerance))
+                | (relative_step < x_tolerance))
+            return (
+                i + 1,
+                tf.where(accept, x_new, x),
+                tf.where(accept, f_new, f),
+                tf.where(accept, g_new, g),
+                tf.where(accept, h_new, h),
+                tf.where(accept, damping / 3, tf.maximum(damping * 4, 1e-4)),
+                converged)
+
+        x0 = tf.clip_by_value(x0, lower, upper)
+        f0, g0, h0 = objective(x0)
+        i, x, f, _, h, _, converged = tf.while_loop(
+            lambda i, *args: (i < max_iterations) & ~args[-1],
+            step,
+            (tf.constant(0), x0, f0, g0, h0,
+             initial_damping,
+             tf.constant(False)))
+        return fd.NewtonMinimizeResult(
+            position=x,
+            objective_value=f,
+            converged=converged,
+            n_iterations=i), h
+
+    @tf.function
+    def _batched_log_likelihood(self, dsetname, param_names, fixed_params,
+                                x, active, data_tensor, batch_info,
+                                batch_dataset, batch_index, empty_datasets,
+                                constraint_extra_args=None):
+        """Return (ll, gradient, hessian) of many independent datasets,
+        each with an extra leading axis, for batched_bestfit.
+
+        Rows of inactive datasets are zero.
+
+        :param x: [n_datasets, n_free] tensor of values of param_names
+        :param active: [n_datasets] boolean mask of datasets to evaluate
+        :param data_tensor: [n_batches, batch_size, n_columns] data tensor
+            of all batches of all datasets
+        :param batch_info: [n_datasets, 1, 3] tensor with the batch info
+            (n_batches, batch_size, n_padding) of each dataset
+        :param batch_dataset: [n_batches] dataset index of each batch
+        :param batch_index: [n_batches] index of each batch in its dataset
+        :param empty_datasets: indices of datasets without events
+        :param constraint_extra_args: dict of extra constraint arguments,
+            with a leading axis over datasets, or None
+        """
+        n_datasets, n_free = x.shape
+        float_type = tf.float64
+        omit_grads = tuple(k for k in self.param_names
+                           if k not in param_names)
+        ll = tf.zeros(n_datasets, dtype=float_type)
+        llgrad = tf.zeros((n_datasets, n_free), dtype=float_type)
+        llgrad2 = tf.zeros((n_datasets, n_free, n_free), dtype=float_type)
+
+        def add_batch(i_dset, i_batch, batch_data_tensor, empty_batch,
+                      ll, llgrad, llgrad2):
+            params = {**fixed_params,
+                      **dict(zip(param_names, tf.unstack(x[i_dset])))}
+            if constraint_extra_args is None:
+                extra_args = None
+            else:
+                extra_args = {k: v[i_dset]
+                              for k, v in constraint_extra_args.items()}
+            results = self._log_likelihood(
+                i_batch,
+                dsetname=dsetname,
+                data_tensor=batch_data_tensor,
+                batch_info=batch_info[i_dset],
+                omit_grads=omit_grads,
+                second_order=True,
+                empty_batch=empty_batch,
+                constraint_extra_args=extra_args,
+                **params)
+            index = [[i_dset]]
+            return (
+                tf.tensor_scatter_nd_add(
+                    ll, index, tf.cast(results[0], float_type)[None]),
+                tf.tensor_scatter_nd_add(
+                    llgrad, index, tf.cast(results[1], float_type)[None]),
+                tf.tensor_scatter_nd_add(
+                    llgrad2, index, tf.cast(results[2], float_type)[None]))
+
+        # Batches of active datasets
+        batches = tf.cast(
+            tf.where(tf.gather(active, batch_dataset))[:, 0], fd.int_type())
+        for i in tf.range(tf.size(batches)):
+            i_batch = batches[i]
+            ll, llgrad, llgrad2 = add_batch(
+                batch_dataset[i_batch], batch_index[i_batch],
+                data_tensor[i_batch], False,
+                ll, llgrad, llgrad2)
+
+        # Dummy batch without data for the mu and constraint terms
+        # of active datasets without events
+        empty_datasets = tf.boolean_mask(
+            empty_datasets, tf.gather(active, empty_datasets))
+        for i in tf.range(tf.size(empty_datasets)):
+            ll, llgrad, llgrad2 = add_batch(
+                empty_datasets[i], tf.constant(0, dtype=fd.int_type()),
+                None, True,
+                ll, llgrad, llgrad2)
+
+        return ll, llgrad, llgrad2
+
     def interval(self, parameter, **kwargs):
         """Return central confidence interval on parameter.
         Options are the same as for limit."""
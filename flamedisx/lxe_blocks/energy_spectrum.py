@@ -1,3 +1,5 @@
+import os
+
 from multihist import Histdd
 import numpy as np
 import pandas as pd
@@ -296,13 +298,106 @@ class InvalidEventTimes(Exception):
 
 
 @export
-class WIMPEnergySpectrum(VariableEnergySpectrum):
+class WIMPSpectrumMixin:
+    """WIMP energy spectra on disk, in memory and in the tensorflow graph,
+    shared by the lxe and NEST WIMPEnergySpectrum blocks.
+    """
+    model_attributes = ('in_graph_energy_spectrum',
+                        'spectra_cache_dir')
+    non_physics_settings = ('spectra_cache_dir',)
+
+    #: Directory in which to cache computed WIMP spectra on disk, so other
+    #: processes can reuse them. If None, spectra are only cached in memory.
+    spectra_cache_dir = None
+
+    #: If set to True, look up the energy spectrum of each event in the
+    #: tensorflow graph, rather than storing it in the data tensor.
+    #: This saves memory and annotation time, at a small cost in speed.
+    in_graph_energy_spectrum = False
+
+    def setup_energy_hist(self, scale=1.):
+        """Set energies and the (time, energy) histogram energy_hist of
+        the WIMP spectrum, multiplied by scale, and prepare lookups in it.
+        """
+        # BlockModelSource is kind enough to let us change these attributes
+        # at this stage.
+        e_centers = self.bin_centers(self.energy_edges)
+        self.energies = fd.np_to_tf(e_centers)
+        if self.in_graph_energy_spectrum:
+            self.frozen_model_functions = tuple()
+            self.array_columns = tuple()
+        else:
+            self.array_columns = (
+                ('energy_spectrum', len(self.energy_edges) - 1),)
+
+        times = np.linspace(wr.j2000(self.t_start.value),
+                            wr.j2000(self.t_stop.value),
+                            self.n_time_bins + 1)
+        time_centers = self.bin_centers(times)
+
+        spectra = wimp_spectra(time_centers,
+                               self.energy_edges,
+                               cache_dir=self.spectra_cache_dir,
+                               mw=self.mw,
+                               sigma_nucleon=self.sigma_nucleon)
+        assert spectra.shape == (len(time_centers), len(e_centers))
+
+        self.energy_hist = Histdd.from_histogram(
+            spectra,
+            bin_edges=(times, self.energy_edges)) * scale
+
+        if self.pretend_wimps_dont_modulate:
+            self.energy_hist.histogram = (
+                np.ones_like(self.energy_hist.histogram)
+                * self.energy_hist.sum(axis=0).histogram.reshape(1, -1)
+                / self.n_time_bins)
+
+        # Time bin edges in event_time units, for in-graph lookups
+        self.time_edges_tensor = fd.np_to_tf(fd.j2000_to_event_time(times))
+        self.energy_hist_tensor = fd.np_to_tf(self.energy_hist.histogram)
+
+    def energy_spectrum(self, event_time):
+        if self.in_graph_energy_spectrum:
+            return self.energy_spectrum_tf(event_time)
+        ts = fd.tf_to_np(event_time)
+        ts = wr.j2000(ts)
+        ts = self.clip_j2000_times(ts)
+        return fd.np_to_tf(self.energy_hist.histogram[self.time_bin_index(ts)])
+
+    def time_bin_index(self, ts):
+        """Return index of the time bin containing each J2000 time in ts.
+        Both edges of the final bin are inclusive, as in Histdd.slicesum.
+
+        :param ts: array of J2000 timestamps, within the histogram range
+        """
+        tbins = self.energy_hist.bin_edges[0]
+        return np.clip(np.searchsorted(tbins, ts, side='right') - 1,
+                       0, len(tbins) - 2)
+
+    def energy_spectrum_tf(self, event_time):
+        """Return (n_events, n_energies) tensor with the energy spectrum at
+        each event_time, computed in tensorflow.
+        Times outside the histogram range are clipped to it.
+
+        :param event_time: tensor of event times (ns since unix epoch)
+        """
+        event_time = tf.cast(event_time, dtype=fd.float_type())
+        i = tf.searchsorted(self.time_edges_tensor, event_time,
+                            side='right') - 1
+        i = tf.clip_by_value(i, 0, self.n_time_bins - 1)
+        return tf.gather(self.energy_hist_tensor, i)
+
+
+@export
+class WIMPEnergySpectrum(WIMPSpectrumMixin, VariableEnergySpectrum):
     model_attributes = ('pretend_wimps_dont_modulate',
                         'mw',
                         'sigma_nucleon',
                         'exposure_tonneyear',
                         'n_time_bins',
-                        'energy_edges') + VariableEnergySpectrum.model_attributes
+                        'energy_edges') \
+        + WIMPSpectrumMixin.model_attributes \
+        + VariableEnergySpectrum.model_attributes
 
     #: If set to True, the energy spectrum at each time will be set to its
     #: average over the data taking period.
@@ -328,51 +423,7 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     array_columns = (('energy_spectrum', len(energy_edges) - 1),)
 
     def setup(self):
-        wimp_kwargs = dict(mw=self.mw,
-                           sigma_nucleon=self.sigma_nucleon,
-                           exposure_tonneyear=self.exposure_tonneyear,
-                           energy_edges=self.energy_edges)
-
-        # BlockModelSource is kind enough to let us change these attributes
-        # at this stage.
-        e_centers = self.bin_centers(wimp_kwargs['energy_edges'])
-        self.energies = fd.np_to_tf(e_centers)
-        self.array_columns = (('energy_spectrum', len(self.energy_edges) - 1),)
-
-        times = np.linspace(wr.j2000(self.t_start.value),
-                            wr.j2000(self.t_stop.value),
-                            self.n_time_bins + 1)
-        time_centers = self.bin_centers(times)
-
-        # Transform wimp_kwargs to arguments that can be passed to wimprates
-        # which means transforming es from edges to centers
-        del wimp_kwargs['energy_edges'], wimp_kwargs['exposure_tonneyear']
-
-        spectra = np.array([wr.rate_wimp_std(t=t,
-                                             es=e_centers,
-                                             **wimp_kwargs)
-                            * np.diff(self.energy_edges)
-                            for t in time_centers])
-        assert spectra.shape == (len(time_centers), len(e_centers))
-
-        self.energy_hist = Histdd.from_histogram(
-            spectra,
-            bin_edges=(times, self.energy_edges)) * self.exposure_tonneyear
-
-        if self.pretend_wimps_dont_modulate:
-            self.energy_hist.histogram = (
-                np.ones_like(self.energy_hist.histogram)
-                * self.energy_hist.sum(axis=0).histogram.reshape(1, -1)
-                / self.n_time_bins)
-
-    def energy_spectrum(self, event_time):
-        ts = fd.tf_to_np(event_time)
-        ts = wr.j2000(ts)
-        ts = self.clip_j2000_times(ts)
-
-        result = np.stack([self.energy_hist.slicesum(t).histogram
-                           for t in ts])
-        return fd.np_to_tf(result)
+        self.setup_energy_hist(scale=self.exposure_tonneyear)
 
     def clip_j2000_times(self, ts):
         """Return J2000 time(s) ts, clipped to the range of the
@@ -437,3 +488,57 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     @staticmethod
     def bin_centers(x):
         return 0.5 * (x[1:] + x[:-1])
+
+
+# WIMP spectra computed or loaded in this process, by cache key
+_wimp_spectra_memo = dict()
+
+
+@export
+def wimp_spectra(time_centers, energy_edges, cache_dir=None, **wimp_kwargs):
+    """Return (n_times, n_energies) array of WIMP spectra, in events per
+    tonne year per energy bin, at each J2000 time in time_centers.
+
+    Spectra are memoized in this process, and cached on disk in cache_dir
+    if it is given, keyed by the times, energies, wimp_kwargs and the
+    wimprates version (which fixes the default halo model).
+
+    :param time_centers: J2000 times at which to compute the spectra
+    :param energy_edges: Energy bin edges. Spectra are evaluated at
+        the bin centers and multiplied by the bin widths.
+    :param cache_dir: Directory of the on-disk cache. None: no disk cache.
+    :param wimp_kwargs: Passed to wimprates.rate_wimp_std, e.g. mw and
+        sigma_nucleon
+    """
+    time_centers = np.asarray(time_centers, dtype=float)
+    energy_edges = np.asarray(energy_edges, dtype=float)
+    key = fd.deterministic_hash(dict(
+        time_centers=time_centers,
+        energy_edges=energy_edges,
+        wimp_kwargs=repr(sorted(wimp_kwargs.items())),
+        wimprates_version=wr.__version__))
+    if key in _wimp_spectra_memo:
+        return _wimp_spectra_memo[key].copy()
+
+    cache_fn = None
+    if cache_dir is not None:
+        cache_fn = os.path.join(cache_dir, f'wimp_spectra_{key}.npy')
+    if cache_fn is not None and os.path.exists(cache_fn):
+        spectra = np.load(cache_fn)
+    else:
+        e_centers = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+        spectra = np.array([wr.rate_wimp_std(t=t,
+                                             es=e_centers,
+                                             **wimp_kwargs)
+                            * np.diff(energy_edges)
+                            for t in time_centers])
+        if cache_fn is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            def save(fn):
+                with open(fn, mode='wb') as f:
+                    np.save(f, spectra)
+            fd.save_atomically(cache_fn, save)
+
+    _wimp_spectra_memo[key] = spectra
+    return spectra.copy()
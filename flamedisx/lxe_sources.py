@@ -34,6 +34,7 @@ class ERSource(fd.BlockModelSource):
 
     final_dimensions = ('s1', 's2')
     no_step_dimensions = ()
+    columnar_simulation = True
 
 
 @export
@@ -50,6 +51,7 @@ class NRSource(fd.BlockModelSource):
 
     final_dimensions = ('s1', 's2')
     no_step_dimensions = ()
+    columnar_simulation = True
 
     # Use a larger default energy range, since most energy is lost
     # to heat.
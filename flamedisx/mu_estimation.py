@@ -4,6 +4,9 @@ and its variation with parameters.
 """
 import itertools
 from functools import partial
+import multiprocessing as mp
+import os
+import pickle
 
 import numpy as np
 from tqdm import tqdm
@@ -13,6 +16,7 @@ import tensorflow_probability as tfp
 import flamedisx as fd
 
 export, __all__ = fd.exporter()
+o = tf.newaxis
 
 
 @export
@@ -20,6 +24,13 @@ class MuEstimator:
 
     n_trials = int(1e5)  # Number of trials per mu simulation
     progress = True      # Whether to show progress bar during building
+    # Whether to use the same random numbers for each mu simulation
+    common_random_numbers = False
+    crn_seed = 0         # Seed for the common random numbers
+    n_processes = 1      # Number of processes for running mu simulations
+    # Directory of the on-disk cache of built estimators. None: no caching.
+    cache_dir = None
+    cacheable = True     # Whether this estimator can be cached
     options: dict
     bounds: dict
     param_options: dict  # dict param -> dict of options per parameter
@@ -30,11 +41,20 @@ class MuEstimator:
             n_trials=None,
             progress=None,
             options=None,
+            common_random_numbers=None,
+            n_processes=None,
+            cache_dir=None,
             **param_specs):
         if n_trials is not None:
             self.n_trials = n_trials
         if progress is not None:
             self.progress = progress
+        if common_random_numbers is not None:
+            self.common_random_numbers = common_random_numbers
+        if n_processes is not None:
+            self.n_processes = n_processes
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
         if options is None:
             options = dict()
         self.options = options
@@ -61,8 +81,42 @@ class MuEstimator:
         # MuEstimator.__call__, however, expects to be called with filtered params
         param_specs = {k: v for k, v in param_specs.items() if k in source.defaults}
 
-        # Build the necessary interpolators
+        # Build the necessary interpolators, or load them from the cache
+        if self.cache_dir is None or not self.cacheable:
+            self.build(source)
+            return
+        cache_fn = os.path.join(
+            self.cache_dir,
+            f'{self.__class__.__name__}_{self.cache_key(source)}.pkl')
+        if os.path.exists(cache_fn):
+            with open(cache_fn, mode='rb') as f:
+                self.__dict__.update(pickle.load(f))
+            return
         self.build(source)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        def save(fn):
+            with open(fn, mode='wb') as f:
+                pickle.dump(self.__dict__, f)
+        fd.save_atomically(cache_fn, save)
+
+    def cache_key(self, source: fd.Source):
+        """Return a hash identifying the estimator built for source
+        with the current settings.
+        """
+        def class_name(x):
+            return f'{x.__module__}.{x.__qualname__}'
+
+        return fd.deterministic_hash(dict(
+            estimator=class_name(self.__class__),
+            source=class_name(source.__class__),
+            source_settings=source.settings_key(),
+            bounds=self.bounds,
+            param_options=repr(self.param_options),
+            options=repr(self.options),
+            n_trials=self.n_trials,
+            common_random_numbers=self.common_random_numbers,
+            crn_seed=self.crn_seed))
 
     def build(self, source: fd.Source):
         raise NotImplementedError
@@ -70,6 +124,110 @@ class MuEstimator:
     def __call__(self, **params):
         raise NotImplementedError
 
+    def estimate_mu(self, source: fd.Source, **params):
+        """Return source's mu estimated by simulation at params.
+
+        With common_random_numbers, all simulations reuse the same deep truth
+        and random variates, so mus at different anchors differ only by the
+        parameter-dependent response. This gives much smoother mu estimates
+        for the same number of trials.
+        """
+        if not self.common_random_numbers:
+            return source.estimate_mu(**params, n_trials=self.n_trials)
+        with source.common_random_numbers(self.crn_seed):
+            return source.estimate_mu(**params, n_trials=self.n_trials)
+
+    def estimate_mus(self, source: fd.Source, param_list):
+        """Return list of mus estimated by simulation, one for each
+        dictionary of parameters in param_list.
+
+        If n_processes > 1, simulations run in spawned worker processes.
+        """
+        if self.n_processes <= 1 or mp.current_process().daemon:
+            if self.progress:
+                param_list = tqdm(param_list, desc="Estimating mus")
+            return [self.estimate_mu(source, **params)
+                    for params in param_list]
+
+        with fd.worker_pool(self.n_processes,
+                            payload=(self, source)) as pool:
+            result = pool.imap(_estimate_mu_worker, param_list)
+            if self.progress:
+                result = tqdm(result, desc="Estimating mus",
+                              total=len(param_list))
+            return list(result)
+
+    def refine_anchors(self, source: fd.Source, rtol=0.01, max_trials=None):
+        """Return (anchors, mus): dicts mapping each parameter to an array of
+        anchor points and of the mus estimated at these anchors, with the
+        other parameters at their defaults.
+
+        Each parameter starts with n_anchors evenly spaced anchors
+        (default 3). In each round, we simulate the midpoint of each
+        interval that is not yet converged, and add it as a new anchor.
+        If linear interpolation between the interval endpoints predicted the
+        midpoint mu within rtol, the two halves are converged; otherwise
+        they are refined in the next round.
+
+        :param rtol: Relative tolerance on the mu interpolation error.
+        Use common_random_numbers, or make sure the Monte Carlo noise of a
+        single mu estimate is well below rtol.
+        :param max_trials: Total number of Monte Carlo trials to spend
+        on midpoint simulations. Defaults to 10 simulations per parameter.
+        The widest intervals are refined first.
+        """
+        if max_trials is None:
+            max_trials = 10 * len(self.bounds) * self.n_trials
+        sims_left = int(max_trials // self.n_trials)
+
+        anchors, mus = dict(), dict()
+        todo = []  # (pname, left anchor) of unconverged intervals
+        for pname, (start, stop) in self.bounds.items():
+            n_anchors = int(self.param_options.get(pname, {}).get('n_anchors', 3))
+            anchors[pname] = list(np.linspace(start, stop, n_anchors))
+            todo += [(pname, x) for x in anchors[pname][:-1]]
+        initial_mus = self.estimate_mus(source, [
+            {pname: x}
+            for pname, xs in anchors.items()
+            for x in xs])
+        for pname, xs in anchors.items():
+            mus[pname] = initial_mus[:len(xs)]
+            initial_mus = initial_mus[len(xs):]
+
+        while todo and sims_left > 0:
+            # Refine the widest intervals (relative to the parameter range)
+            # first, in case we cannot refine them all
+            intervals = []
+            for pname, x in todo:
+                i = anchors[pname].index(x)
+                width = anchors[pname][i + 1] - x
+                rel_width = width / np.diff(self.bounds[pname])[0]
+                intervals.append((-rel_width, pname, i))
+            intervals = sorted(intervals)[:sims_left]
+            sims_left -= len(intervals)
+
+            mid_mus = self.estimate_mus(source, [
+                {pname: np.mean(anchors[pname][i:i + 2])}
+                for _, pname, i in intervals])
+
+            # Insert new anchors from the back, so indices stay valid
+            todo = []
+            for (_, pname, i), mu in sorted(
+                    zip(intervals, mid_mus),
+                    key=lambda x: -x[0][2]):
+                xs, ys = anchors[pname], mus[pname]
+                x_mid = (xs[i] + xs[i + 1]) / 2
+                mu_pred = (ys[i] + ys[i + 1]) / 2
+                converged = abs(mu - mu_pred) <= rtol * abs(mu)
+                xs.insert(i + 1, x_mid)
+                ys.insert(i + 1, mu)
+                if not converged:
+                    todo += [(pname, xs[i]), (pname, x_mid)]
+
+        anchors = {pname: np.asarray(xs) for pname, xs in anchors.items()}
+        mus = {pname: np.asarray(ys, dtype=float) for pname, ys in mus.items()}
+        return anchors, mus
+
 
 @export
 class CrossInterpolatedMu(MuEstimator):
@@ -78,22 +236,28 @@ class CrossInterpolatedMu(MuEstimator):
     """
 
     def build(self, source: fd.Source):
-        # Estimate mu under the current defaults
-        self.base_mu = tf.constant(
-            source.estimate_mu(n_trials=self.n_trials),
-            dtype=fd.float_type())
+        # Collect the anchors along each direction
+        anchors = dict()
+        for pname, (start, stop) in self.bounds.items():
+            n_anchors = int(self.param_options.get(pname, {}).get('n_anchors', 2))
+            anchors[pname] = np.linspace(start, stop, n_anchors)
+
+        # Estimate mu under the current defaults, and the
+        # mu variation along each direction, in one go
+        param_list = [dict()] + [
+            {pname: x}
+            for pname, xs in anchors.items()
+            for x in xs]
+        mus = self.estimate_mus(source, param_list)
 
-        # Estimate mu variation along each direction
+        self.base_mu = tf.constant(mus[0], dtype=fd.float_type())
         self.mus = dict()   # parameter -> tensor of mus along anchors
-        _iter = self.bounds.items()
-        if self.progress:
-            _iter = tqdm(_iter, desc="Estimating mus")
-        for pname, (start, stop) in _iter:
-            n_anchors = int(self.param_options.get(pname, {}).get('n_anchors', 2))
+        i = 1
+        for pname, xs in anchors.items():
             self.mus[pname] = tf.convert_to_tensor(
-                 [source.estimate_mu(**{pname: x}, n_trials=self.n_trials)
-                  for x in np.linspace(start, stop, n_anchors)],
-                 dtype=fd.float_type())
+                mus[i:i + len(xs)],
+                dtype=fd.float_type())
+            i += len(xs)
 
     def __call__(self, **kwargs):
         kwargs = {param_name: kwargs[param_name] for param_name in self.bounds}
@@ -115,6 +279,7 @@ class SimulateEachCallMu(MuEstimator):
 
     Use for debugging / if you know what you are getting into...
     """
+    cacheable = False
 
     def build(self, source: fd.Source):
         self.source = source
@@ -131,6 +296,8 @@ class ConstantMu(MuEstimator):
     def __init__(self, *args, input_mu=None, **kwargs):
         if input_mu is not None:
             self.mu = input_mu
+            # Nothing to build, and the cache key does not know input_mu
+            self.cacheable = False
         else:
             self.mu = None
 
@@ -138,7 +305,7 @@ class ConstantMu(MuEstimator):
 
     def build(self, source: fd.Source):
         if self.mu is None:
-            self.mu = source.estimate_mu(n_trials=self.n_trials)
+            self.mu = self.estimate_mu(source)
 
     def __call__(self, **params):
         result = self.mu
@@ -201,12 +368,15 @@ class CombinedMu(MuEstimator):
                 est_options = est.get('options', dict())
                 n_trials = est.get('n_trials', self.n_trials)
                 progress = est.get('progress', self.progress)
+                crn = est.get('common_random_numbers',
+                              self.common_random_numbers)
             elif is_mu_estimator_class(est):
                 # We just got a class; don't pass any options
                 est_class = est
                 est_options = dict()
                 n_trials = self.n_trials
                 progress = self.progress
+                crn = self.common_random_numbers
             else:
                 raise ValueError(f"Can't build mu estimator for {spec},"
                                  f" {est} is not a mu estimator?")
@@ -221,6 +391,8 @@ class CombinedMu(MuEstimator):
                 n_trials=n_trials,
                 progress=progress,
                 options=est_options,
+                common_random_numbers=crn,
+                n_processes=self.n_processes,
                 **param_specs
             )
 
@@ -274,13 +446,8 @@ class GridInterpolatedMu(MuEstimator):
         # (like sklearn.ParameterGrid)
         keys, values = grid_dict.keys(), grid_dict.values()
         param_grid = [dict(zip(keys, v)) for v in itertools.product(*values)]
-        if self.progress:
-            param_grid = tqdm(param_grid, desc="Estimating mus")
 
-        mu_grid = [
-            source.estimate_mu(**params, n_trials=self.n_trials)
-            for params in param_grid
-        ]
+        mu_grid = self.estimate_mus(source, param_grid)
         self.mu_grid = fd.np_to_tf(np.asarray(mu_grid).reshape(grid_shape))
 
     def __call__(self, **kwargs):
@@ -296,6 +463,320 @@ class GridInterpolatedMu(MuEstimator):
             axis=-len(self.bounds))[0]
 
 
+@export
+class TemplateMorphMu(MuEstimator):
+    """Exact expected number of events for a fd.MorphedTemplateSource,
+    interpolating the total events of its templates like the source
+    interpolates their bins.
+    """
+    cacheable = False
+
+    def build(self, source: fd.Source):
+        assert isinstance(source, fd.MorphedTemplateSource), \
+            "TemplateMorphMu only works for MorphedTemplateSources"
+        templates = source._events_per_bin_templates
+        n_params = len(source.param_grid)
+        self.param_grid = {pname: fd.np_to_tf(grid)
+                           for pname, grid in source.param_grid.items()}
+        self.defaults = {pname: source.defaults[pname]
+                         for pname in source.param_grid}
+        self.mu_grid = fd.np_to_tf(templates.sum(
+            axis=tuple(range(n_params, len(templates.shape)))))
+
+    def __call__(self, **params):
+        points = [tf.reshape(tf.cast(params.get(pname, default),
+                                     dtype=fd.float_type()), (1,))
+                  for pname, default in self.defaults.items()]
+        mu = fd.tf_multilinear_interpolate(
+            points, list(self.param_grid.values()), self.mu_grid)[0]
+        # Add zero terms so gradient evaluates to 0, not None
+        for pname, value in params.items():
+            if pname not in self.param_grid:
+                mu += 0 * value
+        return mu
+
+
+@export
+class AdaptiveCrossInterpolatedMu(CrossInterpolatedMu):
+    """Cross interpolation with adaptively placed anchors: anchors are added
+    where the mu variation is poorly described by linear interpolation,
+    see MuEstimator.refine_anchors.
+
+    Options:
+     - rtol: relative tolerance on the interpolation error (default 0.01)
+     - max_trials: total Monte Carlo trials for refinement simulations
+    """
+
+    def build(self, source: fd.Source):
+        self.base_mu = tf.constant(
+            self.estimate_mu(source),
+            dtype=fd.float_type())
+
+        anchors, mus = self.refine_anchors(
+            source,
+            rtol=self.options.get('rtol', 0.01),
+            max_trials=self.options.get('max_trials'))
+        self.anchors = {pname: fd.np_to_tf(xs) for pname, xs in anchors.items()}
+        self.mus = {pname: fd.np_to_tf(ys) for pname, ys in mus.items()}
+
+    def __call__(self, **kwargs):
+        kwargs = {param_name: kwargs[param_name] for param_name in self.bounds}
+
+        mu = self.base_mu
+        for pname, v in kwargs.items():
+            mu *= tfp.math.batch_interp_rectilinear_nd_grid(
+                x=tf.reshape(tf.cast(v, fd.float_type()), (1, 1)),
+                x_grid_points=(self.anchors[pname],),
+                y_ref=self.mus[pname],
+                axis=-1)[0] / self.base_mu
+        return mu
+
+
+@export
+class AdaptiveGridInterpolatedMu(GridInterpolatedMu):
+    """Grid interpolation on a non-uniform grid. The anchors for each
+    parameter are placed adaptively along the line through the defaults
+    (see MuEstimator.refine_anchors), then mu is estimated on the full
+    product grid of these anchors.
+
+    Options:
+     - rtol: relative tolerance on the interpolation error (default 0.01)
+     - max_trials: total Monte Carlo trials for refinement simulations.
+       The final grid simulations come on top of this.
+    """
+
+    def build(self, source: fd.Source):
+        anchors, _ = self.refine_anchors(
+            source,
+            rtol=self.options.get('rtol', 0.01),
+            max_trials=self.options.get('max_trials'))
+        self.anchors = tuple(fd.np_to_tf(xs) for xs in anchors.values())
+        grid_shape = tuple(len(xs) for xs in anchors.values())
+
+        keys, values = anchors.keys(), anchors.values()
+        param_grid = [dict(zip(keys, v)) for v in itertools.product(*values)]
+        mu_grid = self.estimate_mus(source, param_grid)
+        self.mu_grid = fd.np_to_tf(np.asarray(mu_grid).reshape(grid_shape))
+
+    def __call__(self, **kwargs):
+        kwargs = {param_name: kwargs[param_name] for param_name in self.bounds}
+        x = tf.cast(tf.stack(list(kwargs.values())), fd.float_type())
+
+        return tfp.math.batch_interp_rectilinear_nd_grid(
+            x[o, :],
+            x_grid_points=self.anchors,
+            y_ref=self.mu_grid,
+            axis=-len(self.bounds))[0]
+
+
+@export
+class QuadratureMu(MuEstimator):
+    """Estimate mu deterministically, by integrating the differential rate
+    over a fixed grid in the final (observable) dimensions, e.g. (s1, s2).
+
+    The grid cells are evaluated like data events, in batches, on a source
+    with the same settings. Deep-truth variables other than the observables
+    (e.g. positions and times) are averaged over a fixed sample from
+    random_truth. Mu and its derivatives thus come from the same computation
+    as the differential rate, without Monte Carlo noise or interpolation
+    anchors. This costs as much as evaluating the likelihood of
+    n_bins**2 * n_truth_samples additional events, once per parameter point:
+    mu, its gradient and (if asked for) its Hessian are cached for the last
+    parameters, so evaluating every batch of the likelihood does not
+    integrate again. The hidden-variable bounds approximations of the
+    differential rate apply here as well.
+
+    Options:
+     - n_bins: number of grid cells per final dimension, either an int
+       or a dict {dimension: n_bins} (default 30)
+     - range: dict {dimension: (low, high)} of grid ranges. Dimensions
+       not specified take the range of events simulated at the defaults.
+       Events outside the grid are lost. The grid must not include
+       regions with zero acceptance (e.g. below the S1 threshold).
+       Differential rates there are (rightly) refused by check_data.
+     - n_truth_samples: number of deep-truth samples to average over
+       (default 10)
+     - batch_size: batch size for evaluating the grid (default 100)
+    """
+
+    def build(self, source: fd.Source):
+        n_bins = self.options.get('n_bins', 30)
+        ranges = self.options.get('range', dict())
+        n_truth = self.options.get('n_truth_samples', 10)
+        dims = source.final_dimensions
+        if not isinstance(n_bins, dict):
+            n_bins = {dim: n_bins for dim in dims}
+
+        missing = [dim for dim in dims if dim not in ranges]
+        if missing:
+            with source.common_random_numbers(self.crn_seed):
+                d = source.simulate(self.n_trials)
+            ranges = {**ranges}
+            for dim in missing:
+                ranges[dim] = (d[dim].min(), d[dim].max())
+
+        # Grid cell centers, and the volume of each cell
+        self.edges = {
+            dim: np.linspace(*ranges[dim], n_bins[dim] + 1)
+            for dim in dims}
+        centers = [(e[1:] + e[:-1]) / 2 for e in self.edges.values()]
+        self.cell_volume = np.prod([np.diff(e)[0] for e in self.edges.values()])
+
+        # Combine each grid cell with each deep-truth sample
+        with source.common_random_numbers(self.crn_seed):
+            data = fd.observables_grid(
+                source, dict(zip(dims, centers)), n_truth)
+        self.grid_shape = (n_truth,) + tuple(len(c) for c in centers)
+
+        # Evaluate the grid like data, on a source with the same settings.
+        # The MC reservoir (for the bounds) only depends on these settings,
+        # so the grid source can share it.
+        self.source = source.__class__(
+            batch_size=min(self.options.get('batch_size', 100), len(data)),
+            max_sigma=source.max_sigma,
+            max_sigma_outer=source.max_sigma_outer,
+            **source.settings())
+        self.source.mc_reservoir = source.mc_reservoir
+        self.source.mc_reservoir_key = source.mc_reservoir_key
+        self.source.set_data(data)
+
+        weights = np.zeros(self.source.n_batches * self.source.batch_size)
+        weights[:len(data)] = self.cell_volume / n_truth
+        self.weights = fd.np_to_tf(weights.reshape(
+            self.source.n_batches, self.source.batch_size))
+
+        # Cached results for the last parameters,
+        # for each set of parameter names we are called with.
+        self._caches = dict()
+
+    def __call__(self, **params):
+        names = tuple(params.keys())
+        x = tf.convert_to_tensor(
+            [params[pname] for pname in names], dtype=fd.float_type())
+        cache = self._get_cache(names)
+
+        @tf.custom_gradient
+        def mu(x):
+            # Mu and the gradient are cached; the Hessian is only computed
+            # (and cached) when the gradient is differentiated.
+            result, grad = self._mu_and_gradient(
+                cache, names, tf.stop_gradient(x))
+
+            def mu_grad_fn(dy):
+                @tf.custom_gradient
+                def gradient(x):
+                    def hessian_fn(ddy):
+                        return tf.linalg.matvec(
+                            self._hessian(cache, names, tf.stop_gradient(x)),
+                            ddy)
+                    return tf.identity(grad), hessian_fn
+                return dy * gradient(x)
+
+            return result, mu_grad_fn
+
+        return mu(x)
+
+    def _get_cache(self, names):
+        if names not in self._caches:
+            n = len(names)
+            nan = tf.constant(float('nan'), dtype=fd.float_type())
+            # Variables must be created outside of traced functions
+            with tf.init_scope():
+                self._caches[names] = dict(
+                    x=tf.Variable(tf.fill([n], nan), trainable=False),
+                    mu=tf.Variable(nan, trainable=False),
+                    grad=tf.Variable(tf.fill([n], nan), trainable=False),
+                    hessian_x=tf.Variable(tf.fill([n], nan), trainable=False),
+                    hessian=tf.Variable(tf.fill([n, n], nan),
+                                        trainable=False))
+        return self._caches[names]
+
+    def _mu_and_gradient(self, cache, names, x):
+        def integrate():
+            result = tf.constant(0., dtype=fd.float_type())
+            grad = tf.zeros_like(x)
+            for i_batch in range(self.source.n_batches):
+                with tf.GradientTape() as t:
+                    t.watch(x)
+                    batch_mu = self._batch_mu(i_batch, names, x)
+                result += batch_mu
+                grad += t.gradient(
+                    batch_mu, x,
+                    unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            cache['x'].assign(x)
+            cache['mu'].assign(result)
+            cache['grad'].assign(grad)
+            return result, grad
+
+        # (mu is NaN until the first integration)
+        is_cached = tf.logical_and(
+            tf.reduce_all(tf.equal(x, cache['x'])),
+            tf.logical_not(tf.math.is_nan(cache['mu'])))
+        return tf.cond(
+            is_cached,
+            lambda: (cache['mu'].read_value(), cache['grad'].read_value()),
+            integrate)
+
+    def _hessian(self, cache, names, x):
+        def integrate():
+            hessian = tf.zeros((len(names), len(names)),
+                               dtype=fd.float_type())
+            for i_batch in range(self.source.n_batches):
+                with tf.GradientTape() as t2:
+                    t2.watch(x)
+                    with tf.GradientTape() as t1:
+                        t1.watch(x)
+                        batch_mu = self._batch_mu(i_batch, names, x)
+                    grad = t1.gradient(
+                        batch_mu, x,
+                        unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                hessian += t2.jacobian(
+                    grad, x,
+                    unconnected_gradients=tf.UnconnectedGradients.ZERO,
+                    experimental_use_pfor=False)
+            cache['hessian_x'].assign(x)
+            cache['hessian'].assign(hessian)
+            return hessian
+
+        return tf.cond(
+            tf.reduce_all(tf.equal(x, cache['hessian_x'])),
+            cache['hessian'].read_value,
+            integrate)
+
+    def _batch_mu(self, i_batch, names, x):
+        ptensor = self.source.ptensor_from_kwargs(
+            **dict(zip(names, tf.unstack(x))))
+        if tf.executing_eagerly():
+            differential_rate = self.source._differential_rate_tf
+        else:
+            # We are already tracing (e.g. in the likelihood);
+            # calling the traced function here would break the Hessian.
+            differential_rate = self.source._differential_rate
+        return tf.reduce_sum(self.weights[i_batch] * differential_rate(
+            data_tensor=self.source.data_tensor[i_batch], ptensor=ptensor))
+
+    def error_estimate(self, **params):
+        """Return dict with estimates of the absolute error on mu
+        at params, from:
+         - quadrature: the difference with a grid of twice the cell size
+           (using every other cell). This overestimates the error of the
+           full grid.
+         - sampling: the standard error of the mean over
+           deep-truth samples.
+        Events outside the grid range are not accounted for.
+        """
+        rates = self.source.batched_differential_rate(progress=False, **params)
+        rates = rates.reshape(self.grid_shape)
+        # Integral for each deep-truth sample
+        mus = rates.sum(axis=tuple(range(1, rates.ndim))) * self.cell_volume
+        coarse = rates[(slice(None),) + (slice(None, None, 2),) * (rates.ndim - 1)]
+        mu_coarse = coarse.mean(axis=0).sum() * self.cell_volume \
+            * rates[0].size / coarse[0].size
+        return dict(
+            quadrature=abs(mus.mean() - mu_coarse),
+            sampling=mus.std(ddof=1) / len(mus)**0.5 if len(mus) > 1 else 0.)
+
+
 @export
 def is_mu_estimator_class(x):
     if isinstance(x, partial):
@@ -304,3 +785,8 @@ def is_mu_estimator_class(x):
         # x is no class (issubclass would crash, annoyingly)
         return False
     return issubclass(x, fd.MuEstimator)
+
+
+def _estimate_mu_worker(params):
+    estimator, source = fd.worker_payload()
+    return estimator.estimate_mu(source, **params)
@@ -126,7 +126,7 @@ class DetectPhotonsOrElectrons(fd.Block):
                                               bound_type='binomial', supports=supports,
                                               rvs_binom=rvs, ns_binom=ns, ps_binom=ps)
 
-            return True
+        return True
 
 
 @export
@@ -28,6 +28,11 @@ class EnergySpectrum(fd.FirstBlock):
     energies = tf.cast(tf.linspace(0., 10., 1000),
                        dtype=fd.float_type())
 
+    # electrons_produced, photons_produced and energy columns of the
+    # MC reservoir, for _annotate
+    _reservoir_columns = None
+    _reservoir_columns_key = None
+
     def domain(self, data_tensor):
         assert isinstance(self.energies, tf.Tensor)  # see WIMPsource for why
 
@@ -47,16 +52,29 @@ class EnergySpectrum(fd.FirstBlock):
                                               self.source.batch_size,
                                               axis=0)}
 
+    def prepare_annotate(self):
+        # Generate an MC reservoir for obtaining energy bounds. Also use this for Bayes bounds priors.
+        # The reservoir only depends on the source settings, so we can reuse it across set_data calls.
+        key = self.reservoir_key()
+        if self.source.mc_reservoir.empty or self.source.mc_reservoir_key != key:
+            reservoir = self.source.simulate(int(1e6), keep_padding=True)
+            assert not reservoir.empty, \
+                "MC reservoir used in energy bounds computation is empty. Are your cuts too tight?"
+            # Sort on electrons_produced, so batches can select their range with a binary search
+            self.source.mc_reservoir = reservoir.sort_values(
+                'electrons_produced', kind='stable', ignore_index=True)
+            self.source.mc_reservoir_key = key
+        if self._reservoir_columns_key != self.source.mc_reservoir_key:
+            self._reservoir_columns = self.source.mc_reservoir[
+                ['electrons_produced', 'photons_produced', 'energy']].to_numpy()
+            self._reservoir_columns_key = self.source.mc_reservoir_key
+
     def _annotate(self, d):
-        # Generate an MC reservoir for obtaining energy bounds. Also use this for Bayes bounds priors
-        self.source.mc_reservoir = self.source.simulate(int(1e6), keep_padding=True)
-        assert not self.source.mc_reservoir.empty, \
-            "MC reservoir used in energy bounds computation is empty. Are your cuts too tight?"
+        # In case we are not called through BlockModelSource._annotate
+        self.prepare_annotate()
 
-        energy = self.source.mc_reservoir.columns.get_loc('energy')
-        electrons_produced = self.source.mc_reservoir.columns.get_loc('electrons_produced')
-        photons_produced = self.source.mc_reservoir.columns.get_loc('photons_produced')
-        res = self.source.mc_reservoir.values
+        electrons_produced, photons_produced, energy = 0, 1, 2
+        res = self._reservoir_columns
 
         # Same energy bounds for all events within a batch
         for batch in range(self.source.n_batches):
@@ -70,11 +88,13 @@ class EnergySpectrum(fd.FirstBlock):
             photons_produced_max = max(d['photons_produced_max'][
                 batch * self.source.batch_size:(batch + 1) * self.source.batch_size])
 
-            # We filter the reservoir energies by flat-prior Bayes bounds on electrons/photons produced
-            energies = res[:, energy][(res[:, electrons_produced] >= electrons_produced_min)
-                                      & (res[:, electrons_produced] <= electrons_produced_max)
-                                      & (res[:, photons_produced] >= photons_produced_min)
-                                      & (res[:, photons_produced] <= photons_produced_max)]
+            # We filter the reservoir energies by flat-prior Bayes bounds on electrons/photons produced.
+            # The electrons_produced range is a contiguous slice of the sorted reservoir.
+            i_min = np.searchsorted(res[:, electrons_produced], electrons_produced_min, side='left')
+            i_max = np.searchsorted(res[:, electrons_produced], electrons_produced_max, side='right')
+            res_batch = res[i_min:i_max]
+            energies = res_batch[:, energy][(res_batch[:, photons_produced] >= photons_produced_min)
+                                            & (res_batch[:, photons_produced] <= photons_produced_max)]
 
             # We use this filtered reservoir to estimate energy bounds
             self.source.data.loc[batch * self.source.batch_size:
@@ -84,6 +104,13 @@ class EnergySpectrum(fd.FirstBlock):
                                  (batch + 1) * self.source.batch_size - 1, 'energy_max'] = \
                 np.quantile(energies, 1. - self.source.bounds_prob)
 
+    def reservoir_key(self):
+        """Return a key identifying the source settings the MC reservoir
+        depends on: parameter defaults, constant model functions and
+        model attributes.
+        """
+        return self.source.settings_key()
+
     def draw_positions(self, n_events, **params):
         """Return dictionary with x, y, z, r, theta, drift_time
         randomly drawn.
@@ -340,12 +367,14 @@ class InvalidEventTimes(Exception):
 
 
 @export
-class WIMPEnergySpectrum(VariableEnergySpectrum):
+class WIMPEnergySpectrum(fd.WIMPSpectrumMixin, VariableEnergySpectrum):
     model_attributes = ('pretend_wimps_dont_modulate',
                         'mw',
                         'sigma_nucleon',
                         'n_time_bins',
-                        'energy_edges') + VariableEnergySpectrum.model_attributes
+                        'energy_edges') \
+        + fd.WIMPSpectrumMixin.model_attributes \
+        + VariableEnergySpectrum.model_attributes
 
     # If set to True, the energy spectrum at each time will be set to its
     # average over the data taking period.
@@ -363,49 +392,7 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     array_columns = (('energy_spectrum', len(energy_edges) - 1),)
 
     def setup(self):
-        wimp_kwargs = dict(mw=self.mw,
-                           sigma_nucleon=self.sigma_nucleon,
-                           energy_edges=self.energy_edges)
-
-        # BlockModelSource is kind enough to let us change these attributes
-        # at this stage.
-        e_centers = self.bin_centers(wimp_kwargs['energy_edges'])
-        self.energies = fd.np_to_tf(e_centers)
-        self.array_columns = (('energy_spectrum', len(self.energy_edges) - 1),)
-
-        times = np.linspace(wr.j2000(self.t_start.value),
-                            wr.j2000(self.t_stop.value),
-                            self.n_time_bins + 1)
-        time_centers = self.bin_centers(times)
-
-        # Transform wimp_kwargs to arguments that can be passed to wimprates
-        # which means transforming es from edges to centers
-        del wimp_kwargs['energy_edges']
-        spectra = np.array([wr.rate_wimp_std(t=t,
-                                             es=e_centers,
-                                             **wimp_kwargs)
-                            * np.diff(self.energy_edges)
-                            for t in time_centers])
-        assert spectra.shape == (len(time_centers), len(e_centers))
-
-        self.energy_hist = Histdd.from_histogram(
-            spectra,
-            bin_edges=(times, self.energy_edges))
-
-        if self.pretend_wimps_dont_modulate:
-            self.energy_hist.histogram = (
-                np.ones_like(self.energy_hist.histogram)
-                * self.energy_hist.sum(axis=0).histogram.reshape(1, -1)
-                / self.n_time_bins)
-
-    def energy_spectrum(self, event_time):
-        ts = fd.tf_to_np(event_time)
-        ts = wr.j2000(ts)
-        ts = self.clip_j2000_times(ts)
-
-        result = np.stack([self.energy_hist.slicesum(t).histogram
-                           for t in ts])
-        return fd.np_to_tf(result)
+        self.setup_energy_hist()
 
     def clip_j2000_times(self, ts):
         """Return J2000 time(s) ts, clipped to the range of the
@@ -1,3 +1,6 @@
+import os
+import warnings
+
 import numpy as np
 from scipy import stats
 import tensorflow as tf
@@ -26,12 +29,273 @@ class MakePhotonsElectronsNR(fd.Block):
                                'variance', 'width_correction', 'mu_correction')
     model_functions = special_model_functions
 
+    model_attributes = ('energy_chunk_size',
+                        'use_quanta_table',
+                        'quanta_table_file')
+    non_physics_settings = model_attributes
+
+    # Number of energies to compute at once when summing over the spectrum.
+    # If None, all energies are computed at once; set this to bound the
+    # memory use of _compute for large energy dimsizes.
+    energy_chunk_size = None
+
+    # Whether to look up p(electrons, photons | energy) from a precomputed
+    # table, rather than evaluating it for every event. Only used if none of
+    # the yield model functions depend on fitted parameters or observables.
+    use_quanta_table = False
+
+    # .npz file to store the quanta table in, and load it from if it exists
+    # and was made for the same energies. If None, the table is kept in memory.
+    quanta_table_file = None
+
+    _quanta_table = None
+
     def setup(self):
         self.array_columns = (('ions_produced_min',
                                max(min(len(self.source.energies),
                                        self.source.max_dim_sizes['energy']),
                                    2)),)
 
+    @property
+    def cutoff_energy(self):
+        """Energy above which we use the approximate computation"""
+        return 5. if self.is_ER else 20.
+
+    def yield_params_free(self):
+        """Return whether any model function of this block depends on
+        fitted parameters or on event observables, in which case we
+        cannot use the quanta table.
+        """
+        for fname in self.model_functions:
+            if self.source.f_dims[fname]:
+                return True
+            if set(self.source.f_params[fname]) & set(self.source.fit_params):
+                return True
+        return False
+
+    def quanta_table_key(self):
+        """Return a hash identifying the block class and the source settings
+        (parameter defaults, constant model functions and model attributes)
+        the quanta table depends on.
+        """
+        return fd.deterministic_hash([
+            f'{type(self).__module__}.{type(self).__qualname__}',
+            self.source.settings_key()])
+
+    def quanta_table(self):
+        """Return dictionary with the quanta table, building it (or loading it
+        from quanta_table_file) if needed. See build_quanta_table for the format.
+        """
+        energies = fd.tf_to_np(self.source.energies)
+        key = self.quanta_table_key()
+        if self._quanta_table is not None \
+                and np.array_equal(self._quanta_table['energies'], energies) \
+                and self._quanta_table['key'] == key:
+            return self._quanta_table
+
+        table = None
+        if self.quanta_table_file is not None and os.path.exists(self.quanta_table_file):
+            with np.load(self.quanta_table_file) as f:
+                table = {k: f[k] for k in f.files}
+            if not (np.array_equal(table['energies'], energies)
+                    and table['max_sigma'] == self.source.max_sigma
+                    and table.get('key', '') == key):
+                warnings.warn(f"Quanta table in {self.quanta_table_file} was made "
+                              f"for different settings, rebuilding it")
+                table = None
+        if table is None:
+            table = dict(**self.build_quanta_table(), key=key)
+            if self.quanta_table_file is not None:
+                np.savez_compressed(self.quanta_table_file, **table)
+
+        self._quanta_table = table
+        return table
+
+    def build_quanta_table(self, n_sigma=None, min_p=1e-30, ions_chunk_size=16):
+        """Return dictionary with p(electrons_produced, quanta | energy),
+        summed over all ions_produced, for each energy in source.energies.
+
+        For each energy, the table only covers a window of electrons and quanta
+        (= electrons + photons) in which the probability exceeds min_p:
+          - p: (n_energies, n_electrons, n_quanta) array, zero-padded
+          - electrons_offset, quanta_offset: (n_energies,) arrays, the
+            electrons and quanta corresponding to the first row/column of p.
+
+        :param n_sigma: Number of standard deviations of ions_produced and
+            excitons to cover, defaults to twice source.max_sigma
+        :param min_p: Probability below which table entries can be discarded
+        :param ions_chunk_size: Number of ions_produced values to evaluate at
+            once, to limit memory use
+        """
+        energies = fd.tf_to_np(self.source.energies)
+        max_sigma = self.source.max_sigma
+        if n_sigma is None:
+            n_sigma = 2 * max_sigma
+
+        ps, electrons_offset, quanta_offset = [], [], []
+        for energy in energies:
+            ions_min, ions_max = self.ion_bounds(energy, max_sigma=n_sigma)
+            ions_min = max(int(ions_min), 0)
+            ions_max = max(int(ions_max), ions_min)
+
+            # Quanta are ions plus excitons
+            nq_mean, ex_ratio = self._mean_quanta(energy)
+            nex_mean = max(nq_mean * ex_ratio / (1. + ex_ratio), 1.)
+            nex_max = int(np.ceil(nex_mean + n_sigma * np.sqrt(nex_mean)))
+
+            electrons = np.arange(0, ions_max + 1)
+            quanta = np.arange(ions_min, ions_max + nex_max + 1)
+            p = np.zeros((len(electrons), len(quanta)))
+
+            for ions_start in range(ions_min, ions_max + 1, ions_chunk_size):
+                ions = np.arange(ions_start, min(ions_start + ions_chunk_size, ions_max + 1))
+                el, nq, ni = [tf.constant(x[o], dtype=fd.float_type())
+                              for x in np.meshgrid(electrons, quanta, ions, indexing='ij')]
+                p += self._compute_single_energy(
+                    None, None,
+                    tf.constant(energy, dtype=fd.float_type()), 1.,
+                    el, nq - el, ni,
+                    approx=energy >= self.cutoff_energy).numpy()[0]
+
+            # Photons cannot be negative
+            p[electrons[:, o] > quanta[o, :]] = 0.
+
+            # Keep only the window with non-negligible probability
+            el_i, nq_i = np.where(p > min_p)
+            if not len(el_i):
+                el_i, nq_i = np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+            p = p[el_i.min():el_i.max() + 1, nq_i.min():nq_i.max() + 1]
+            ps.append(p)
+            electrons_offset.append(electrons[el_i.min()])
+            quanta_offset.append(quanta[nq_i.min()])
+
+        table = np.zeros((len(energies),
+                          max([p.shape[0] for p in ps]),
+                          max([p.shape[1] for p in ps])),
+                         dtype=np.float32)
+        for i, p in enumerate(ps):
+            table[i, :p.shape[0], :p.shape[1]] = p
+
+        return dict(energies=energies,
+                    max_sigma=max_sigma,
+                    p=table,
+                    electrons_offset=np.array(electrons_offset),
+                    quanta_offset=np.array(quanta_offset))
+
+    def _mean_quanta(self, energy):
+        """Return mean number of quanta and exciton ratio at energy"""
+        if self.is_ER:
+            nel = self.gimme_numpy('mean_yield_electron', energy)
+            nq = self.gimme_numpy('mean_yield_quanta', (energy, nel))
+            ex_ratio = self.gimme_numpy('exciton_ratio', energy)
+        else:
+            _, nq, ex_ratio = self.gimme_numpy('mean_yields', energy)
+        return float(nq), float(ex_ratio)
+
+    def _compute_single_energy(self, data_tensor, ptensor, energy, rate_vs_energy,
+                               electrons_produced, photons_produced, ions_produced,
+                               approx=False):
+        """Return the block result for a single energy, summed over ions_produced.
+        Set approx to True for an approximate computation at higher energies
+        """
+        nq = electrons_produced + photons_produced
+
+        if self.is_ER:
+            nel_mean = self.gimme('mean_yield_electron', data_tensor=data_tensor, ptensor=ptensor,
+                                  bonus_arg=energy)
+            nq_mean = self.gimme('mean_yield_quanta', data_tensor=data_tensor, ptensor=ptensor,
+                                 bonus_arg=(energy, nel_mean))
+            fano = self.gimme('fano_factor', data_tensor=data_tensor, ptensor=ptensor,
+                              bonus_arg=nq_mean)
+
+            if approx:
+                p_nq = tfp.distributions.Normal(loc=nq_mean,
+                                                scale=tf.sqrt(nq_mean * fano) + 1e-10).prob(nq)
+            else:
+                normal_dist_nq = tfp.distributions.Normal(loc=nq_mean,
+                                                          scale=tf.sqrt(nq_mean * fano) + 1e-10)
+                p_nq = normal_dist_nq.cdf(nq + 0.5) - normal_dist_nq.cdf(nq - 0.5)
+
+            ex_ratio = self.gimme('exciton_ratio', data_tensor=data_tensor, ptensor=ptensor,
+                                  bonus_arg=energy)
+            alpha = 1. / (1. + ex_ratio)
+
+            p_ni = tfp.distributions.Binomial(
+                total_count=nq, probs=alpha).prob(ions_produced)
+
+        else:
+            yields = self.gimme('mean_yields', data_tensor=data_tensor, ptensor=ptensor,
+                                bonus_arg=energy)
+            nel_mean = yields[0]
+            nq_mean = yields[1]
+            ex_ratio = yields[2]
+            alpha = 1. / (1. + ex_ratio)
+
+            yield_fano = self.gimme('yield_fano', data_tensor=data_tensor, ptensor=ptensor,
+                                    bonus_arg=nq_mean)
+            ni_fano = yield_fano[0]
+            nex_fano = yield_fano[1]
+
+            if approx:
+                p_ni = tfp.distributions.Normal(loc=nq_mean*alpha,
+                                                scale=tf.sqrt(nq_mean*alpha*ni_fano) + 1e-10).prob(ions_produced)
+
+                p_nq = tfp.distributions.Normal(loc=nq_mean*alpha*ex_ratio,
+                                                scale=tf.sqrt(nq_mean*alpha*ex_ratio*nex_fano) + 1e-10).prob(
+                                                    nq - ions_produced)
+            else:
+                normal_dist_ni = tfp.distributions.Normal(loc=nq_mean*alpha,
+                                                          scale=tf.sqrt(nq_mean*alpha) + 1e-10)
+                p_ni = normal_dist_ni.cdf(ions_produced + 0.5) - \
+                    normal_dist_ni.cdf(ions_produced - 0.5)
+
+                normal_dist_nq = tfp.distributions.Normal(loc=nq_mean*alpha*ex_ratio,
+                                                          scale=tf.sqrt(nq_mean*alpha*ex_ratio) + 1e-10)
+                p_nq = normal_dist_nq.cdf(nq - ions_produced + 0.5) \
+                    - normal_dist_nq.cdf(nq - ions_produced - 0.5)
+
+        recomb_p = self.gimme('recomb_prob', data_tensor=data_tensor, ptensor=ptensor,
+                              bonus_arg=(nel_mean, nq_mean, ex_ratio))
+        skew = self.gimme('skewness', data_tensor=data_tensor, ptensor=ptensor,
+                          bonus_arg=nq_mean)
+        var = self.gimme('variance', data_tensor=data_tensor, ptensor=ptensor,
+                         bonus_arg=(nel_mean, nq_mean, recomb_p, ions_produced))
+        width_corr = self.gimme('width_correction', data_tensor=data_tensor, ptensor=ptensor,
+                                bonus_arg=skew)
+        mu_corr = self.gimme('mu_correction', data_tensor=data_tensor, ptensor=ptensor,
+                             bonus_arg=(skew, var, width_corr))
+
+        mean = (tf.ones_like(ions_produced, dtype=fd.float_type()) - recomb_p) * ions_produced - mu_corr
+        std_dev = tf.sqrt(var) / width_corr
+
+        if self.is_ER:
+            owens_t_terms = 5
+        else:
+            owens_t_terms = 2
+
+        if approx:
+            p_nel = fd.tfp_files.SkewGaussian(loc=mean, scale=std_dev,
+                                              skewness=skew,
+                                              owens_t_terms=owens_t_terms).prob(electrons_produced)
+        else:
+            p_nel = fd.tfp_files.TruncatedSkewGaussianCC(loc=mean, scale=std_dev,
+                                                         skewness=skew,
+                                                         limit=ions_produced,
+                                                         owens_t_terms=owens_t_terms).prob(electrons_produced)
+
+        p_mult = p_nq * p_ni * p_nel
+
+        # Contract over ions_produced
+        p_final = tf.reduce_sum(p_mult, 3)
+
+        r_final = p_final * rate_vs_energy
+
+        r_final = tf.where(tf.math.is_nan(r_final),
+                           tf.zeros_like(r_final, dtype=fd.float_type()),
+                           r_final)
+
+        return r_final
+
     def _compute(self,
                  data_tensor, ptensor,
                  # Domain
@@ -56,101 +320,9 @@ class MakePhotonsElectronsNR(fd.Block):
             # Calculate the ion domain tensor for this energy
             _ions_produced = ions_produced_add + ions_min
 
-            if self.is_ER:
-                nel_mean = self.gimme('mean_yield_electron', data_tensor=data_tensor, ptensor=ptensor,
-                                      bonus_arg=energy)
-                nq_mean = self.gimme('mean_yield_quanta', data_tensor=data_tensor, ptensor=ptensor,
-                                     bonus_arg=(energy, nel_mean))
-                fano = self.gimme('fano_factor', data_tensor=data_tensor, ptensor=ptensor,
-                                  bonus_arg=nq_mean)
-
-                if approx:
-                    p_nq = tfp.distributions.Normal(loc=nq_mean,
-                                                    scale=tf.sqrt(nq_mean * fano) + 1e-10).prob(nq)
-                else:
-                    normal_dist_nq = tfp.distributions.Normal(loc=nq_mean,
-                                                              scale=tf.sqrt(nq_mean * fano) + 1e-10)
-                    p_nq = normal_dist_nq.cdf(nq + 0.5) - normal_dist_nq.cdf(nq - 0.5)
-
-                ex_ratio = self.gimme('exciton_ratio', data_tensor=data_tensor, ptensor=ptensor,
-                                      bonus_arg=energy)
-                alpha = 1. / (1. + ex_ratio)
-
-                p_ni = tfp.distributions.Binomial(
-                    total_count=nq, probs=alpha).prob(_ions_produced)
-
-            else:
-                yields = self.gimme('mean_yields', data_tensor=data_tensor, ptensor=ptensor,
-                                    bonus_arg=energy)
-                nel_mean = yields[0]
-                nq_mean = yields[1]
-                ex_ratio = yields[2]
-                alpha = 1. / (1. + ex_ratio)
-
-                yield_fano = self.gimme('yield_fano', data_tensor=data_tensor, ptensor=ptensor,
-                                        bonus_arg=nq_mean)
-                ni_fano = yield_fano[0]
-                nex_fano = yield_fano[1]
-
-                if approx:
-                    p_ni = tfp.distributions.Normal(loc=nq_mean*alpha,
-                                                    scale=tf.sqrt(nq_mean*alpha*ni_fano) + 1e-10).prob(_ions_produced)
-
-                    p_nq = tfp.distributions.Normal(loc=nq_mean*alpha*ex_ratio,
-                                                    scale=tf.sqrt(nq_mean*alpha*ex_ratio*nex_fano) + 1e-10).prob(
-                                                        nq - _ions_produced)
-                else:
-                    normal_dist_ni = tfp.distributions.Normal(loc=nq_mean*alpha,
-                                                              scale=tf.sqrt(nq_mean*alpha) + 1e-10)
-                    p_ni = normal_dist_ni.cdf(_ions_produced + 0.5) - \
-                        normal_dist_ni.cdf(_ions_produced - 0.5)
-
-                    normal_dist_nq = tfp.distributions.Normal(loc=nq_mean*alpha*ex_ratio,
-                                                              scale=tf.sqrt(nq_mean*alpha*ex_ratio) + 1e-10)
-                    p_nq = normal_dist_nq.cdf(nq - _ions_produced + 0.5) \
-                        - normal_dist_nq.cdf(nq - _ions_produced - 0.5)
-
-            recomb_p = self.gimme('recomb_prob', data_tensor=data_tensor, ptensor=ptensor,
-                                  bonus_arg=(nel_mean, nq_mean, ex_ratio))
-            skew = self.gimme('skewness', data_tensor=data_tensor, ptensor=ptensor,
-                              bonus_arg=nq_mean)
-            var = self.gimme('variance', data_tensor=data_tensor, ptensor=ptensor,
-                             bonus_arg=(nel_mean, nq_mean, recomb_p, _ions_produced))
-            width_corr = self.gimme('width_correction', data_tensor=data_tensor, ptensor=ptensor,
-                                    bonus_arg=skew)
-            mu_corr = self.gimme('mu_correction', data_tensor=data_tensor, ptensor=ptensor,
-                                 bonus_arg=(skew, var, width_corr))
-
-            mean = (tf.ones_like(_ions_produced, dtype=fd.float_type()) - recomb_p) * _ions_produced - mu_corr
-            std_dev = tf.sqrt(var) / width_corr
-
-            if self.is_ER:
-                owens_t_terms = 5
-            else:
-                owens_t_terms = 2
-
-            if approx:
-                p_nel = fd.tfp_files.SkewGaussian(loc=mean, scale=std_dev,
-                                                  skewness=skew,
-                                                  owens_t_terms=owens_t_terms).prob(electrons_produced)
-            else:
-                p_nel = fd.tfp_files.TruncatedSkewGaussianCC(loc=mean, scale=std_dev,
-                                                             skewness=skew,
-                                                             limit=_ions_produced,
-                                                             owens_t_terms=owens_t_terms).prob(electrons_produced)
-
-            p_mult = p_nq * p_ni * p_nel
-
-            # Contract over ions_produced
-            p_final = tf.reduce_sum(p_mult, 3)
-
-            r_final = p_final * rate_vs_energy
-
-            r_final = tf.where(tf.math.is_nan(r_final),
-                               tf.zeros_like(r_final, dtype=fd.float_type()),
-                               r_final)
-
-            return r_final
+            return self._compute_single_energy(data_tensor, ptensor, energy, rate_vs_energy,
+                                               electrons_produced, photons_produced, _ions_produced,
+                                               approx=approx)
 
         def compute_single_energy_full(args):
             # Compute the block for a single energy, without approximations
@@ -161,8 +333,6 @@ class MakePhotonsElectronsNR(fd.Block):
             # or truncated skew Gaussian
             return compute_single_energy(args, approx=True)
 
-        nq = electrons_produced + photons_produced
-
         ions_min_initial = self.source._fetch('ions_produced_min', data_tensor=data_tensor)[:, 0, o]
         ions_min_initial = tf.repeat(ions_min_initial, tf.shape(ions_produced)[1], axis=1)
         ions_min_initial = tf.repeat(ions_min_initial[:, :, o], tf.shape(ions_produced)[2], axis=2)
@@ -173,10 +343,7 @@ class MakePhotonsElectronsNR(fd.Block):
         ions_produced_add = ions_produced - ions_min_initial
 
         # Energy above which we use the approximate computation
-        if self.is_ER:
-            cutoff_energy = 5.
-        else:
-            cutoff_energy = 20.
+        cutoff_energy = self.cutoff_energy
 
         energies_below_cutoff = tf.size(tf.where(energy[0, :] < cutoff_energy))
         energies_above_cutoff = tf.size(tf.where(energy[0, :] >= cutoff_energy))
@@ -191,18 +358,74 @@ class MakePhotonsElectronsNR(fd.Block):
         ion_bounds_min_full, ion_bounds_min_approx = \
             tf.split(ion_bounds_min, [energies_below_cutoff, energies_above_cutoff], 1)
 
+        def sum_over_energies(compute_fn, elems):
+            # Sum the block result over energies, vectorizing over
+            # energy_chunk_size energies at a time
+            if self.energy_chunk_size is None:
+                return tf.reduce_sum(tf.vectorized_map(compute_fn, elems=elems), 0)
+
+            chunk_size = self.energy_chunk_size
+            n_energies = tf.shape(elems[0])[0]
+
+            def add_chunk(i, result):
+                chunk = [x[i:i + chunk_size] for x in elems]
+                return (i + chunk_size,
+                        result + tf.reduce_sum(tf.vectorized_map(compute_fn, elems=chunk), 0))
+
+            _, result = tf.while_loop(
+                lambda i, _: i < n_energies,
+                add_chunk,
+                (tf.constant(0), tf.zeros(tf.shape(ions_produced)[:3], dtype=fd.float_type())))
+            return result
+
+        if self.use_quanta_table and not self.yield_params_free():
+            # Build the table (outside of any graph we might be tracing)
+            with tf.init_scope():
+                table = self.quanta_table()
+            table_p = tf.constant(table['p'], dtype=fd.float_type())
+            electrons_offset = tf.constant(table['electrons_offset'], dtype=fd.int_type())
+            quanta_offset = tf.constant(table['quanta_offset'], dtype=fd.int_type())
+
+            electrons = tf.cast(tf.round(electrons_produced[:, :, :, 0]), fd.int_type())
+            quanta = electrons + tf.cast(tf.round(photons_produced[:, :, :, 0]), fd.int_type())
+
+            def lookup_single_energy(args):
+                i_energy = args[0]
+                rate_vs_energy = args[1]
+                i_el = electrons - electrons_offset[i_energy]
+                i_nq = quanta - quanta_offset[i_energy]
+                in_table = ((i_el >= 0) & (i_el < tf.shape(table_p)[1])
+                            & (i_nq >= 0) & (i_nq < tf.shape(table_p)[2]))
+                p = tf.gather_nd(
+                    table_p,
+                    tf.stack([tf.fill(tf.shape(i_el), i_energy),
+                              tf.clip_by_value(i_el, 0, tf.shape(table_p)[1] - 1),
+                              tf.clip_by_value(i_nq, 0, tf.shape(table_p)[2] - 1)],
+                             axis=-1))
+                return tf.where(in_table, p, tf.zeros_like(p)) * rate_vs_energy
+
+            energy_index = tf.searchsorted(
+                tf.constant(table['energies'], dtype=fd.float_type()),
+                energy[0, :],
+                out_type=fd.int_type())
+            result = sum_over_energies(lookup_single_energy,
+                                       [energy_index, rate_vs_energy[0, :]])
+
+            # The table sums over all ions_produced, so undo the scaling
+            # for ions_produced stepping that is applied to the block result
+            ions_steps = self.source._fetch('ions_produced_steps', data_tensor=data_tensor)
+            return result / ions_steps[:, o, o]
+
         # Sum the block result per energy over energies, separately for the
         # energies below the cutoff and the energies above the cutoff
-        result_full = tf.reduce_sum(tf.vectorized_map(compute_single_energy_full,
-                                                      elems=[energy_full,
-                                                             rate_vs_energy_full,
-                                                             tf.transpose(ion_bounds_min_full)]),
-                                    0)
-        result_approx = tf.reduce_sum(tf.vectorized_map(compute_single_energy_approx,
-                                                        elems=[energy_approx,
-                                                               rate_vs_energy_approx,
-                                                               tf.transpose(ion_bounds_min_approx)]),
-                                      0)
+        result_full = sum_over_energies(compute_single_energy_full,
+                                        [energy_full,
+                                         rate_vs_energy_full,
+                                         tf.transpose(ion_bounds_min_full)])
+        result_approx = sum_over_energies(compute_single_energy_approx,
+                                          [energy_approx,
+                                           rate_vs_energy_approx,
+                                           tf.transpose(ion_bounds_min_approx)])
 
         return (result_full + result_approx)
 
@@ -277,16 +500,21 @@ class MakePhotonsElectronsNR(fd.Block):
     def _annotate(self, d):
         pass
 
-    def _annotate_special(self, d):
-        # Here we manually calculate ion bounds for each energy we will sum over in the spectrum
-        # Simple computation, based on forward simulation procedure
+    def ion_bounds(self, energy, max_sigma=None):
+        """Return (min, max) ions_produced at energy.
+        Simple computation, based on forward simulation procedure
 
-        def get_bounds_ER(energy):
+        :param max_sigma: Number of standard deviations to include,
+            defaults to source.max_sigma
+        """
+        if max_sigma is None:
+            max_sigma = self.source.max_sigma
+        if self.is_ER:
             nel = self.gimme_numpy('mean_yield_electron', energy)
             nq = self.gimme_numpy('mean_yield_quanta', (energy, nel))
             fano = self.gimme_numpy('fano_factor', nq)
-            nq_actual_upper = nq + np.sqrt(fano * nq) * self.source.max_sigma
-            nq_actual_lower = nq - np.sqrt(fano * nq) * self.source.max_sigma
+            nq_actual_upper = nq + np.sqrt(fano * nq) * max_sigma
+            nq_actual_lower = nq - np.sqrt(fano * nq) * max_sigma
 
             ex_ratio = self.gimme_numpy('exciton_ratio', energy)
             alpha = 1. / (1. + ex_ratio)
@@ -296,12 +524,12 @@ class MakePhotonsElectronsNR(fd.Block):
             ions_std_upper = np.sqrt(nq_actual_upper * alpha * (1 - alpha))
             ions_std_lower = np.sqrt(nq_actual_lower * alpha * (1 - alpha))
 
-            ions_produced_min = np.floor(ions_mean_lower - self.source.max_sigma * ions_std_lower).astype(int)
-            ions_produced_max = np.ceil(ions_mean_upper + self.source.max_sigma * ions_std_upper).astype(int)
+            ions_produced_min = np.floor(ions_mean_lower - max_sigma * ions_std_lower).astype(int)
+            ions_produced_max = np.ceil(ions_mean_upper + max_sigma * ions_std_upper).astype(int)
 
             return (ions_produced_min, ions_produced_max)
 
-        def get_bounds_NR(energy):
+        else:
             nq = self.gimme_numpy('mean_yields', energy)[1]
             ex_ratio = self.gimme_numpy('mean_yields', energy)[2]
             alpha = 1. / (1. + ex_ratio)
@@ -310,16 +538,15 @@ class MakePhotonsElectronsNR(fd.Block):
             ions_mean = nq * alpha
             ions_std = np.sqrt(nq * alpha * ni_fano)
 
-            ions_produced_min = np.floor(ions_mean - self.source.max_sigma * ions_std).astype(int)
-            ions_produced_max = np.ceil(ions_mean + self.source.max_sigma * ions_std).astype(int)
+            ions_produced_min = np.floor(ions_mean - max_sigma * ions_std).astype(int)
+            ions_produced_max = np.ceil(ions_mean + max_sigma * ions_std).astype(int)
 
             return (ions_produced_min, ions_produced_max)
 
+    def _annotate_special(self, d):
+        # Here we manually calculate ion bounds for each energy we will sum over in the spectrum
         # Compute ion bounds for every energy in the full spectrum, once
-        if self.is_ER:
-            bounds = [get_bounds_ER(energy) for energy in self.source.energies.numpy()]
-        else:
-            bounds = [get_bounds_NR(energy) for energy in self.source.energies.numpy()]
+        bounds = [self.ion_bounds(energy) for energy in self.source.energies.numpy()]
 
         ions_produced_min_full = [x[0] for x in bounds]
         ions_produced_max_full = [x[1] for x in bounds]
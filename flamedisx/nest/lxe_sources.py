@@ -19,6 +19,8 @@ XENON_REF_DENSITY = 2.90
 
 
 class nestSource(fd.BlockModelSource):
+    columnar_simulation = True
+
     def __init__(self, *args, detector='default', **kwargs):
         assert detector in ('default',)
 
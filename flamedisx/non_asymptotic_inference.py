@@ -1,5 +1,10 @@
+from hashlib import sha1
+import json
+import os
+
 import flamedisx as fd
 import numpy as np
+import pandas as pd
 from scipy import stats
 from tqdm.auto import tqdm
 import typing as ty
@@ -14,11 +19,21 @@ class TestStatistic():
     """Class to evaluate a test statistic based on a conidtional and unconditional
     maximum likelihood fit. Override the evaluate() method in derived classes.
 
+    Fits are cached, so calling the test statistic again for another mu_test
+    reuses the unconditional fit, and starts the conditional fit from the
+    conditional fit at the nearest mu_test already evaluated. Only reuse a
+    TestStatistic while the likelihood's data and constraint arguments are
+    unchanged.
+
     Arguments:
         - likelihood: fd.LogLikelihood instance with data already set
     """
     def __init__(self, likelihood):
         self.likelihood = likelihood
+        # {signal source name: unconditional fit}
+        self.unconditional_fits = dict()
+        # {signal source name: {mu_test: conditional fit}}
+        self.conditional_fits = dict()
 
     def __call__(self, mu_test, signal_source_name, guess_dict):
         # To fix the signal RM in the conditional fit
@@ -27,10 +42,22 @@ class TestStatistic():
         guess_dict_nuisance = guess_dict.copy()
         guess_dict_nuisance.pop(f'{signal_source_name}_rate_multiplier')
 
+        # Start from the conditional fit at the nearest mu_test, if any
+        conditional_fits = self.conditional_fits.setdefault(signal_source_name, dict())
+        if conditional_fits:
+            nearest_mu = min(conditional_fits, key=lambda mu: abs(mu - mu_test))
+            guess_dict_nuisance.update({
+                k: v for k, v in conditional_fits[nearest_mu].items()
+                if k not in fix_dict})
+
         # Conditional fit
         bf_conditional = self.likelihood.bestfit(fix=fix_dict, guess=guess_dict_nuisance, suppress_warnings=True)
-        # Uncnditional fit
-        bf_unconditional = self.likelihood.bestfit(guess=guess_dict, suppress_warnings=True)
+        conditional_fits[mu_test] = bf_conditional
+        # Uncnditional fit, which does not depend on mu_test
+        if signal_source_name not in self.unconditional_fits:
+            self.unconditional_fits[signal_source_name] = \
+                self.likelihood.bestfit(guess=guess_dict, suppress_warnings=True)
+        bf_unconditional = self.unconditional_fits[signal_source_name]
 
         # Return the test statistic, unconditional fit and conditional fit
         return self.evaluate(bf_unconditional, bf_conditional), bf_unconditional, bf_conditional
@@ -125,6 +152,104 @@ class ObservedTestStatistics():
         self.conditional_best_fits[mu_test] = fit_values
 
 
+@export
+class ToyDatasets():
+    """Collection of toy datasets, stored as one array per column with the
+    events of all toys concatenated, and the offsets at which each toy
+    starts. Memory therefore scales with the total number of events, not
+    with the number of toys, and the arrays can be saved to and memory-mapped
+    from disk, to share toys between processes without pickling.
+
+    toys[i] returns toy i as a DataFrame; toys.view(i) returns it as
+    fd.ColumnarData of views into the arrays, without copying.
+
+    Arguments:
+        - columns: dictionary {column name: array} of concatenated toys
+        - offsets: array of length (number of toys + 1) with the index of the
+            first event of each toy, and the total number of events.
+    """
+    def __init__(self, columns: ty.Dict[str, np.ndarray], offsets):
+        self.columns = columns
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        for column, values in columns.items():
+            assert len(values) == self.offsets[-1], \
+                f'Column {column} does not have {self.offsets[-1]} events'
+
+    @classmethod
+    def from_frames(cls, toys):
+        """Return ToyDatasets from a sequence of DataFrames (or fd.ColumnarData).
+        Toys without some columns get NaN there.
+        """
+        toys = [fd.ColumnarData.from_frame(toy)
+                if isinstance(toy, pd.DataFrame) else toy
+                for toy in toys]
+        offsets = np.cumsum([0] + [len(toy) for toy in toys])
+
+        # Columns in order of appearance
+        column_names = list(dict.fromkeys(
+            column for toy in toys for column in toy.columns))
+        columns = dict()
+        for column in column_names:
+            parts = [toy[column].values if column in toy
+                     else np.full(len(toy), np.nan)
+                     for toy in toys]
+            values = np.concatenate(parts) if parts else np.zeros(0)
+            if values.dtype == object:
+                # Fixed-width strings, so the column can be memory-mapped
+                values = values.astype(str)
+            columns[column] = values
+        return cls(columns, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_events(self):
+        """Number of events in each toy"""
+        return np.diff(self.offsets)
+
+    def view(self, i):
+        """Return toy i as fd.ColumnarData of views into the column arrays"""
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return fd.ColumnarData(
+            {column: values[start:stop]
+             for column, values in self.columns.items()},
+            n_rows=stop - start)
+
+    def __getitem__(self, i):
+        """Return toy i as a DataFrame"""
+        return self.view(i).to_frame()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, directory):
+        """Save toys to directory, as one .npy file per column"""
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        for column, values in self.columns.items():
+            np.save(os.path.join(directory, f'column_{column}.npy'), values)
+        with open(os.path.join(directory, 'toys.json'), mode='w') as f:
+            json.dump(dict(columns=list(self.columns.keys())), f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Load toys saved to directory with save.
+
+        :param mmap: If True (default), memory-map the column arrays rather
+            than reading them into memory.
+        """
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, 'toys.json')) as f:
+            column_names = json.load(f)['columns']
+        return cls(
+            {column: np.load(os.path.join(directory, f'column_{column}.npy'),
+                             mmap_mode=mmap_mode)
+             for column in column_names},
+            np.load(os.path.join(directory, 'offsets.npy')))
+
+
 @export
 class TSEvaluation():
     """NOTE: currently works for a single dataset only.
@@ -206,12 +331,17 @@ class TSEvaluation():
         self.sample_other_constraints = sample_other_constraints
         self.rm_bounds = rm_bounds
 
+        # {dataset key: test statistic} of the observed data and
+        # background-only toys, see get_test_statistic
+        self.test_statistics = dict()
+
     def run_routine(self, mus_test=None, save_fits=False,
                     observed_data=None,
                     observed_test_stats=None,
                     generate_B_toys=False,
                     simulate_dict_B=None, toy_data_B=None, constraint_extra_args_B=None,
-                    toy_batch=0):
+                    toy_batch=0,
+                    toy_data_B_directory=None):
         """If observed_data is passed, evaluate observed test statistics. Otherwise,
         obtain test statistic distributions (for both S+B and B-only).
 
@@ -232,11 +362,14 @@ class TSEvaluation():
             - simulate_dict_B: first return argument of the result of calling this function with
                 generate_B_toys=True)
             - toy_data_B: second return argument of the result of calling this function with
-                generate_B_toys=True)
+                generate_B_toys=True), a ToyDatasets. Can also be the directory a ToyDatasets
+                was saved to, which is then memory-mapped, or a list of DataFrames.
             - toy_data_B: third return argument of the result of calling this function with
                 generate_B_toys=True)
             - toy_batch: if parallelising toys, this should correspond to the parallel batch index
                 (starting at 0) being run, to ensure the correct background-only toys are accessed
+            - toy_data_B_directory: if generating background-only toys and this is passed, save
+                the toys to this directory, and return them memory-mapped from there
         """
         if observed_test_stats is not None:
             self.observed_test_stats = observed_test_stats
@@ -244,16 +377,8 @@ class TSEvaluation():
             self.observed_test_stats = None
 
         if toy_data_B is not None:
-            assert simulate_dict_B is not None, \
-                'Must pass all of simulate_dict_B, toy_data_B and \
-                    constraint_extra_args_B'
-            assert constraint_extra_args_B is not None, \
-                'Must pass all of simulate_dict_B, toy_data_B and \
-                    constraint_extra_args_B'
-            self.simulate_dict_B = simulate_dict_B
-            self.toy_data_B = toy_data_B
-            self.constraint_extra_args_B = constraint_extra_args_B
-            self.toy_batch = toy_batch
+            self.set_toy_data_B(simulate_dict_B, toy_data_B, constraint_extra_args_B,
+                                toy_batch=toy_batch)
 
         observed_test_stats_collection = dict()
         test_stat_dists_SB_collection = dict()
@@ -265,33 +390,7 @@ class TSEvaluation():
             test_stat_dists_SB = TestStatisticDistributions()
             test_stat_dists_B = TestStatisticDistributions()
 
-            sources = dict()
-            arguments = dict()
-            for background_source in self.background_source_names:
-                sources[background_source] = self.sources[background_source]
-                arguments[background_source] = self.arguments[background_source]
-            sources[signal_source] = self.sources[signal_source]
-            arguments[signal_source] = self.arguments[signal_source]
-
-            # Create likelihood of TemplateSources
-            likelihood = fd.LogLikelihood(sources=sources,
-                                          arguments=arguments,
-                                          progress=False,
-                                          batch_size=self.batch_size,
-                                          free_rates=tuple([sname for sname in sources.keys()]))
-
-            rm_bounds = dict()
-            if signal_source in self.rm_bounds.keys():
-                rm_bounds[signal_source] = self.rm_bounds[signal_source]
-            for background_source in self.background_source_names:
-                if background_source in self.rm_bounds.keys():
-                    rm_bounds[background_source] = self.rm_bounds[background_source]
-
-            # Pass rate multiplier bounds to likelihood
-            likelihood.set_rate_multiplier_bounds(**rm_bounds)
-
-            # Pass constraint function to likelihood
-            likelihood.set_log_constraint(self.log_constraint_fn)
+            likelihood = self.make_likelihood(signal_source)
 
             # Where we want to generate B-only toys
             if generate_B_toys:
@@ -300,9 +399,14 @@ class TSEvaluation():
                 for i in tqdm(range(self.ntoys), desc='Background-only toys'):
                     simulate_dict_B, toy_data_B, constraint_extra_args_B = \
                         self.sample_data_constraints(0., signal_source, likelihood)
-                    toy_data_B_all.append(toy_data_B)
+                    # Keep only the column arrays, not the DataFrame
+                    toy_data_B_all.append(fd.ColumnarData.from_frame(toy_data_B))
                     constraint_extra_args_B_all.append(constraint_extra_args_B)
                 simulate_dict_B.pop(f'{signal_source}_rate_multiplier')
+                toy_data_B_all = ToyDatasets.from_frames(toy_data_B_all)
+                if toy_data_B_directory is not None:
+                    toy_data_B_all.save(toy_data_B_directory)
+                    toy_data_B_all = ToyDatasets.load(toy_data_B_directory)
                 return simulate_dict_B, toy_data_B_all, constraint_extra_args_B_all
 
             these_mus_test = mus_test[signal_source]
@@ -328,6 +432,162 @@ class TSEvaluation():
         else:
             return test_stat_dists_SB_collection, test_stat_dists_B_collection
 
+    def set_toy_data_B(self, simulate_dict_B, toy_data_B, constraint_extra_args_B,
+                       toy_batch=0):
+        """Set the background-only toys to use, see run_routine for the arguments
+        """
+        assert simulate_dict_B is not None, \
+            'Must pass all of simulate_dict_B, toy_data_B and \
+                constraint_extra_args_B'
+        assert constraint_extra_args_B is not None, \
+            'Must pass all of simulate_dict_B, toy_data_B and \
+                constraint_extra_args_B'
+        self.simulate_dict_B = simulate_dict_B
+        if isinstance(toy_data_B, str):
+            toy_data_B = ToyDatasets.load(toy_data_B)
+        self.toy_data_B = toy_data_B
+        self.constraint_extra_args_B = constraint_extra_args_B
+        self.toy_batch = toy_batch
+
+    def make_likelihood(self, signal_source):
+        """Return likelihood of the background sources and signal_source
+        """
+        sources = dict()
+        arguments = dict()
+        for background_source in self.background_source_names:
+            sources[background_source] = self.sources[background_source]
+            arguments[background_source] = self.arguments[background_source]
+        sources[signal_source] = self.sources[signal_source]
+        arguments[signal_source] = self.arguments[signal_source]
+
+        # Create likelihood of TemplateSources
+        likelihood = fd.LogLikelihood(sources=sources,
+                                      arguments=arguments,
+                                      progress=False,
+                                      batch_size=self.batch_size,
+                                      free_rates=tuple([sname for sname in sources.keys()]))
+
+        rm_bounds = dict()
+        if signal_source in self.rm_bounds.keys():
+            rm_bounds[signal_source] = self.rm_bounds[signal_source]
+        for background_source in self.background_source_names:
+            if background_source in self.rm_bounds.keys():
+                rm_bounds[background_source] = self.rm_bounds[background_source]
+
+        # Pass rate multiplier bounds to likelihood
+        likelihood.set_rate_multiplier_bounds(**rm_bounds)
+
+        # Pass constraint function to likelihood
+        likelihood.set_log_constraint(self.log_constraint_fn)
+
+        # Test statistics of the previous likelihood cannot be reused
+        self.test_statistics = dict()
+
+        return likelihood
+
+    def get_test_statistic(self, likelihood, data, constraint_extra_args):
+        """Set data and constraint_extra_args in likelihood, and return a
+        test statistic for them. Test statistics, and so their fits, are
+        reused for the same dataset, such as the observed data and the
+        background-only toys at each mu_test.
+        """
+        likelihood.set_constraint_extra_args(**constraint_extra_args)
+        likelihood.set_data(data)
+        key = _dataset_key(data, constraint_extra_args)
+        if key not in self.test_statistics:
+            self.test_statistics[key] = self.test_statistic(likelihood)
+        return self.test_statistics[key]
+
+    def run_routine_adaptive(self, mus_test, observed_data,
+                             conf_level=0.1,
+                             toys_per_round=50,
+                             n_refine=2,
+                             p_value_cl=0.95,
+                             condition_on_observed=False,
+                             save_fits=False,
+                             simulate_dict_B=None, toy_data_B=None, constraint_extra_args_B=None,
+                             toy_batch=0):
+        """Evaluate observed test statistics and test statistic distributions in one go,
+        with toys allocated adaptively.
+
+        At each mu, toys are run in rounds of toys_per_round, until the binomial
+        (Clopper-Pearson) confidence interval on the S+B p-value excludes conf_level,
+        or ntoys toys are done. Mus far from the crossing of conf_level thus need only
+        a few rounds. Then, up to n_refine times, the midpoints of neighbouring mus whose
+        p-values lie on different sides of conf_level are added to the scan.
+
+        Arguments:
+            - mus_test: dictionary {sourcename: np.array([mu1, mu2, ...])} of signal rate
+                multipliers to be tested initially for each signal source
+            - observed_data: observed data
+            - conf_level: p-value threshold of the confidence intervals that will be
+                constructed, as in IntervalCalculator.get_interval
+            - toys_per_round: number of toys to add in each round
+            - n_refine: maximum number of times to refine the mu grid
+            - p_value_cl: confidence level of the interval on the p-value used to
+                decide when to stop
+            - condition_on_observed: if True, center the toys on the observed conditional
+                best fits, as when passing observed_test_stats to run_routine
+            - save_fits, simulate_dict_B, toy_data_B, constraint_extra_args_B,
+                toy_batch: see run_routine.
+
+        Returns (observed test statistics, S+B test statistic distributions, B-only
+        test statistic distributions), dictionaries {sourcename: ...} as returned by
+        run_routine, all with the same (refined) mus.
+        """
+        if toy_data_B is not None:
+            self.set_toy_data_B(simulate_dict_B, toy_data_B, constraint_extra_args_B,
+                                toy_batch=toy_batch)
+
+        observed_test_stats_collection = dict()
+        test_stat_dists_SB_collection = dict()
+        test_stat_dists_B_collection = dict()
+        self.observed_test_stats = None
+        if condition_on_observed:
+            self.observed_test_stats = observed_test_stats_collection
+
+        # Loop over signal sources
+        for signal_source in self.signal_source_names:
+            observed_test_stats = ObservedTestStatistics()
+            test_stat_dists_SB = TestStatisticDistributions()
+            test_stat_dists_B = TestStatisticDistributions()
+            observed_test_stats_collection[signal_source] = observed_test_stats
+            test_stat_dists_SB_collection[signal_source] = test_stat_dists_SB
+            test_stat_dists_B_collection[signal_source] = test_stat_dists_B
+
+            likelihood = self.make_likelihood(signal_source)
+
+            p_vals = dict()
+            new_mus = sorted(mus_test[signal_source])
+            for _ in range(n_refine + 1):
+                for mu_test in tqdm(new_mus, desc='Scanning over mus'):
+                    self.get_observed_test_stat(observed_test_stats, observed_data,
+                                                mu_test, signal_source, likelihood,
+                                                save_fits=save_fits or condition_on_observed)
+                    p_vals[mu_test] = self.adaptive_toy_test_statistic_dist(
+                        test_stat_dists_SB, test_stat_dists_B,
+                        mu_test, signal_source, likelihood,
+                        observed_test_stats.test_stats[mu_test],
+                        conf_level=conf_level,
+                        toys_per_round=toys_per_round,
+                        p_value_cl=p_value_cl,
+                        save_fits=save_fits)
+
+                # Refine the grid where the p-value crosses conf_level
+                mus = sorted(p_vals.keys())
+                new_mus = [0.5 * (mu_left + mu_right)
+                           for mu_left, mu_right in zip(mus[:-1], mus[1:])
+                           if (p_vals[mu_left] - conf_level) * (p_vals[mu_right] - conf_level) < 0]
+                if not new_mus:
+                    break
+
+            # IntervalCalculator expects the mus in increasing order
+            for results in (observed_test_stats, test_stat_dists_SB, test_stat_dists_B):
+                for name, values in vars(results).items():
+                    setattr(results, name, dict(sorted(values.items())))
+
+        return observed_test_stats_collection, test_stat_dists_SB_collection, test_stat_dists_B_collection
+
     def sample_data_constraints(self, mu_test, signal_source_name, likelihood):
         """Internal function to sample the toy data and constraint central values
         following a frequentist procedure. Method taken depends on whether conditional
@@ -369,16 +629,58 @@ class TSEvaluation():
                                 mu_test, signal_source_name, likelihood, save_fits=False):
         """Internal function to get test statistic distribution.
         """
+        toy_results = self.run_toys(range(self.ntoys), mu_test, signal_source_name,
+                                    likelihood, save_fits=save_fits)
+        self.add_toy_results(test_stat_dists_SB, test_stat_dists_B, mu_test,
+                             toy_results, save_fits=save_fits)
+
+    def adaptive_toy_test_statistic_dist(self, test_stat_dists_SB, test_stat_dists_B,
+                                         mu_test, signal_source_name, likelihood,
+                                         observed_test_stat,
+                                         conf_level=0.1, toys_per_round=50,
+                                         p_value_cl=0.95, save_fits=False):
+        """Internal function to get test statistic distribution with toys run in rounds,
+        until the S+B p-value of observed_test_stat is known to be above or below
+        conf_level. Returns the estimated p-value.
+        """
+        toy_results = None
+        n_toys = 0
+        while n_toys < self.ntoys:
+            n_round = min(toys_per_round, self.ntoys - n_toys)
+            round_results = self.run_toys(range(n_toys, n_toys + n_round), mu_test,
+                                          signal_source_name, likelihood, save_fits=save_fits)
+            n_toys += n_round
+            if toy_results is None:
+                toy_results = round_results
+            else:
+                for key, values in round_results.items():
+                    toy_results[key] += values
+
+            # Same p-value definition as TestStatisticDistributions.get_p_vals
+            n_above = np.sum(np.array(toy_results['ts_values_SB']) > observed_test_stat)
+            p_val_interval = stats.binomtest(n_above, n_toys).proportion_ci(
+                confidence_level=p_value_cl)
+            if p_val_interval.low > conf_level or p_val_interval.high < conf_level:
+                break
+
+        self.add_toy_results(test_stat_dists_SB, test_stat_dists_B, mu_test,
+                             toy_results, save_fits=save_fits)
+        return n_above / n_toys
+
+    def run_toys(self, toys, mu_test, signal_source_name, likelihood, save_fits=False):
+        """Internal function to evaluate test statistics of S+B and B-only toys, with
+        indices in toys. Returns dictionary of lists with the test statistics, and if
+        save_fits, the fits.
+        """
         ts_values_SB = []
         ts_values_B = []
-        if save_fits:
-            unconditional_bfs_SB = []
-            conditional_bfs_SB = []
-            unconditional_bfs_B = []
-            conditional_bfs_B = []
+        unconditional_bfs_SB = []
+        conditional_bfs_SB = []
+        unconditional_bfs_B = []
+        conditional_bfs_B = []
 
         # Loop over toys
-        for toy in tqdm(range(self.ntoys), desc='Doing toys'):
+        for toy in tqdm(toys, desc='Doing toys'):
             simulate_dict_SB, toy_data_SB, constraint_extra_args_SB = \
                 self.sample_data_constraints(mu_test, signal_source_name, likelihood)
 
@@ -417,30 +719,41 @@ class TSEvaluation():
             except Exception:
                 raise RuntimeError("Could not find background-only datasets")
 
-            # Shift the constraint in the likelihood based on the background RMs we drew
-            likelihood.set_constraint_extra_args(**constraint_extra_args_B)
-            # Set data
-            likelihood.set_data(toy_data_B)
-            # Create test statistic
-            test_statistic_B = self.test_statistic(likelihood)
+            # Set data, and shift the constraint in the likelihood based on
+            # the background RMs we drew. Reuse the test statistic (and its
+            # fits) of this toy from previous mus.
+            test_statistic_B = self.get_test_statistic(
+                likelihood, toy_data_B, constraint_extra_args_B)
             # Evaluate test statistic
             ts_result_B = test_statistic_B(mu_test, signal_source_name, guess_dict_B)
             # Save test statistic, and possibly fits
             ts_values_B.append(ts_result_B[0])
             if save_fits:
-                unconditional_bfs_B.append(ts_result_SB[1])
-                conditional_bfs_B.append(ts_result_SB[2])
-
+                unconditional_bfs_B.append(ts_result_B[1])
+                conditional_bfs_B.append(ts_result_B[2])
+
+        return dict(ts_values_SB=ts_values_SB,
+                    ts_values_B=ts_values_B,
+                    unconditional_bfs_SB=unconditional_bfs_SB,
+                    conditional_bfs_SB=conditional_bfs_SB,
+                    unconditional_bfs_B=unconditional_bfs_B,
+                    conditional_bfs_B=conditional_bfs_B)
+
+    def add_toy_results(self, test_stat_dists_SB, test_stat_dists_B, mu_test,
+                        toy_results, save_fits=False):
+        """Internal function to add the results of run_toys to test statistic
+        distributions.
+        """
         # Add to the test statistic distributions
-        test_stat_dists_SB.add_ts_dist(mu_test, ts_values_SB)
-        test_stat_dists_B.add_ts_dist(mu_test, ts_values_B)
+        test_stat_dists_SB.add_ts_dist(mu_test, toy_results['ts_values_SB'])
+        test_stat_dists_B.add_ts_dist(mu_test, toy_results['ts_values_B'])
 
         # Possibly save the fits
         if save_fits:
-            test_stat_dists_SB.add_unconditional_best_fit(mu_test, unconditional_bfs_SB)
-            test_stat_dists_SB.add_conditional_best_fit(mu_test, conditional_bfs_SB)
-            test_stat_dists_B.add_unconditional_best_fit(mu_test, unconditional_bfs_B)
-            test_stat_dists_B.add_conditional_best_fit(mu_test, conditional_bfs_B)
+            test_stat_dists_SB.add_unconditional_best_fit(mu_test, toy_results['unconditional_bfs_SB'])
+            test_stat_dists_SB.add_conditional_best_fit(mu_test, toy_results['conditional_bfs_SB'])
+            test_stat_dists_B.add_unconditional_best_fit(mu_test, toy_results['unconditional_bfs_B'])
+            test_stat_dists_B.add_conditional_best_fit(mu_test, toy_results['conditional_bfs_B'])
 
     def get_observed_test_stat(self, observed_test_stats, observed_data,
                                mu_test, signal_source_name, likelihood, save_fits=False):
@@ -452,12 +765,10 @@ class TSEvaluation():
             constraint_extra_args[f'{background_source}_expected_counts'] = \
                 self.expected_background_counts[background_source]
 
-        likelihood.set_constraint_extra_args(**constraint_extra_args)
-
-        # Set data
-        likelihood.set_data(observed_data)
-        # Create test statistic
-        test_statistic = self.test_statistic(likelihood)
+        # Set data, and create test statistic, unless we have one from
+        # a previous mu
+        test_statistic = self.get_test_statistic(
+            likelihood, observed_data, constraint_extra_args)
         # Guesses for fit
         guess_dict = {f'{signal_source_name}_rate_multiplier': mu_test}
         for background_source in self.background_source_names:
@@ -477,6 +788,14 @@ class TSEvaluation():
             observed_test_stats.add_conditional_best_fit(mu_test, ts_result[2])
 
 
+def _dataset_key(data, constraint_extra_args):
+    """Return key identifying a dataset and its constraint arguments"""
+    data_hash = sha1(pd.util.hash_pandas_object(data, index=False).values)
+    return (data_hash.hexdigest(),
+            tuple(sorted((k, float(v))
+                         for k, v in constraint_extra_args.items())))
+
+
 @export
 class IntervalCalculator():
     """NOTE: currently works for a single dataset only.
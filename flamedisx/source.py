@@ -1,6 +1,8 @@
 from copy import copy
 from contextlib import contextmanager
+from hashlib import sha1
 import inspect
+import multiprocessing as mp
 import typing as ty
 import warnings
 
@@ -27,10 +29,41 @@ class Source:
     #: to make it match the batch size
     n_padding = None
 
+    #: Attributes that depend on the data, set by set_data
+    _data_attributes = ('data', 'n_events', 'n_batches', 'n_padding',
+                        'dimsizes', 'data_tensor')
+
     #: Whether to trace (compile into a tensorflow graph) the differential
     #: rate computation
     trace_difrate = True
 
+    #: Whether to simulate with columns of numpy arrays (fd.ColumnarData)
+    #: rather than a pandas DataFrame. Only enable this if the simulation
+    #: and add_extra_columns code uses no pandas-specific features.
+    #: random_truth may return either a DataFrame or fd.ColumnarData.
+    columnar_simulation = False
+
+    #: Number of processes to use for simulation. If > 1, events are
+    #: simulated in chunks in spawned worker processes. The source must be
+    #: picklable for this, so define source classes at module level.
+    n_simulate_processes = 1
+
+    #: Maximum number of events to simulate at once. Larger simulations
+    #: are split into chunks, each with its own seeded random stream.
+    #: If None, simulations are split into n_simulate_processes chunks.
+    simulate_chunk_size = None
+
+    #: Names of model attributes that only affect performance, not the
+    #: model itself. These are left out of settings_key, so changing them
+    #: does not invalidate caches. Subclasses and blocks that add such
+    #: attributes should extend this.
+    non_physics_settings: ty.Tuple[str] = ('n_simulate_processes',
+                                           'simulate_chunk_size')
+
+    #: Seed of the common random numbers used for simulation, if any.
+    #: Set this with the common_random_numbers context manager.
+    _crn_seed = None
+
     default_max_sigma = 3
     default_max_sigma_outer = 3
     default_max_dim_size = 70
@@ -226,6 +259,7 @@ class Source:
         self.bounds_prob = stats.norm.cdf(-max_sigma)
         self.bounds_prob_outer = stats.norm.cdf(-max_sigma_outer)
         self.max_sigma = max_sigma
+        self.max_sigma_outer = max_sigma_outer
         assert self.bounds_prob > 0., \
             "max_sigma too high!"
         assert self.bounds_prob_outer > 0., \
@@ -284,6 +318,8 @@ class Source:
         # A source may choose to fill these in for improved bounds computation.
         # See bounds.py for details
         self.mc_reservoir = pd.DataFrame()
+        # Settings the mc_reservoir was made with, to allow reusing it
+        self.mc_reservoir_key = None
         self.prior_PDFs_LB = tuple(dict())
         self.prior_PDFs_UB = tuple(dict())
 
@@ -343,6 +379,44 @@ class Source:
         if unused:
             warnings.warn(f"Defaults for unused settings ignored: {unused}")
 
+    def settings(self):
+        """Return dict of the settings of the model: parameter defaults,
+        constant model functions and model attributes.
+
+        Passing these to the source class gives a source with the same model,
+        unless the class takes other constructor arguments.
+        """
+        return {
+            **self.defaults,
+            **{fname: getattr(self, fname)
+               for fname in self.model_functions
+               if not callable(getattr(self, fname))},
+            **{aname: getattr(self, aname)
+               for aname in self.model_attributes}}
+
+    def settings_key(self):
+        """Return a tuple of strings identifying the settings the model
+        depends on: parameter defaults, constant model functions and
+        model attributes (except those that only affect performance).
+
+        Changes to the source code are not reflected in the key.
+        """
+        def to_str(x):
+            if isinstance(x, (tf.Tensor, np.ndarray)):
+                x = np.ascontiguousarray(fd.tf_to_np(x))
+                return f'{x.dtype}{x.shape}' + sha1(x.tobytes()).hexdigest()
+            return repr(x)
+
+        return (
+            tuple((pname, to_str(v))
+                  for pname, v in sorted(self.defaults.items())),
+            tuple((fname, to_str(getattr(self, fname)))
+                  for fname in sorted(self.model_functions)
+                  if not callable(getattr(self, fname))),
+            tuple((aname, to_str(getattr(self, aname)))
+                  for aname in sorted(self.model_attributes)
+                  if aname not in self.non_physics_settings))
+
     def set_data(self,
                  data=None,
                  data_is_annotated=False,
@@ -393,6 +467,53 @@ class Source:
             self._check_data()
             self._populate_tensor_cache(output_data_tensor=output_data_tensor)
 
+    def append_data(self, data, **params):
+        """Add events to the currently set data, without re-annotating or
+        re-caching events in batches that are already complete.
+
+        Only the (padded) last batch of the current data is recomputed,
+        together with the new events. Since bounds and dimsizes are computed
+        per batch, the result is the same as calling set_data on the
+        concatenated data.
+
+        :param data: Dataframe with events to add
+        :param params: New defaults, as in set_data
+        """
+        if self.data is None or getattr(self, 'data_tensor', None) is None:
+            return self.set_data(data, **params)
+        self.set_defaults(**params)
+
+        # Batches we can keep as they are: all complete ones.
+        n_keep = self.n_events // self.batch_size
+        i_split = n_keep * self.batch_size
+
+        old_data = self.data[:i_split]
+        old_tensor = self.data_tensor[:n_keep]
+        old_n_events = self.n_events
+        old_dimsizes = {k: np.asarray(v)[:i_split]
+                        for k, v in getattr(self, 'dimsizes', dict()).items()}
+        old_priors_LB = self.prior_PDFs_LB[:n_keep]
+        old_priors_UB = self.prior_PDFs_UB[:n_keep]
+
+        # Annotate the events in the incomplete last batch (minus padding)
+        # together with the new events
+        chunk = pd.concat([self.data[i_split:self.n_events], data],
+                          ignore_index=True)
+        self.prior_PDFs_LB = tuple(dict())
+        self.prior_PDFs_UB = tuple(dict())
+        self.set_data(chunk)
+
+        self.data = pd.concat([old_data, self.data], ignore_index=True)
+        self.data_tensor = tf.concat([old_tensor, self.data_tensor], axis=0)
+        self.n_events = old_n_events + len(data)
+        self.n_batches = n_keep + self.n_batches
+        self.prior_PDFs_LB = old_priors_LB + self.prior_PDFs_LB
+        self.prior_PDFs_UB = old_priors_UB + self.prior_PDFs_UB
+        for k, v in old_dimsizes.items():
+            if k in self.dimsizes:
+                self.dimsizes[k] = np.concatenate(
+                    [v, np.asarray(self.dimsizes[k])])
+
     def _check_data(self):
         """Do any final checks on the self.data dataframe,
         before passing it on to the tensorflow layer.
@@ -654,6 +775,17 @@ class Source:
             self._differential_rate,
             input_signature=input_signature)
 
+    def __getstate__(self):
+        # Traced tensorflow functions cannot be pickled; we recreate the
+        # tf.function on unpickling (e.g. in worker processes)
+        state = self.__dict__.copy()
+        state.pop('_differential_rate_tf', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.trace_differential_rate()
+
     def differential_rate(self, data_tensor=None, autograph=True, **kwargs):
         ptensor = self.ptensor_from_kwargs(**kwargs)
         if autograph and self.trace_difrate:
@@ -703,21 +835,107 @@ class Source:
     ##
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
-                 keep_padding=False, **params):
+                 keep_padding=False, _count_only=False, **params):
         """Simulate n events.
 
         Will omit events lost due to selection/detection efficiencies
+
+        Large simulations are done in chunks, possibly in several processes,
+        see simulate_chunk_size and n_simulate_processes.
+
+        :param _count_only: If True, return only the number of accepted
+            events, without building a DataFrame of them.
         """
         assert isinstance(n_events, (int, float)), \
             f"n_events must be an int or float, not {type(n_events)}"
 
+        n_chunks = self._n_simulation_chunks(n_events)
+        if n_chunks == 1:
+            return self._simulate_chunk(
+                n_events, fix_truth=fix_truth, full_annotate=full_annotate,
+                keep_padding=keep_padding, _count_only=_count_only, **params)
+
+        results = list(self.simulate_chunks(
+            n_events, n_chunks, fix_truth=fix_truth,
+            keep_padding=keep_padding, _count_only=_count_only, **params))
+        if _count_only:
+            return sum(results)
+        d = pd.concat(results, ignore_index=True)
+        if full_annotate:
+            return self.annotate_data(d)
+        return d
+
+    def simulate_chunks(self, n_events, n_chunks=None, **kwargs):
+        """Yield results of simulating n_events in n_chunks chunks,
+        in order. Each chunk uses its own random stream, seeded from the
+        global numpy random state (or the common random numbers seed).
+
+        Chunks are simulated in n_simulate_processes spawned worker
+        processes, if this is more than one; the results do not depend on
+        the number of processes.
+
+        Use this to stream large simulations, e.g. to disk, rather than
+        holding all events in memory at once.
+
+        :param n_events: Total number of events to simulate
+        :param n_chunks: Number of chunks. Defaults to the number implied by
+            simulate_chunk_size and n_simulate_processes.
+        :param kwargs: Passed to simulate for each chunk
+        """
+        if n_chunks is None:
+            n_chunks = self._n_simulation_chunks(n_events)
+        chunk_sizes = np.diff(
+            np.linspace(0, int(n_events), n_chunks + 1).astype(int))
+        tasks = list(zip(chunk_sizes.tolist(), self._chunk_seeds(n_chunks)))
+
+        n_processes = min(self.n_simulate_processes, n_chunks)
+        if (n_processes <= 1
+                # Workers of a pool (e.g. a parallel mu estimator build)
+                # cannot start pools of their own
+                or mp.current_process().daemon):
+            for n, seed in tasks:
+                with self.common_random_numbers(seed):
+                    yield self._simulate_chunk(n, **kwargs)
+            return
+
+        with fd.worker_pool(n_processes, payload=(self, kwargs)) as pool:
+            yield from pool.imap(_simulate_chunk_worker, tasks)
+
+    def _n_simulation_chunks(self, n_events):
+        """Return number of chunks to simulate n_events in"""
+        if self.simulate_chunk_size is None:
+            n_chunks = self.n_simulate_processes
+        else:
+            n_chunks = np.ceil(n_events / self.simulate_chunk_size)
+        return max(1, min(int(n_chunks), int(n_events)))
+
+    def _chunk_seeds(self, n_chunks):
+        """Return list of n_chunks independent integer seeds for
+        simulation chunks"""
+        if self._crn_seed is None:
+            entropy = np.random.randint(2**31)
+        else:
+            # Reuse the same chunk streams for every simulation
+            entropy = self._crn_seed
+        return [int(ss.generate_state(1)[0])
+                for ss in np.random.SeedSequence(entropy).spawn(n_chunks)]
+
+    def _simulate_chunk(self, n_events, fix_truth=None, full_annotate=False,
+                        keep_padding=False, _count_only=False, **params):
+        """Simulate n_events in one go, see simulate for arguments"""
         # Draw random "deep truth" variables (energy, position)
         # Pass on a copy of the dict or DataFrame
         fix_truth = self.validate_fix_truth(fix_truth.copy()
                                             if fix_truth is not None
                                             else None)
+        self._seed_simulation_stage(0)
         sim_data = self.random_truth(n_events, fix_truth=fix_truth, **params)
-        assert isinstance(sim_data, pd.DataFrame)
+        assert isinstance(sim_data, (pd.DataFrame, fd.ColumnarData))
+        if self.columnar_simulation:
+            if isinstance(sim_data, pd.DataFrame):
+                sim_data = fd.ColumnarData.from_frame(sim_data)
+        elif isinstance(sim_data, fd.ColumnarData):
+            sim_data = sim_data.to_frame()
 
         with self._set_temporarily(sim_data, _skip_bounds_computation=True,
                                    keep_padding=keep_padding, **params):
@@ -725,7 +943,16 @@ class Source:
             d = self._simulate_response()
             if 'p_accepted' in d.columns:
                 # Draw which events are accepted
-                d = d.iloc[np.random.rand(len(d)) < d['p_accepted'].values].copy()
+                self._seed_simulation_stage(1)
+                accepted = np.random.rand(len(d)) < d['p_accepted'].values
+                if isinstance(d, fd.ColumnarData):
+                    d = d.compress(accepted)
+                else:
+                    d = d.iloc[accepted].copy()
+            if _count_only:
+                return len(d)
+            if isinstance(d, fd.ColumnarData):
+                d = d.to_frame()
             if full_annotate:
                 # Now that we have s1 and s2 values, we can populate
                 # columns like e_vis, photon_produced_mle, etc.
@@ -734,6 +961,35 @@ class Source:
                 return self.annotate_data(d)
             return d
 
+    @contextmanager
+    def common_random_numbers(self, seed=0):
+        """Context manager in which all simulations use common random numbers:
+        each simulation stage (deep truth, response, acceptance) reseeds the
+        global numpy random state from seed, so repeated simulations with
+        different parameters see the same random draws wherever possible.
+        Differences between such simulations are then mostly due to the
+        parameters, not to fresh randomness.
+
+        The global numpy random state is restored on exit.
+
+        :param seed: Integer seed from which the stage seeds are derived
+        """
+        old_state = np.random.get_state()
+        old_seed = self._crn_seed
+        self._crn_seed = int(seed)
+        try:
+            yield
+        finally:
+            self._crn_seed = old_seed
+            np.random.set_state(old_state)
+
+    def _seed_simulation_stage(self, stage):
+        """Reseed the global numpy random state for simulation stage
+        (an integer), if we are using common random numbers.
+        """
+        if self._crn_seed is not None:
+            np.random.seed([self._crn_seed, stage])
+
     def validate_fix_truth(self, fix_truth):
         """Return checked fix truth, with extra derived variables if needed"""
         return fix_truth
@@ -754,9 +1010,12 @@ class Source:
         """Return estimate of total expected number of events
         :param n_trials: Number of events to simulate for estimate
         """
-        d_simulated = self.simulate(n_trials, **params)
+        n_accepted = self.simulate(n_trials, _count_only=True, **params)
+        if isinstance(n_accepted, pd.DataFrame):
+            # simulate was overriden by a method that ignores _count_only
+            n_accepted = len(n_accepted)
         return (self.mu_before_efficiencies(**params)
-                * len(d_simulated) / n_trials)
+                * n_accepted / n_trials)
 
     ##
     # Functions you have to override
@@ -830,3 +1089,15 @@ class ColumnSource(Source):
 
     def _differential_rate(self, data_tensor, ptensor):
         return self._fetch(self.column, data_tensor)
+
+
+def _simulate_chunk_worker(task):
+    """Simulate one chunk for Source.simulate_chunks in a worker process,
+    whose payload is the (source, simulate kwargs) tuple.
+
+    :param task: (number of events, seed) tuple
+    """
+    source, kwargs = fd.worker_payload()
+    n_events, seed = task
+    with source.common_random_numbers(seed):
+        return source._simulate_chunk(n_events, **kwargs)
@@ -1,9 +1,12 @@
+from copy import deepcopy
+import itertools
+import json
 import random
 import string
 
 from multihist import Histdd
 import pandas as pd
-from scipy.interpolate import interp2d
+import tensorflow as tf
 
 import numpy as np
 
@@ -11,6 +14,9 @@ import flamedisx as fd
 
 export, __all__ = fd.exporter()
 
+#: Version of the file format written by build_template_source
+TEMPLATE_FILE_VERSION = 1
+
 
 @export
 class TemplateSource(fd.ColumnSource):
@@ -26,6 +32,13 @@ class TemplateSource(fd.ColumnSource):
             If None, get this info from template.
         - events_per_bin: set to True if template specifies expected events per
             bin, rather than differential rate.
+        - interpolate: if True, interpolate the differential rate linearly
+            between bin centers, rather than using the value of the bin
+            containing each event.
+        - interp_2d: alias for interpolate, kept for backwards compatibility.
+        - in_graph: if True, evaluate the template in the tensorflow graph
+            from the observables, rather than storing the differential rate
+            of each event in a data column during annotation.
 
     For other arguments, see flamedisx.source.Source
     """
@@ -38,37 +51,15 @@ class TemplateSource(fd.ColumnSource):
             axis_names=None,
             events_per_bin=False,
             *args,
+            interpolate=False,
+            in_graph=False,
             **kwargs):
-        # Get template, bin_edges, and axis_names
-        if bin_edges is None:
-            # Hopefully we got some kind of histogram container
-            if isinstance(template, tuple) and len(template) == 2:
-                # (hist, bin_edges) tuple, e.g. from np.histdd
-                template, bin_edges = template
-            elif hasattr(template, "to_numpy"):
-                # boost_histogram / hist
-                if not axis_names:
-                    axis_names = [ax.name for ax in template.axes]
-                template, bin_edges = template.to_numpy()
-            elif hasattr(template, "bin_edges"):
-                # multihist
-                if not axis_names:
-                    axis_names = template.axis_names
-                template, bin_edges = template.histogram, template.bin_edges
-            else:
-                raise ValueError("Need histogram, bin_edges, and axis_names")
-
-        if not axis_names or len(axis_names) != len(template.shape):
-            raise ValueError("Axis names missing or mismatched")
+        template, bin_edges, axis_names = _parse_template(
+            template, bin_edges, axis_names)
         self.final_dimensions = axis_names
 
-        if interp_2d:
-            assert len(self.final_dimensions) == 2, "Interpolation only supported for 2D histogram!"
-            centers_dim_1 = 0.5 * (bin_edges[0][1:] + bin_edges[0][:-1])
-            centers_dim_2 = 0.5 * (bin_edges[1][1:] + bin_edges[1][:-1])
-            self.interp_2d = interp2d(centers_dim_1, centers_dim_2, np.transpose(template))
-        else:
-            self.interp_2d = None
+        self.interpolate = interpolate or interp_2d
+        self.in_graph = in_graph
 
         # Build a diff rate and events/bin multihist from the template
         _mh = Histdd.from_histogram(template, bin_edges=bin_edges)
@@ -81,6 +72,13 @@ class TemplateSource(fd.ColumnSource):
 
         self.mu = fd.np_to_tf(self._mh_events_per_bin.n)
 
+        # Tensors for evaluating the template in the graph
+        self._bin_edges_tf = [
+            fd.np_to_tf(x) for x in self._mh_diff_rate.bin_edges]
+        self._bin_centers_tf = [
+            fd.np_to_tf(x) for x in self._mh_diff_rate.bin_centers()]
+        self._diff_rate_tf = fd.np_to_tf(self._mh_diff_rate.histogram)
+
         # Generate a random column name to use to store the diff rates
         # of observed events
         self.column = (
@@ -89,16 +87,36 @@ class TemplateSource(fd.ColumnSource):
 
         super().__init__(*args, **kwargs)
 
+    def extra_needed_columns(self):
+        if self.in_graph:
+            # Skip the precomputed differential rate column
+            return super(fd.ColumnSource, self).extra_needed_columns()
+        return super().extra_needed_columns()
+
     def _annotate(self):
         """Add columns needed in inference to self.data
         """
-        if self.interp_2d is not None:
-            self.data[self.column] = np.array([self.interp_2d(r[self.data.columns.get_loc(self.final_dimensions[0])],
-                                                              r[self.data.columns.get_loc(self.final_dimensions[1])])[0]
-                                               for r in self.data.itertuples(index=False)])
+        if self.in_graph:
+            return
+        coordinates = [self.data[x].values for x in self.final_dimensions]
+        if self.interpolate:
+            self.data[self.column] = multilinear_interpolate(
+                coordinates,
+                self._mh_diff_rate.bin_centers(),
+                self._mh_diff_rate.histogram)
         else:
-            self.data[self.column] = self._mh_diff_rate.lookup(
-                *[self.data[x] for x in self.final_dimensions])
+            self.data[self.column] = self._mh_diff_rate.lookup(*coordinates)
+
+    def _differential_rate(self, data_tensor, ptensor):
+        if not self.in_graph:
+            return super()._differential_rate(data_tensor, ptensor)
+        coordinates = [self._fetch(x, data_tensor)
+                       for x in self.final_dimensions]
+        if self.interpolate:
+            return tf_multilinear_interpolate(
+                coordinates, self._bin_centers_tf, self._diff_rate_tf)
+        return tf_histogram_lookup(
+            coordinates, self._bin_edges_tf, self._diff_rate_tf)
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
                  keep_padding=False, **params):
@@ -115,3 +133,414 @@ class TemplateSource(fd.ColumnSource):
         return pd.DataFrame(dict(zip(
             self.final_dimensions,
             self._mh_events_per_bin.get_random(n_events).T)))
+
+
+@export
+class MorphedTemplateSource(TemplateSource):
+    """Template source whose shape depends on parameters. The differential
+    rate is interpolated bin by bin ("vertical morphing") between templates
+    made at the points of a grid of parameter values. Morphing happens in
+    the tensorflow graph, so the parameters can be fitted like any other.
+
+    Use fd.TemplateMorphMu as the mu estimator, to get the exact expected
+    number of events of the morphed template.
+
+    Arguments:
+        - templates: templates at each point of the parameter grid. Either
+            nested sequences (one level per parameter) of anything
+            TemplateSource accepts as a template, or an array of shape
+            (grid shape + histogram shape), in which case bin_edges and
+            axis_names must be given. All templates must have the same bins.
+        - param_grid: dictionary {parameter name: sorted array of values},
+            in the order of the template nesting (or array axes).
+        - param_defaults: dictionary {parameter name: default value}.
+            Omitted parameters default to the middle of their grid range.
+
+    Outside the grid, the template at the nearest grid edge is used.
+    For other arguments, see TemplateSource.
+    """
+
+    def __init__(
+            self,
+            templates,
+            param_grid,
+            bin_edges=None,
+            axis_names=None,
+            events_per_bin=False,
+            *args,
+            param_defaults=None,
+            interpolate=False,
+            **kwargs):
+        self.param_grid = {pname: np.asarray(grid, dtype=float)
+                           for pname, grid in param_grid.items()}
+        grid_shape = tuple(len(grid) for grid in self.param_grid.values())
+
+        if isinstance(templates, np.ndarray) and templates.dtype != object:
+            if bin_edges is None or not axis_names:
+                raise ValueError(
+                    "Need bin_edges and axis_names for an array of templates")
+            histograms = templates
+        else:
+            for _ in grid_shape[1:]:
+                templates = sum([list(t) for t in templates], [])
+            parsed = [_parse_template(t, bin_edges, axis_names)
+                      for t in templates]
+            _, bin_edges, axis_names = parsed[0]
+            for _, other_edges, _ in parsed[1:]:
+                if not all(np.array_equal(a, b)
+                           for a, b in zip(bin_edges, other_edges)):
+                    raise ValueError("Templates must have the same bins")
+            histograms = np.stack([p[0] for p in parsed])
+            histograms = histograms.reshape(grid_shape + histograms.shape[1:])
+        if histograms.shape[:len(grid_shape)] != grid_shape:
+            raise ValueError(
+                f"Templates of shape {histograms.shape} do not match "
+                f"the parameter grid of shape {grid_shape}")
+
+        bin_volumes = Histdd.from_histogram(
+            histograms[(0,) * len(grid_shape)],
+            bin_edges=bin_edges).bin_volumes()
+        if events_per_bin:
+            self._events_per_bin_templates = histograms
+        else:
+            self._events_per_bin_templates = histograms * bin_volumes
+        self._grid_tf = [fd.np_to_tf(grid)
+                         for grid in self.param_grid.values()]
+        self._diff_rate_templates_tf = fd.np_to_tf(
+            self._events_per_bin_templates / bin_volumes)
+
+        self.param_defaults = {pname: 0.5 * (grid[0] + grid[-1])
+                               for pname, grid in self.param_grid.items()}
+        if param_defaults is not None:
+            self.param_defaults.update(param_defaults)
+
+        super().__init__(
+            self.morph(**self.param_defaults),
+            False,
+            bin_edges,
+            axis_names,
+            True,
+            *args,
+            interpolate=interpolate,
+            in_graph=True,
+            **kwargs)
+
+    def scan_model_functions(self):
+        super().scan_model_functions()
+        for pname, value in self.param_defaults.items():
+            self.defaults[pname] = tf.convert_to_tensor(
+                value, dtype=fd.float_type())
+
+    def morph(self, **params):
+        """Return numpy array with the expected events per bin of the
+        template morphed to params (omitted params are set to defaults)
+        """
+        points = [np.atleast_1d(params[pname] if pname in params
+                                else self.defaults[pname])
+                  for pname in self.param_grid]
+        return multilinear_interpolate(
+            points,
+            list(self.param_grid.values()),
+            self._events_per_bin_templates)[0]
+
+    def _differential_rate(self, data_tensor, ptensor):
+        points = [tf.reshape(self._fetch_param(pname, ptensor), (1,))
+                  for pname in self.param_grid]
+        diff_rate = tf_multilinear_interpolate(
+            points, self._grid_tf, self._diff_rate_templates_tf)[0]
+        coordinates = [self._fetch(x, data_tensor)
+                       for x in self.final_dimensions]
+        if self.interpolate:
+            return tf_multilinear_interpolate(
+                coordinates, self._bin_centers_tf, diff_rate)
+        return tf_histogram_lookup(
+            coordinates, self._bin_edges_tf, diff_rate)
+
+    def mu_before_efficiencies(self, **params):
+        return fd.np_to_tf(np.sum(self.morph(**params)))
+
+    def estimate_mu(self, n_trials=None, **params):
+        return self.mu_before_efficiencies(**params)
+
+    def simulate(self, n_events, fix_truth=None, full_annotate=False,
+                 keep_padding=False, **params):
+        """Simulate n events from the template morphed to params
+        """
+        if fix_truth:
+            raise NotImplementedError(
+                "MorphedTemplateSource does not yet support fix_truth")
+        assert isinstance(n_events, (int, float)), \
+            f"n_events must be an int or float, not {type(n_events)}"
+        mh = Histdd.from_histogram(self.morph(**params),
+                                   bin_edges=self._mh_diff_rate.bin_edges)
+        return pd.DataFrame(dict(zip(
+            self.final_dimensions,
+            mh.get_random(n_events).T)))
+
+
+def _parse_template(template, bin_edges=None, axis_names=None):
+    """Return (histogram, bin_edges, axis_names) from a template,
+    see TemplateSource for the accepted formats.
+    """
+    if bin_edges is None:
+        # Hopefully we got some kind of histogram container
+        if isinstance(template, tuple) and len(template) == 2:
+            # (hist, bin_edges) tuple, e.g. from np.histdd
+            template, bin_edges = template
+        elif hasattr(template, "to_numpy"):
+            # boost_histogram / hist
+            if not axis_names:
+                axis_names = [ax.name for ax in template.axes]
+            template, bin_edges = template.to_numpy()
+        elif hasattr(template, "bin_edges"):
+            # multihist
+            if not axis_names:
+                axis_names = template.axis_names
+            template, bin_edges = template.histogram, template.bin_edges
+        else:
+            raise ValueError("Need histogram, bin_edges, and axis_names")
+
+    if not axis_names or len(axis_names) != len(template.shape):
+        raise ValueError("Axis names missing or mismatched")
+    return template, bin_edges, axis_names
+
+
+def _interpolation_weights(x, grid):
+    """Return (lower index, upper index, weight of upper index) arrays
+    for linear interpolation of x on the sorted 1d grid.
+    Coordinates outside the grid are clipped to it.
+    """
+    n = len(grid)
+    x = np.clip(x, grid[0], grid[-1])
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, max(n - 2, 0))
+    i_up = np.minimum(i + 1, n - 1)
+    dx = grid[i_up] - grid[i]
+    # Grids with a single point have dx = 0
+    w = np.where(dx > 0, (x - grid[i]) / np.where(dx > 0, dx, 1), 0)
+    return i, i_up, w
+
+
+def _tf_interpolation_weights(x, grid):
+    """Tensorflow version of _interpolation_weights"""
+    n = grid.shape[0]
+    x = tf.clip_by_value(tf.cast(x, dtype=grid.dtype), grid[0], grid[-1])
+    i = tf.clip_by_value(
+        tf.searchsorted(grid, x, side='right') - 1, 0, max(n - 2, 0))
+    i_up = tf.minimum(i + 1, n - 1)
+    x_low, x_up = tf.gather(grid, i), tf.gather(grid, i_up)
+    dx = x_up - x_low
+    w = tf.where(dx > 0,
+                 (x - x_low) / tf.where(dx > 0, dx, tf.ones_like(dx)),
+                 tf.zeros_like(dx))
+    return i, i_up, w
+
+
+@export
+def multilinear_interpolate(points, grid, values):
+    """Return values interpolated (n-)linearly on a rectilinear grid.
+    Points outside the grid get the value at the nearest point on the grid.
+
+    :param points: sequence of n arrays with coordinates, one per dimension
+    :param grid: sequence of n sorted 1d arrays with grid coordinates,
+        e.g. histogram bin centers
+    :param values: array of values on the grid. If this has more than n
+        dimensions, the trailing dimensions are interpolated independently,
+        e.g. to interpolate between histograms.
+    """
+    weights = [_interpolation_weights(np.asarray(x), np.asarray(g))
+               for x, g in zip(points, grid)]
+    n_trailing = len(values.shape) - len(weights)
+    result = 0
+    for corner in itertools.product((0, 1), repeat=len(weights)):
+        index = tuple(w[c] for w, c in zip(weights, corner))
+        weight = np.prod([w[2] if c else 1 - w[2]
+                          for w, c in zip(weights, corner)], axis=0)
+        weight = np.reshape(weight, weight.shape + (1,) * n_trailing)
+        result = result + weight * values[index]
+    return result
+
+
+@export
+def tf_multilinear_interpolate(points, grid, values):
+    """Tensorflow version of multilinear_interpolate
+
+    :param points: sequence of n tensors with coordinates, one per dimension
+    :param grid: sequence of n sorted 1d tensors with grid coordinates
+    :param values: tensor of values on the grid, possibly with trailing
+        dimensions that are interpolated independently
+    """
+    weights = [_tf_interpolation_weights(x, g)
+               for x, g in zip(points, grid)]
+    n_trailing = len(values.shape) - len(weights)
+    result = 0
+    for corner in itertools.product((0, 1), repeat=len(weights)):
+        index = tf.stack([w[c] for w, c in zip(weights, corner)], axis=-1)
+        weight = tf.reduce_prod(
+            tf.stack([w[2] if c else 1 - w[2]
+                      for w, c in zip(weights, corner)], axis=0),
+            axis=0)
+        weight = tf.reshape(
+            weight,
+            tf.concat([tf.shape(weight),
+                       tf.ones(n_trailing, dtype=tf.int32)], axis=0))
+        result = result + weight * tf.gather_nd(values, index)
+    return result
+
+
+@export
+def tf_histogram_lookup(points, bin_edges, histogram):
+    """Tensorflow version of multihist.Histdd.lookup: return values of the
+    histogram bins containing points. Out-of-range points are clipped.
+
+    :param points: sequence of n tensors with coordinates, one per dimension
+    :param bin_edges: sequence of n 1d tensors with bin edges
+    :param histogram: n-dimensional tensor with the histogram
+    """
+    index = tf.stack([
+        tf.clip_by_value(
+            tf.searchsorted(edges, tf.cast(x, dtype=edges.dtype)) - 1,
+            0, edges.shape[0] - 2)
+        for x, edges in zip(points, bin_edges)], axis=-1)
+    return tf.gather_nd(histogram, index)
+
+
+@export
+def observables_grid(source, centers, n_truth_samples=10):
+    """Return DataFrame combining each point of a grid in the observables
+    with each of n_truth_samples draws of the other deep-truth variables
+    (e.g. positions and times) from source.random_truth.
+
+    Rows are ordered as an array of shape
+    (n_truth_samples, len(centers[dim_0]), len(centers[dim_1]), ...)
+
+    :param source: Source to draw deep-truth variables from
+    :param centers: dictionary {dimension: 1d array of grid points}
+    :param n_truth_samples: number of deep-truth samples
+    """
+    dims = list(centers.keys())
+    truth = source.random_truth(n_truth_samples)
+    truth = truth.drop(columns=dims, errors='ignore')
+    grid = np.meshgrid(*centers.values(), indexing='ij')
+    data = pd.DataFrame({
+        dim: np.tile(x.ravel(), n_truth_samples)
+        for dim, x in zip(dims, grid)})
+    i_truth = np.repeat(np.arange(n_truth_samples), grid[0].size)
+    for col in truth.columns:
+        data[col] = truth[col].values[i_truth]
+    return data
+
+
+@export
+def build_template_source(source, bin_edges,
+                          method='simulate',
+                          n_events=int(1e6),
+                          n_truth_samples=10,
+                          filename=None,
+                          **kwargs):
+    """Return a TemplateSource approximating source at its current
+    defaults, with a histogram of expected events in the observables.
+
+    :param source: Source to approximate
+    :param bin_edges: dictionary {final dimension: bin edges}
+    :param method: How to build the histogram:
+        - 'simulate': simulate n_events events, in chunks. Set
+          n_simulate_processes on the source to simulate in parallel.
+        - 'quadrature': evaluate the differential rate at bin centers,
+          averaged over n_truth_samples draws of the other deep-truth
+          variables, times the bin volumes. This is deterministic, but
+          only accurate if the rate varies little within each bin. Set
+          n_annotate_processes on the source to annotate in parallel.
+    :param n_events: Number of events to simulate for method='simulate'
+    :param n_truth_samples: Number of deep-truth samples for
+        method='quadrature'
+    :param filename: If given, save the template to this .npz file,
+        which load_template_source can read.
+    :param kwargs: Passed to TemplateSource, e.g. batch_size or interpolate
+
+    Events outside the bins are not in the template, so the template mu
+    is the expected number of events inside the bins.
+    """
+    dims = tuple(source.final_dimensions)
+    if set(bin_edges.keys()) != set(dims):
+        raise ValueError(f"Need bin edges for exactly {dims}")
+    bin_edges = [np.asarray(bin_edges[dim], dtype=float) for dim in dims]
+    shape = tuple(len(e) - 1 for e in bin_edges)
+
+    if method == 'simulate':
+        events_per_bin = np.zeros(shape)
+        for d in source.simulate_chunks(n_events):
+            events_per_bin += np.histogramdd(
+                np.stack([d[dim].values for dim in dims], axis=1),
+                bins=bin_edges)[0]
+        events_per_bin *= (float(source.mu_before_efficiencies())
+                           / int(n_events))
+    elif method == 'quadrature':
+        centers = {dim: 0.5 * (e[1:] + e[:-1])
+                   for dim, e in zip(dims, bin_edges)}
+        data = observables_grid(source, centers, n_truth_samples)
+        # Evaluate the grid like data, on a copy of the source
+        s = deepcopy(source)
+        if 'check_acceptances' in s.model_attributes:
+            # Bins below thresholds have zero rate, that's fine here
+            s.check_acceptances = False
+        s.set_data(data)
+        rates = s.batched_differential_rate(progress=False)
+        events_per_bin = (
+            rates.reshape((n_truth_samples,) + shape).mean(axis=0)
+            * Histdd.from_histogram(np.zeros(shape),
+                                    bin_edges=bin_edges).bin_volumes())
+    else:
+        raise ValueError(f"Unknown template building method {method}")
+
+    metadata = dict(
+        file_version=TEMPLATE_FILE_VERSION,
+        flamedisx_version=fd.__version__,
+        source_class=(f'{source.__class__.__module__}.'
+                      f'{source.__class__.__qualname__}'),
+        source_settings=fd.deterministic_hash(source.settings_key()),
+        method=method,
+        n_events=int(n_events) if method == 'simulate' else None,
+        n_truth_samples=n_truth_samples if method == 'quadrature' else None,
+        mu=float(events_per_bin.sum()))
+
+    if filename is not None:
+        np.savez(filename,
+                 events_per_bin=events_per_bin,
+                 axis_names=np.asarray(dims),
+                 metadata=json.dumps(metadata),
+                 **{f'bin_edges_{i}': e for i, e in enumerate(bin_edges)})
+
+    result = TemplateSource(events_per_bin,
+                            bin_edges=bin_edges,
+                            axis_names=dims,
+                            events_per_bin=True,
+                            **kwargs)
+    result.template_metadata = metadata
+    return result
+
+
+@export
+def load_template_source(filename, **kwargs):
+    """Return TemplateSource from a file saved by build_template_source
+
+    :param filename: .npz file with the template
+    :param kwargs: Passed to TemplateSource, e.g. batch_size or interpolate
+    """
+    with np.load(filename) as f:
+        metadata = json.loads(str(f['metadata']))
+        if metadata['file_version'] > TEMPLATE_FILE_VERSION:
+            raise ValueError(
+                f"{filename} has template file version "
+                f"{metadata['file_version']}, this flamedisx only reads "
+                f"versions up to {TEMPLATE_FILE_VERSION}")
+        axis_names = tuple(f['axis_names'].tolist())
+        bin_edges = [f[f'bin_edges_{i}'] for i in range(len(axis_names))]
+        events_per_bin = f['events_per_bin']
+
+    result = TemplateSource(events_per_bin,
+                            bin_edges=bin_edges,
+                            axis_names=axis_names,
+                            events_per_bin=True,
+                            **kwargs)
+    result.template_metadata = metadata
+    return result
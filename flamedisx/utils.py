@@ -1,3 +1,5 @@
+import multiprocessing as mp
+import os
 from pathlib import Path
 import subprocess
 
@@ -294,3 +296,114 @@ def filter_kwargs(func, kwargs):
         # if func accepts wildcard kwargs, return all
         return kwargs
     return {k: v for k, v in kwargs.items() if k in params}
+
+
+class _Column(np.ndarray):
+    """Numpy array that, like a pandas Series, has a .values attribute"""
+
+    @property
+    def values(self):
+        return self.view(np.ndarray)
+
+
+# Payload of the worker_pool this process is a worker of
+_worker_payload = None
+
+
+def _set_worker_payload(payload):
+    global _worker_payload
+    _worker_payload = payload
+
+
+@export
+def worker_pool(n_processes, payload=None):
+    """Return a multiprocessing pool of n_processes spawned workers.
+
+    TensorFlow deadlocks in forked processes once it has been initialized,
+    which happens as soon as a source is created. Spawned workers start a
+    fresh interpreter instead, and receive their arguments by pickling.
+
+    :param payload: object needed by all tasks, e.g. a source. Each worker
+        receives it once, by pickling, rather than with every task.
+        Tasks get it with fd.worker_payload().
+    """
+    return mp.get_context('spawn').Pool(
+        n_processes, initializer=_set_worker_payload, initargs=(payload,))
+
+
+@export
+def worker_payload():
+    """Return the payload of the worker_pool this process is a worker of"""
+    return _worker_payload
+
+
+@export
+def save_atomically(fn, save):
+    """Call save(temporary filename), then move the result to fn,
+    so other processes never see a partially written file"""
+    temp_fn = fn + f'.{os.getpid()}.tmp'
+    save(temp_fn)
+    os.replace(temp_fn, fn)
+
+
+@export
+class ColumnarData:
+    """Minimal dict-of-arrays stand-in for a pandas DataFrame,
+    used to simulate events without pandas overhead.
+
+    Supports the DataFrame features used in block simulation code:
+    getting and setting columns (scalars are broadcast), .values on
+    columns, .columns, len, copy, and slicing rows with data[a:b].
+    """
+
+    def __init__(self, columns=None, n_rows=None):
+        self._columns = dict()
+        if n_rows is None:
+            n_rows = len(next(iter(columns.values()))) if columns else 0
+        self.n_rows = int(n_rows)
+        for k, v in (columns or dict()).items():
+            self[k] = v
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame):
+        return cls({k: df[k].values for k in df.columns}, n_rows=len(df))
+
+    def to_frame(self):
+        return pd.DataFrame({k: v.values for k, v in self._columns.items()})
+
+    @property
+    def columns(self):
+        return list(self._columns.keys())
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ColumnarData(
+                {k: v.values[key] for k, v in self._columns.items()},
+                n_rows=len(range(*key.indices(self.n_rows))))
+        return self._columns[key]
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value)
+        if value.shape[:1] != (self.n_rows,):
+            value = np.broadcast_to(value, (self.n_rows,) + value.shape).copy()
+        self._columns[key] = value.view(_Column)
+
+    def __delitem__(self, key):
+        del self._columns[key]
+
+    def copy(self):
+        return ColumnarData(
+            {k: v.values.copy() for k, v in self._columns.items()},
+            n_rows=self.n_rows)
+
+    def compress(self, mask):
+        """Return ColumnarData with only the rows where mask is True"""
+        return ColumnarData(
+            {k: v.values[mask] for k, v in self._columns.items()},
+            n_rows=np.sum(mask))
@@ -66,7 +66,15 @@ s1_map, s2_map = [
 ##
 
 
-class SR0Source:
+@export
+class XENON1TSource:
+    """Settings shared by the XENON1T SR0 and SR1 sources"""
+    # Simulate with pandas: add_extra_columns uses detector maps
+    # that have not been checked with columnar (fd.ColumnarData) input
+    columnar_simulation = False
+
+
+class SR0Source(XENON1TSource):
     # TODO: add p_el_sr0
 
     def random_truth(self, n_events, fix_truth=None, **params):
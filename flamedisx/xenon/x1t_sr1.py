@@ -154,7 +154,7 @@ def construct_exponential_r_spatial_hist(n = 2e6, max_r = 42.8387,
 ##
 # Flamedisx sources
 ##
-class SR1Source:
+class SR1Source(fd.XENON1TSource):
     model_attributes = ('s2_area_fraction_top',
                         'path_cut_accept_s1',
                         'path_cut_accept_s2',
@@ -0,0 +1,30 @@
+import numpy as np
+from multihist import Histdd
+import pytest
+
+import flamedisx as fd
+
+
+def template(loc):
+    h = Histdd(bins=[np.linspace(0, 10, 11), np.linspace(0, 10, 11)],
+               axis_names=['s1', 's2'])
+    h.add(*np.random.normal(loc, 2, size=(2, 10000)).clip(0, 9.9))
+    return h / h.n * 10
+
+
+@pytest.fixture
+def template_model():
+    """Sources and arguments of a signal and background TemplateSource"""
+    np.random.seed(0)
+    return dict(sources=dict(sig=fd.TemplateSource, bkg=fd.TemplateSource),
+                arguments=dict(sig=dict(template=template(3)),
+                               bkg=dict(template=template(6))))
+
+
+@pytest.fixture
+def template_lf(template_model):
+    """LogLikelihood of template_model, with free signal and background
+    rates"""
+    return fd.LogLikelihood(**template_model,
+                            free_rates=('sig', 'bkg'),
+                            batch_size=10)
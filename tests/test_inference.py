@@ -153,3 +153,86 @@ def test_bestfit_scipy(xes):
     bestfit = lf.bestfit(guess, optimizer='scipy')
     assert isinstance(bestfit, dict)
     assert len(bestfit) == 2
+
+
+def test_batched_bestfit(template_lf):
+    np.random.seed(1)
+    lf = template_lf
+    toys = [lf.simulate(sig_rate_multiplier=mu) for mu in (0.5, 1., 3.)]
+    toys.append(toys[0].iloc[:0])
+    lf.set_data(toys[1])
+    ll, guess = lf(), lf.guess()
+
+    results = lf.batched_bestfit(toys)
+    results_fixed = lf.batched_bestfit(toys, fix=dict(bkg_rate_multiplier=1.))
+    # The likelihood's data is restored afterwards
+    assert lf() == ll and lf.guess() == guess
+    assert lf.sources['sig'].n_events == len(toys[1])
+    # All datasets are evaluated in one traced call per iteration;
+    # fixing a parameter needs a second trace
+    assert lf._batched_log_likelihood.experimental_get_tracing_count() == 2
+
+    # Results match fits of the individual datasets
+    assert len(results) == len(results_fixed) == len(toys)
+    for toy, result, result_fixed in zip(toys[:-1], results, results_fixed):
+        lf.set_data(toy)
+        for r, kwargs in ((result, dict()),
+                          (result_fixed, dict(fix=dict(bkg_rate_multiplier=1.)))):
+            bestfit = lf.bestfit(**kwargs)
+            for k, v in bestfit.items():
+                np.testing.assert_allclose(r[k], v, rtol=1e-2)
+
+    # Without events, both rates go to their lower bound
+    for v in results[-1].values():
+        assert v == fd.LOWER_RATE_MULTIPLIER_BOUND
+
+    # Fixed parameters are returned unchanged
+    assert all(r['bkg_rate_multiplier'] == 1. for r in results_fixed)
+
+
+def test_bestfit_newton(template_lf):
+    np.random.seed(1)
+    lf = template_lf
+    lf.set_data(lf.simulate())
+
+    for kwargs in (dict(), dict(fix=dict(bkg_rate_multiplier=1.))):
+        bestfit = lf.bestfit(optimizer='newton', **kwargs)
+        bestfit_scipy = lf.bestfit(optimizer='scipy', **kwargs)
+        for k, v in bestfit_scipy.items():
+            np.testing.assert_allclose(bestfit[k], v, rtol=1e-2)
+
+    # The unconstrained best fit is outside the bounds,
+    # so we should end on the bound
+    assert bestfit['sig_rate_multiplier'] > 0.5
+    bestfit = lf.bestfit(optimizer='newton',
+                         bounds=dict(sig_rate_multiplier=(0.1, 0.5)))
+    np.testing.assert_allclose(bestfit['sig_rate_multiplier'], 0.5)
+    bestfit_scipy = lf.bestfit(optimizer='scipy',
+                               fix=dict(sig_rate_multiplier=0.5))
+    np.testing.assert_allclose(bestfit['bkg_rate_multiplier'],
+                               bestfit_scipy['bkg_rate_multiplier'],
+                               rtol=1e-2)
+
+    # Errors are estimated from the Hessian at the best fit
+    bestfit, errors = lf.bestfit(optimizer='newton', return_errors=True)
+    cov = 2 * lf.inverse_hessian(bestfit)
+    np.testing.assert_allclose(
+        [errors['error_' + k] for k in lf.param_names],
+        np.diag(cov) ** 0.5,
+        rtol=1e-2)
+
+    # The minimizer is traced once per set of free parameters,
+    # regardless of the optimizer options
+    lf.bestfit(optimizer='newton', optimizer_kwargs=dict(max_iterations=50))
+    assert lf._minimize_newton.experimental_get_tracing_count() == 2
+
+
+def test_bestfit_hvp(template_lf):
+    np.random.seed(1)
+    lf = template_lf
+    lf.set_data(lf.simulate())
+
+    bestfit = lf.bestfit(use_hessian='hvp')
+    bestfit_hessian = lf.bestfit(use_hessian=True)
+    for k, v in bestfit_hessian.items():
+        np.testing.assert_allclose(bestfit[k], v, rtol=1e-2)
@@ -343,3 +343,39 @@ def test_hessian_rate_and_shape(xes: fd.ERSource):
     a = inv_hess[0, 1]
     b = inv_hess[1, 0]
     assert abs(a - b)/(a+b) < 1e-3
+
+
+def test_hessian_vector_product(xes: fd.ERSource):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        elife=(100e3, 500e3, 5),
+        free_rates='er',
+        data=xes.data)
+
+    guess = lf.guess()
+    ll, grad, hess = lf.log_likelihood(second_order=True, **guess)
+    vector = np.array([0.3, 1e-5])
+    ll_2, grad_2, hvp = lf.log_likelihood(hvp_vector=vector, **guess)
+    np.testing.assert_allclose(ll_2, ll, rtol=1e-5)
+    # float32 noise on near-zero components
+    np.testing.assert_allclose(grad_2, grad, rtol=1e-3, atol=1e-4)
+    np.testing.assert_allclose(hvp, hess @ vector, rtol=1e-3, atol=1e-4)
+
+    # Omitted gradients are omitted from the product too
+    _, _, hvp = lf.log_likelihood(hvp_vector=[1.], omit_grads=('elife',),
+                                  **guess)
+    np.testing.assert_allclose(hvp, hess[:1, 0], rtol=1e-3)
+
+
+def test_append_data(xes: fd.ERSource):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        data=xes.data.copy(),
+        batch_size=2)
+    n_batches = lf.sources['er'].n_batches
+
+    lf.append_data(xes.data.copy())
+    assert lf.sources['er'].n_events == 2 * len(xes.data)
+    assert lf.batch_info.numpy()[0, 0] == lf.sources['er'].n_batches
+    assert lf.data_tensors[DEFAULT_DSETNAME].shape[0] == 2 * n_batches
+    lf()
@@ -9,7 +9,11 @@ arg_names = ['er_rate_multplier', 'elife']
 truth_test = np.array([2., 3.])
 
 
-@pytest.fixture(params=list(fd.SUPPORTED_OPTIMIZERS.values()))
+# The Newton optimizer evaluates the likelihood inside its own tensorflow
+# graph, so it cannot be mocked by overriding _inner_fun_and_grad
+@pytest.fixture(params=[objective
+                        for name, objective in fd.SUPPORTED_OPTIMIZERS.items()
+                        if name != 'newton'])
 def mock_objective(request):
 
     class MockObjective(request.param):
@@ -1,3 +1,5 @@
+from functools import partial
+
 import numpy as np
 import pandas as pd
 import tensorflow as tf
@@ -122,3 +124,135 @@ def test_grid_interpolation():
     mu_est_corner = -ll(x=-1, y=-1)
 
     assert np.isclose(mu_est_corner, mu_func(-1, -1))
+
+
+def test_common_random_numbers():
+    source = fd.ERSource()
+    est = fd.ConstantMu(source, n_trials=int(1e3), progress=False,
+                        common_random_numbers=True)
+
+    # Simulations reuse the same random numbers, and leave
+    # the global random state alone
+    np.random.seed(42)
+    state = np.random.get_state()[1].copy()
+    mu_1 = est.estimate_mu(source, elife=500e3)
+    mu_2 = est.estimate_mu(source, elife=500e3)
+    assert mu_1 == mu_2
+    assert np.all(np.random.get_state()[1] == state)
+
+    # Simulation with a small parameter change differs only a little
+    mu_3 = est.estimate_mu(source, elife=501e3)
+    assert abs(mu_3 - mu_1) / mu_1 < 1e-2
+
+
+def test_parallel_cached_build(tmp_path):
+    def make_ll(**kwargs):
+        return fd.LogLikelihood(**ll_options, mu_estimators=partial(
+            fd.GridInterpolatedMu, cache_dir=str(tmp_path), **kwargs))
+
+    # Simulations in worker processes give the same grid
+    ll_serial = fd.LogLikelihood(**ll_options,
+                                 mu_estimators=fd.GridInterpolatedMu)
+    ll = make_ll(n_processes=2)
+    assert np.allclose(ll.mu_estimators['bla'].mu_grid,
+                       ll_serial.mu_estimators['bla'].mu_grid)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # The second build is loaded from the cache
+    build = fd.GridInterpolatedMu.build
+    try:
+        def fail(*args, **kwargs):
+            raise RuntimeError("Estimator was rebuilt")
+        fd.GridInterpolatedMu.build = fail
+        ll_cached = make_ll()
+    finally:
+        fd.GridInterpolatedMu.build = build
+    assert ll_cached(x=0.5, y=0.3) == ll(x=0.5, y=0.3)
+
+
+def test_adaptive_interpolation():
+    class CurvedMuSource(MuTestSource):
+        def our_mu(self, x=0, y=0):
+            return 42 + 10 * np.exp(-10 * x**2) + y
+
+    opts = {**ll_options, 'sources': dict(bla=CurvedMuSource)}
+    for mu_est in (fd.AdaptiveCrossInterpolatedMu,
+                   fd.AdaptiveGridInterpolatedMu):
+        ll = fd.LogLikelihood(**opts, n_trials=1, mu_estimators=partial(
+            mu_est, options=dict(rtol=1e-3, max_trials=100)))
+        est = ll.mu_estimators['bla']
+
+        # The linear y direction converges after testing one midpoint
+        # per initial interval, the curved x direction needs many more
+        anchors = est.anchors
+        if isinstance(anchors, tuple):
+            anchors = dict(zip(est.bounds.keys(), anchors))
+        assert len(anchors['y']) == 5
+        assert 5 < len(anchors['x']) <= 3 + 100 - 2
+
+        for x in (-0.55, 0.1, 0.3):
+            assert np.isclose(-ll(x=x, y=0.5),
+                              CurvedMuSource().our_mu(x, 0.5),
+                              rtol=1e-2)
+
+
+def test_quadrature_mu():
+    source = fd.ERSource()
+    est = fd.QuadratureMu(
+        source, progress=False,
+        options=dict(n_bins=20, n_truth_samples=1),
+        elife=(300e3, 600e3))
+
+    mu_mc = source.estimate_mu(n_trials=int(1e5))
+    assert np.isclose(est(), mu_mc, rtol=0.03)
+    errors = est.error_estimate()
+    assert set(errors.keys()) == {'quadrature', 'sampling'}
+
+    # Mu is deterministic, and has a gradient
+    elife = tf.constant(400e3, dtype=fd.float_type())
+    with tf.GradientTape() as t:
+        t.watch(elife)
+        mu = est(elife=elife)
+    assert est(elife=elife) == mu
+    assert t.gradient(mu, elife) is not None
+
+
+def test_quadrature_mu_likelihood():
+    np.random.seed(0)
+    data = fd.ERSource().simulate(30)
+    lf = fd.LogLikelihood(
+        sources=dict(er=fd.ERSource),
+        data=data,
+        free_rates='er',
+        batch_size=10,
+        progress=False,
+        mu_estimators=partial(
+            fd.QuadratureMu,
+            options=dict(n_bins=10, n_truth_samples=1)),
+        elife=(300e3, 600e3))
+    est = lf.mu_estimators['er']
+    params = dict(elife=450e3, er_rate_multiplier=1.2)
+    i_rm, i_elife = (lf.param_names.index(pname)
+                     for pname in ('er_rate_multiplier', 'elife'))
+
+    ll, grad, hess = lf.log_likelihood(second_order=True, **params)
+    _, _, hvp = lf.log_likelihood(hvp_vector=[1., 1e-5], **params)
+    np.testing.assert_allclose(hvp, hess @ [1., 1e-5], rtol=1e-4)
+
+    # Mu and its derivative match the estimator's
+    elife = tf.constant(params['elife'], dtype=fd.float_type())
+    with tf.GradientTape() as t:
+        t.watch(elife)
+        mu = est(elife=elife)
+    np.testing.assert_allclose(
+        grad[i_rm], len(data) / params['er_rate_multiplier'] - mu.numpy(),
+        rtol=1e-4)
+    np.testing.assert_allclose(
+        hess[i_rm, i_elife], -t.gradient(mu, elife).numpy(), rtol=1e-3)
+
+    # Mu is integrated once per parameter point, and then reused
+    cache = est._caches[('elife',)]
+    assert cache['x'].numpy() == params['elife']
+    cache['mu'].assign_add(1.)
+    assert np.isclose(ll - lf(**params), params['er_rate_multiplier'],
+                      rtol=1e-3)
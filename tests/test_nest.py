@@ -1,5 +1,14 @@
 import numpy as np
 import pandas as pd
+import pytest
+
+import flamedisx.nest as fd_nest
+
+
+class ScaledYieldERSource(fd_nest.nestERSource):
+    def mean_yield_electron(self, energy, electron_scale=1.):
+        return electron_scale * super().mean_yield_electron(energy)
+
 
 def dummy_data():
     return pd.DataFrame(
@@ -20,6 +29,15 @@ def test_nest_source():
     df_test = dummy_data()
     s = fd_nest.nestERSource(df_test, energy_min=8, energy_max=8, num_energies=1, batch_size=2)
 
+    # The MC reservoir for bounds estimation is reused if settings are unchanged
+    # and so are the sorted reservoir arrays for the priors
+    reservoir = s.mc_reservoir
+    prior_reservoirs = s.prepare_priors()
+    s.set_data(df_test)
+    assert s.mc_reservoir is reservoir
+    assert s.prepare_priors() is prior_reservoirs
+    assert np.all(np.diff(reservoir['electrons_produced'].values) >= 0)
+
     # Simulate events
     d_sim = s.simulate(1000)
     assert isinstance(d_sim, pd.DataFrame)
@@ -43,3 +61,62 @@ def test_nest_source():
         [1.837623e-05, 4.047864e-05],
         # For some reason, we get different values on different machines
         rtol=5e-3)
+
+    # Summing over the energy spectrum in chunks gives the same result
+    s.energy_chunk_size = 1
+    np.testing.assert_allclose(
+        s.differential_rate(s.data_tensor[0], autograph=False).numpy(),
+        dr.numpy(),
+        rtol=1e-4)
+
+    # Looking up the quanta splitting from a precomputed table gives
+    # nearly the same result; the table also includes the far tails
+    s.energy_chunk_size = None
+    s.use_quanta_table = True
+    assert not s.model_blocks[1].yield_params_free()
+    np.testing.assert_allclose(
+        s.differential_rate(s.data_tensor[0], autograph=False).numpy(),
+        dr.numpy(),
+        rtol=1e-2)
+
+
+def test_nest_parallel_annotate():
+    import flamedisx.nest as fd_nest
+    df_test = dummy_data()
+    s = fd_nest.nestERSource(df_test, energy_min=8, energy_max=8, num_energies=1, batch_size=1)
+    reservoir = s.mc_reservoir
+    serial_data = s.data.copy()
+
+    # Workers use the MC reservoir built in this process, so bounds and
+    # priors are identical to those from serial annotation
+    s.n_annotate_processes = 2
+    s.set_data(df_test)
+    assert s.mc_reservoir is reservoir
+    pd.testing.assert_frame_equal(s.data, serial_data)
+
+    # The worker processes are reused for later annotations
+    pool = s._annotate_pool
+    s.set_data(df_test)
+    assert s._annotate_pool is pool
+    pd.testing.assert_frame_equal(s.data, serial_data)
+    s.close_annotate_pool()
+
+
+def test_quanta_table_settings(tmp_path):
+    fn = str(tmp_path / 'quanta_table.npz')
+    kwargs = dict(energy_min=8, energy_max=8, num_energies=1, fit_params=[],
+                  quanta_table_file=fn)
+    s1 = ScaledYieldERSource(**kwargs)
+    s2 = ScaledYieldERSource(**kwargs, electron_scale=0.8)
+    b1, b2 = s1.model_blocks[1], s2.model_blocks[1]
+    assert b1.quanta_table_key() != b2.quanta_table_key()
+
+    # Sources with different yield defaults do not share a table,
+    # neither from the file nor in memory
+    t1 = b1.quanta_table()
+    with pytest.warns(UserWarning, match='different settings'):
+        t2 = b2.quanta_table()
+    assert t1['p'].shape != t2['p'].shape
+
+    s1.set_defaults(electron_scale=0.8)
+    np.testing.assert_array_equal(b1.quanta_table()['p'], t2['p'])
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+import flamedisx as fd
+
+
+def test_toy_datasets(tmp_path):
+    frames = [
+        pd.DataFrame(dict(s1=[1., 2., 3.], s2=[10., 20., 30.],
+                          source=['er', 'nr', 'er'])),
+        pd.DataFrame(dict(s1=np.zeros(0), s2=np.zeros(0),
+                          source=np.zeros(0, dtype=str))),
+        pd.DataFrame(dict(s1=[4.], source=['nr']))]
+    toys = fd.ToyDatasets.from_frames(frames)
+    assert len(toys) == 3
+    np.testing.assert_array_equal(toys.n_events, [3, 0, 1])
+    pd.testing.assert_frame_equal(toys[0], frames[0])
+    assert len(toys[1]) == 0
+    assert np.isnan(toys[2]['s2'].values).all()
+
+    # Views share memory with the concatenated arrays
+    assert np.shares_memory(toys.view(2)['s1'].values, toys.columns['s1'])
+
+    toys.save(str(tmp_path))
+    loaded = fd.ToyDatasets.load(str(tmp_path))
+    assert isinstance(loaded.columns['s1'], np.memmap)
+    for toy, loaded_toy in zip(toys, loaded):
+        pd.testing.assert_frame_equal(toy, loaded_toy)
+
+
+def test_test_statistic_reuses_fits(template_lf):
+    lf = template_lf
+    lf.set_data(lf.simulate())
+    guess = dict(sig_rate_multiplier=1., bkg_rate_multiplier=1.)
+
+    ts = fd.TestStatisticTMuTilde(lf)
+    n_fits = 0
+    bestfit = lf.bestfit
+
+    def counting_bestfit(*args, **kwargs):
+        nonlocal n_fits
+        n_fits += 1
+        return bestfit(*args, **kwargs)
+
+    lf.bestfit = counting_bestfit
+    results = [ts(mu_test, 'sig', guess) for mu_test in (0.5, 1., 2.)]
+    # One unconditional fit, and one conditional fit per mu_test
+    assert n_fits == 4
+    assert list(ts.conditional_fits['sig'].keys()) == [0.5, 1., 2.]
+
+    # Warm-started fits find the same test statistic as fresh ones
+    fresh_result = fd.TestStatisticTMuTilde(lf)(2., 'sig', guess)
+    np.testing.assert_allclose(results[-1][0], fresh_result[0],
+                               rtol=1e-3, atol=1e-3)
+
+
+def test_test_statistics_keyed_on_data(template_model):
+    tse = fd.TSEvaluation(
+        fd.TestStatisticTMuTilde, ('sig',), ('bkg',),
+        **template_model,
+        expected_background_counts=dict(bkg=1.))
+    lf = tse.make_likelihood('sig')
+    data = lf.simulate(sig_rate_multiplier=3.)
+    args = dict(bkg_expected_counts=1.)
+
+    # Test statistics (and their fits) are shared by identical datasets
+    ts = tse.get_test_statistic(lf, data, args)
+    assert tse.get_test_statistic(lf, data.copy(), args) is ts
+    assert tse.get_test_statistic(
+        lf, pd.concat([data, data], ignore_index=True), args) is not ts
+    assert tse.get_test_statistic(
+        lf, data, dict(bkg_expected_counts=2.)) is not ts
+
+    # A new likelihood needs new test statistics
+    lf = tse.make_likelihood('sig')
+    assert tse.get_test_statistic(lf, data, args).likelihood is lf
+
+
+def test_adaptive_toys(template_model):
+    tse = fd.TSEvaluation(
+        fd.TestStatisticTMuTilde, ('sig',), ('bkg',),
+        **template_model,
+        expected_background_counts=dict(bkg=1.),
+        ntoys=60)
+    simulate_dict_B, toy_data_B, constraint_extra_args_B = \
+        tse.run_routine(generate_B_toys=True)
+    observed, dists_SB, dists_B = tse.run_routine_adaptive(
+        dict(sig=np.array([0.1, 1., 4.])), toy_data_B[0],
+        conf_level=0.1, toys_per_round=10, n_refine=1,
+        simulate_dict_B=simulate_dict_B, toy_data_B=toy_data_B,
+        constraint_extra_args_B=constraint_extra_args_B)
+
+    # Far above the crossing, we stop before running all toys
+    n_toys = {mu: len(ts) for mu, ts in dists_SB['sig'].ts_dists.items()}
+    assert n_toys[4.] < 60
+
+    # The grid was refined where the p-value crosses conf_level
+    p_vals = dists_SB['sig'].get_p_vals(observed['sig'])
+    mus = list(p_vals.keys())
+    assert mus == sorted(mus) and len(mus) > 3
+    fd.IntervalCalculator(('sig',), observed, dists_SB, dists_B).get_interval(
+        conf_level=0.1)
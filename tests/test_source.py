@@ -1,4 +1,5 @@
 from datetime import timedelta
+import os
 import warnings
 
 import numpy as np
@@ -54,22 +55,27 @@ def xes(request):
     elif request.param == 'WIMP':
         x = fd.WIMPSource(data.copy(), batch_size=2, max_sigma=8)
     elif request.param == 'ER_spatial':
-        nbins = 100
-        r = np.linspace(0, 47.9, nbins + 1)
-        z = np.linspace(-97.6, 0, nbins + 1)
-        theta = np.linspace(0, 2 * np.pi, nbins + 1)
+        x = ERSpatial(data.copy(), batch_size=2, max_sigma=8)
+    return x
 
-        # Construct histogram corresponding to a uniform source
-        # (since the tests expect this)
-        # number of events ~ bin volume ~ r
-        h = Histdd(bins=[r, theta, z], axis_names=['r', 'theta', 'z'])
-        h.histogram = h.histogram * 0 + h.bin_centers('r')[:, None, None]
 
-        class ERSpatial(fd.SpatialRateERSource):
-            spatial_hist = h
+def uniform_spatial_hist():
+    nbins = 100
+    r = np.linspace(0, 47.9, nbins + 1)
+    z = np.linspace(-97.6, 0, nbins + 1)
+    theta = np.linspace(0, 2 * np.pi, nbins + 1)
+
+    # Construct histogram corresponding to a uniform source
+    # (since the tests expect this)
+    # number of events ~ bin volume ~ r
+    h = Histdd(bins=[r, theta, z], axis_names=['r', 'theta', 'z'])
+    h.histogram = h.histogram * 0 + h.bin_centers('r')[:, None, None]
+    return h
 
-        x = ERSpatial(data.copy(), batch_size=2, max_sigma=8)
-    return x
+
+# Defined at module level, so worker processes can unpickle it
+class ERSpatial(fd.SpatialRateERSource):
+    spatial_hist = uniform_spatial_hist()
 
 
 def test_test(xes):
@@ -150,6 +156,40 @@ def test_simulate(xes: fd.ERSource):
     assert simd['energy'].values[0] == e_test
 
 
+def test_columnar_simulate(xes: fd.ERSource):
+    """Columnar simulation gives the same events as pandas simulation"""
+    assert xes.columnar_simulation
+    n_ev = int(1e3)
+    with xes.common_random_numbers():
+        simd_columnar = xes.simulate(n_ev)
+        n_accepted = xes.simulate(n_ev, _count_only=True)
+    xes.columnar_simulation = False
+    with xes.common_random_numbers():
+        simd = xes.simulate(n_ev)
+
+    assert isinstance(simd_columnar, pd.DataFrame)
+    assert len(simd) == len(simd_columnar) == n_accepted
+    pd.testing.assert_frame_equal(
+        simd.reset_index(drop=True), simd_columnar, check_dtype=False)
+
+
+def test_chunked_simulate(xes: fd.ERSource):
+    """Chunked simulation does not depend on the number of processes"""
+    n_ev = int(1e3)
+    xes.simulate_chunk_size = 300
+    np.random.seed(42)
+    simd = xes.simulate(n_ev)
+    np.random.seed(42)
+    n_accepted = xes.simulate(n_ev, _count_only=True)
+
+    xes.n_simulate_processes = 2
+    np.random.seed(42)
+    simd_parallel = xes.simulate(n_ev)
+    assert len(simd) == n_accepted
+    pd.testing.assert_frame_equal(simd, simd_parallel)
+    assert 0 < xes.estimate_mu(n_trials=n_ev) < float('inf')
+
+
 def test_bounds(xes: fd.ERSource):
     """Test bounds on nq_produced and _detected"""
     data = xes.data
@@ -344,6 +384,47 @@ def test_set_data(xes: fd.ERSource):
     assert x.shape == (3,)
 
 
+def test_append_data(xes: fd.ERSource):
+    data1 = xes.data.copy()
+    data2 = pd.concat([data1, data1.iloc[:1]], ignore_index=True)
+    data2['s1'] *= 0.9
+
+    # Full reference computation
+    xes.set_data(pd.concat([data1, data2], ignore_index=True))
+    x_full = xes.batched_differential_rate()
+
+    # Incremental: 2 + 3 events, with a padded batch at the end
+    xes.set_data(data1)
+    xes.append_data(data2.iloc[:2])
+    assert xes.n_events == 4
+    assert xes.n_batches == 2
+    xes.append_data(data2.iloc[2:])
+    assert xes.n_events == 5
+    assert xes.n_batches == 3
+    assert xes.n_padding == 1
+    assert len(xes.data) == 6
+
+    np.testing.assert_array_equal(
+        xes.data['s1'].values[:5],
+        pd.concat([data1, data2])['s1'].values)
+    np.testing.assert_allclose(xes.batched_differential_rate(),
+                               x_full,
+                               rtol=1e-4)
+
+
+def test_parallel_annotate():
+    data = pd.concat([dummy_data(), dummy_data()], ignore_index=True)
+    data['s1'] *= np.array([1., 1., 0.9, 0.9])
+
+    s = fd.ERSource(data.copy(), batch_size=2)
+    s2 = fd.ERSource(data.copy(), batch_size=2, n_annotate_processes=2)
+    assert s2.n_batches == 2
+
+    pd.testing.assert_frame_equal(s.data, s2.data)
+    np.testing.assert_array_equal(s.batched_differential_rate(),
+                                  s2.batched_differential_rate())
+
+
 def test_clip(xes):
     if not isinstance(xes, fd.WIMPSource):
         return
@@ -357,6 +438,48 @@ def test_clip(xes):
     xes.simulate(10, fix_truth=dict(event_time=t_good))
 
 
+def test_wimp_energy_spectrum():
+    data = fd.WIMPSource().simulate(100)
+    s = fd.WIMPSource(data.copy(), batch_size=50)
+    b = s.model_blocks[0]
+
+    # Vectorized lookup matches a slice of the histogram for each event
+    ts = b.clip_j2000_times(j2000(s.data['event_time'].values))
+    expected = np.stack([b.energy_hist.slicesum(t).histogram for t in ts])
+    np.testing.assert_array_equal(
+        s.gimme_numpy('energy_spectrum'),
+        expected.astype(fd.float_type().as_numpy_dtype))
+
+    # In-graph lookup gives the same differential rate, up to
+    # float32 rounding of event times near time bin edges
+    class InGraphWIMPSource(fd.WIMPSource):
+        in_graph_energy_spectrum = True
+
+    s2 = InGraphWIMPSource(data.copy(), batch_size=50)
+    assert 'energy_spectrum' not in s2.column_index
+    np.testing.assert_allclose(s.batched_differential_rate(),
+                               s2.batched_differential_rate(),
+                               rtol=1e-2)
+
+
+def test_wimp_spectra_cache(tmp_path):
+    kwargs = dict(time_centers=np.array([7000., 7100.]),
+                  energy_edges=np.geomspace(1, 50, 11),
+                  mw=50., sigma_nucleon=1e-45)
+    spectra = fd.wimp_spectra(**kwargs, cache_dir=str(tmp_path))
+    assert spectra.shape == (2, 10)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Spectra are loaded from disk in a fresh process
+    fd.lxe_blocks.energy_spectrum._wimp_spectra_memo.clear()
+    np.testing.assert_array_equal(
+        spectra, fd.wimp_spectra(**kwargs, cache_dir=str(tmp_path)))
+
+    # and different settings give a different cache entry
+    fd.wimp_spectra(**{**kwargs, 'mw': 100.}, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+
+
 def test_config(xes):
     # Test the use of config files to set source attributes
     xes.set_defaults(config='example')
@@ -392,6 +515,11 @@ def test_FrozenReservoirSource():
     assert d_er['source'].values.all() == 'er'
     assert d_nr['source'].values.all() == 'nr'
 
+    # Check simulated events are whole rows of the reservoir
+    d_big = s_er.simulate(100)
+    assert (d_big['source'] == 'er').all()
+    assert len(d_big.merge(res[res['source'] == 'er'])) >= len(d_big)
+
     # Compute differential rates
     s_er.set_data(d_er)
     dr_data_er_source_er = s_er.batched_differential_rate()
@@ -409,3 +537,115 @@ def test_FrozenReservoirSource():
 
     assert (dr_data_nr_source_er == d_nr['er_diff_rate'].values).all()
     assert (dr_data_nr_source_nr == d_nr['nr_diff_rate'].values).all()
+
+
+def test_settings_key():
+    s = fd.ERSource()
+    key = s.settings_key()
+    assert 'n_annotate_processes' in s.non_physics_settings
+
+    # Performance settings do not change the key, model settings do
+    s.n_annotate_processes = 2
+    s.simulate_chunk_size = 100
+    assert s.settings_key() == key
+    assert fd.ERSource(elife=1e5).settings_key() != key
+
+
+def test_build_event_reservoir(tmp_path):
+    sources = dict(er=fd.ERSource(batch_size=100),
+                   nr=fd.NRSource(batch_size=100))
+    n_sim = {sname: int(source.mu_before_efficiencies())
+             for sname, source in sources.items()}
+    res = fd.build_event_reservoir(str(tmp_path), ntoys=1,
+                                   chunk_size=max(n_sim.values()) // 2,
+                                   seed=42, progress=False, **sources)
+    assert isinstance(res, fd.ColumnarData)
+    # Columns are memory-mapped, not read into memory
+    base = res['er_diff_rate'].values
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert isinstance(base, np.memmap)
+    assert set(np.unique(res['source'].values)) == {'er', 'nr'}
+    for sname in sources:
+        assert (res['source'].values == sname).sum() <= n_sim[sname]
+
+    # Differential rates match a direct computation (up to the
+    # data-dependent dimension bounds, which differ per chunk)
+    d = pd.DataFrame({column: res[column].values for column in res.columns})
+    for sname, source in sources.items():
+        source.set_data(d[d['source'] == sname])
+        np.testing.assert_allclose(
+            source.batched_differential_rate(progress=False),
+            d[d['source'] == sname][f'{sname}_diff_rate'].values,
+            rtol=0.05)
+
+    # Interrupted builds resume and give the same reservoir,
+    # also when simulating in worker processes
+    os.remove(tmp_path / 'reservoir.json')
+    os.remove(tmp_path / 'events_er_00001.pkl')
+    os.remove(tmp_path / 'events_er_00001_nr_diff_rate.npy')
+    res_2 = fd.build_event_reservoir(str(tmp_path), ntoys=1,
+                                     chunk_size=max(n_sim.values()) // 2,
+                                     n_processes=2, progress=False, **sources)
+    for column in res.columns:
+        np.testing.assert_array_equal(res[column].values, res_2[column].values)
+
+    # FrozenReservoirSources can simulate from the reservoir directory
+    s_er = fd.FrozenReservoirSource(source_type=fd.ERSource, source_name='er',
+                                    reservoir=str(tmp_path))
+    d_er = s_er.simulate(5)
+    assert (d_er['source'] == 'er').all()
+    s_er.set_data(d_er)
+    np.testing.assert_array_equal(s_er.batched_differential_rate(progress=False),
+                                  d_er['er_diff_rate'].values)
+
+    # Resuming or loading with different settings fails
+    with pytest.raises(ValueError):
+        fd.build_event_reservoir(str(tmp_path), ntoys=2, progress=False,
+                                 **sources)
+    with pytest.raises(ValueError):
+        fd.build_event_reservoir(
+            str(tmp_path), ntoys=1, chunk_size=max(n_sim.values()) // 2,
+            progress=False,
+            **{**sources, 'er': fd.ERSource(batch_size=100, elife=1e5)})
+    os.remove(tmp_path / 'reservoir.json')
+    with pytest.raises(ValueError):
+        fd.build_event_reservoir(str(tmp_path), ntoys=2, progress=False,
+                                 **sources)
+
+
+def test_reweighted_frozen_reservoir(tmp_path):
+    er = fd.ERSource(batch_size=100)
+    elife_anchors = [3.5e5, 5.5e5]
+    fd.build_event_reservoir(str(tmp_path), ntoys=1, seed=1, progress=False,
+                             anchors=dict(er=dict(elife=elife_anchors)),
+                             er=er)
+    s = fd.FrozenReservoirSource(source_type=fd.ERSource, source_name='er',
+                                 reservoir=str(tmp_path))
+    assert 'elife' in s.defaults
+
+    # At the anchors, we recover the stored differential rates
+    d = s.simulate(20)
+    s.set_data(d)
+    for i, elife in enumerate(elife_anchors):
+        np.testing.assert_allclose(
+            s.batched_differential_rate(progress=False, elife=elife),
+            d[f'er_diff_rate_elife_{i}'].values,
+            rtol=1e-4)
+    np.testing.assert_allclose(
+        s.batched_differential_rate(progress=False),
+        d['er_diff_rate'].values,
+        rtol=1e-4)
+
+    # Reweighted mu is close to the true one
+    np.testing.assert_allclose(s.estimate_mu(elife=5.5e5),
+                               er.estimate_mu(elife=5.5e5),
+                               rtol=0.05)
+
+    # Longer electron lifetimes give larger S2s
+    np.random.seed(0)
+    assert (s.simulate(2000, elife=5.5e5)['s2'].mean()
+            > s.simulate(2000, elife=3.5e5)['s2'].mean())
+
+    with pytest.raises(NotImplementedError):
+        s.simulate(10, g2=21.)
@@ -1,5 +1,7 @@
 import flamedisx as fd
 import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
 
 from multihist import Histdd
 
@@ -30,3 +32,114 @@ def test_template():
 
     # Total events should equal the histogram sum
     assert np.isclose(st.estimate_mu().numpy(), mh.n)
+
+
+def test_template_interpolation():
+    np.random.seed(42)
+    mh = Histdd(np.random.normal(50, 10, size=10_000),
+                np.random.normal(2000, 300, size=10_000),
+                bins=[np.linspace(20, 80, 13), np.geomspace(1000, 3000, 9)],
+                axis_names=['s1', 's2'])
+    d = pd.DataFrame(dict(s1=np.random.uniform(10, 90, 100),
+                          s2=np.random.uniform(800, 3500, 100)))
+
+    # Linear interpolation between bin centers, with points outside
+    # the grid clipped to it (like scipy's interp2d did)
+    centers = mh.bin_centers()
+    expected = RegularGridInterpolator(centers, mh.histogram)(np.stack([
+        np.clip(d[dim], c[0], c[-1])
+        for dim, c in zip(['s1', 's2'], centers)], axis=1))
+    st = fd.TemplateSource(mh, data=d.copy(), interpolate=True, batch_size=50)
+    np.testing.assert_allclose(st.batched_differential_rate(), expected,
+                               rtol=1e-5)
+
+    # Evaluating the template in the graph gives the same result
+    for interpolate in (True, False):
+        st = fd.TemplateSource(mh, data=d.copy(), interpolate=interpolate,
+                               batch_size=50)
+        st_graph = fd.TemplateSource(mh, data=d.copy(),
+                                     interpolate=interpolate,
+                                     in_graph=True, batch_size=50)
+        assert st.column not in st_graph.column_index
+        np.testing.assert_allclose(st.batched_differential_rate(),
+                                   st_graph.batched_differential_rate(),
+                                   rtol=1e-5)
+
+
+def test_morphed_template():
+    np.random.seed(42)
+    n = 10_000
+    bin_edges = [np.linspace(0, 10, 11), np.linspace(0, 5, 6)]
+    param_grid = dict(shift=[-1., 0., 1.], width=[1., 2.])
+    # Expected events per bin, with the total depending on the shift
+    templates = [[Histdd(np.random.normal(5 + shift, width, n),
+                         np.random.uniform(0, 5, n),
+                         bins=bin_edges, axis_names=['s1', 's2'])
+                  * (2 + shift) * 100 / n
+                  for width in param_grid['width']]
+                 for shift in param_grid['shift']]
+    arguments = dict(templates=templates, param_grid=param_grid,
+                     events_per_bin=True)
+
+    st = fd.MorphedTemplateSource(**arguments, batch_size=100)
+    assert st.defaults['shift'] == 0. and st.defaults['width'] == 1.5
+    d = st.simulate(100, shift=1., width=2.)
+    st.set_data(d)
+
+    # On the grid, the differential rate is that of the template;
+    # halfway between grid points, it is the average
+    def template_diff_rate(i, j):
+        h = templates[i][j]
+        return (h / h.bin_volumes()).lookup(d['s1'], d['s2'])
+    np.testing.assert_allclose(
+        st.batched_differential_rate(shift=1., width=2.),
+        template_diff_rate(2, 1), rtol=1e-5)
+    np.testing.assert_allclose(
+        st.batched_differential_rate(shift=0.5, width=2.),
+        (template_diff_rate(1, 1) + template_diff_rate(2, 1)) / 2,
+        rtol=1e-5)
+
+    # The mu estimator gives the exact mu of the morphed template
+    lf = fd.LogLikelihood(
+        sources=dict(bg=fd.MorphedTemplateSource),
+        arguments=dict(bg=arguments),
+        data=d,
+        free_rates=tuple(),
+        mu_estimators=fd.TemplateMorphMu,
+        shift=(-1., 1.), width=(1., 2.))
+    expected_mu = (templates[1][0].n + templates[2][0].n) / 2
+    np.testing.assert_allclose(
+        lf.mu(source_name='bg', shift=0.5, width=1.),
+        expected_mu, rtol=1e-5)
+    np.testing.assert_allclose(
+        st.estimate_mu(shift=0.5, width=1.), expected_mu, rtol=1e-5)
+
+    # The shape parameters have gradients
+    _, grad, _ = lf.log_likelihood(shift=0.5, width=1.5)
+    assert np.all(grad != 0)
+
+
+def test_build_template_source(tmp_path):
+    s = fd.ERSource()
+    bin_edges = dict(s1=np.linspace(0, 70, 8), s2=np.geomspace(300, 8000, 8))
+    fn = str(tmp_path / 'template.npz')
+
+    np.random.seed(42)
+    st = fd.build_template_source(s, bin_edges, n_events=int(1e5),
+                                  filename=fn, batch_size=100)
+    assert isinstance(st, fd.TemplateSource)
+    assert st.template_metadata['method'] == 'simulate'
+    # Nearly all events fall in the bins
+    mu = s.estimate_mu(n_trials=int(1e5))
+    assert abs(st.estimate_mu().numpy() - mu) / mu < 0.05
+
+    # Template can be loaded from disk
+    st2 = fd.load_template_source(fn)
+    assert st2.template_metadata == st.template_metadata
+    np.testing.assert_array_equal(st2._mh_events_per_bin.histogram,
+                                  st._mh_events_per_bin.histogram)
+
+    # Quadrature gives a similar total
+    st3 = fd.build_template_source(s, bin_edges, method='quadrature',
+                                   n_truth_samples=2)
+    assert abs(st3.estimate_mu().numpy() - mu) / mu < 0.1